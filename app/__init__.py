@@ -7,16 +7,24 @@ from flask_mail import Mail
 from flask_moment import Moment
 from flask_login import LoginManager
 from flask_pagedown import PageDown
+from werkzeug.local import LocalProxy
+from celery import Celery
 from config import config
-import redis
+from . import redis_pool
+from . import metrics
+from . import profiler
 
 
 bootstrap = Bootstrap()
 mail = Mail()
 moment = Moment()
 pagedown = PageDown()
+celery = Celery(__name__)
 
-rd = None
+# 当前进程的redis客户端, fork之后自动重新创建连接池
+rd = LocalProxy(redis_pool.get_client)
+# 读取使用的客户端, 配置了从库时在请求中读从库
+rd_read = LocalProxy(redis_pool.get_read_client)
 
 
 login_manager = LoginManager()
@@ -36,9 +44,21 @@ def create_app(config_name):
     mail.init_app(app)
     moment.init_app(app)
     pagedown.init_app(app)
-    global rd
-    rd = redis.Redis(host=config[config_name].REDIS_IP, port=config[config_name].REDIS_PORT,
-                     db=config[config_name].REDIS_DB, password=config[config_name].REDIS_PWD)
+    redis_pool.init_app(app)
+    redis_pool.init_routing(app)
+    metrics.init_app(app)
+    profiler.init_app(app)
+    celery.conf.update(broker_url=app.config['CELERY_BROKER_URL'] or redis_pool.url(app.config),
+                       beat_schedule={'send-queued-mail': {'task': 'app.email.send_queued_mail',
+                                                           'schedule': app.config['MAIL_QUEUE_INTERVAL']},
+                                      'purge-posts': {'task': 'app.tasks.purge_posts',
+                                                      'schedule': app.config['POSTS_PURGE_INTERVAL']}})
+    from .data import backend
+    backend.init_app(app)
+    from . import purge
+    purge.init_app(app)
+    from . import assets
+    assets.init_app(app)
     login_manager.init_app(app)
 
     # 注册蓝图
@@ -48,4 +68,11 @@ def create_app(config_name):
     from .auth import auth as auth_blueprint
     # url_prefix为可选参数，如果设置，注册后的蓝本中定义的所有路由都会加上指定的前缀
     app.register_blueprint(auth_blueprint, url_prefix='/auth')
+
+    # 注册celery任务
+    from . import email, tasks
+
+    if app.config['GZIP_ENABLED']:
+        from .compress import GzipMiddleware
+        app.wsgi_app = GzipMiddleware(app.wsgi_app, app.config['GZIP_MIN_SIZE'], app.config['GZIP_LEVEL'])
     return app
@@ -0,0 +1,115 @@
+# !/usr/bin/python
+# coding=utf-8
+
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+from functools import partial
+from flask import current_app, request, send_from_directory
+from .compress import accepts_gzip, compressible
+
+'''
+静态文件的指纹和预压缩;
+1. manage.py build_static 把static下的文件复制到static/dist, 文件名加上内容的md5(styles.<md5>.css),
+   可以压缩的文件同时写入gzip压缩(level 9)的.gz, 压缩后没有变小时不写; dist/manifest.json记录原文件名到带指纹文件名的映射;
+2. 启动时存在manifest则url_for('static', filename=...)生成dist下带指纹的地址, 每次部署重新构建;
+   旧的文件保留, 代理和浏览器中缓存的旧页面引用的文件仍然可用;
+3. dist下的文件内容不会变化, 返回Cache-Control: public, max-age=STATIC_MAX_AGE, immutable;
+   客户端接受gzip并且有.gz时直接发送.gz, 不再经过GzipMiddleware压缩;
+'''
+
+DIST = 'dist'
+MANIFEST = 'manifest.json'
+
+
+def _fingerprint(filename, data):
+    root, ext = os.path.splitext(filename)
+    return '{0}.{1}{2}'.format(root, hashlib.md5(data).hexdigest()[:12], ext)
+
+
+def _gzip(data, level):
+    out = io.BytesIO()
+    # mtime固定为0, 相同的内容每次构建得到相同的文件
+    with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=level, mtime=0) as f:
+        f.write(data)
+    return out.getvalue()
+
+
+def _write(path, data):
+    # 先写临时文件再替换, 正在运行的进程不会读到写了一半的文件
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def build(static_folder, level=9):
+    """
+    write fingerprinted copies of the files in static_folder and their gzip versions to static_folder/dist
+    return the manifest, dict filename -> fingerprinted filename
+    """
+    output = os.path.join(static_folder, DIST)
+    manifest = {}
+    for root, dirs, files in os.walk(static_folder):
+        if root == static_folder and DIST in dirs:
+            dirs.remove(DIST)
+        for name in files:
+            filename = os.path.relpath(os.path.join(root, name), static_folder).replace(os.sep, '/')
+            with open(os.path.join(root, name), 'rb') as f:
+                data = f.read()
+            target = _fingerprint(filename, data)
+            path = os.path.join(output, *target.split('/'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _write(path, data)
+            mimetype = mimetypes.guess_type(filename)[0]
+            if mimetype is not None and compressible(mimetype):
+                compressed = _gzip(data, level)
+                if len(compressed) < len(data):
+                    _write(path + '.gz', compressed)
+            manifest[filename] = target
+    _write(os.path.join(output, MANIFEST), json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    return manifest
+
+
+def load_manifest(static_folder):
+    """
+    return the manifest written by build, empty if static files have not been built
+    """
+    path = os.path.join(static_folder, DIST, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _fingerprinted_url(manifest, endpoint, values):
+    if endpoint == 'static' and values.get('filename') in manifest:
+        values['filename'] = DIST + '/' + manifest[values['filename']]
+
+
+def _static(filename):
+    if not filename.startswith(DIST + '/'):
+        return current_app.send_static_file(filename)
+    folder = os.path.join(current_app.static_folder, DIST)
+    filename = filename[len(DIST) + 1:]
+    precompressed = os.path.isfile(os.path.join(folder, *(filename + '.gz').split('/')))
+    compressed = precompressed and accepts_gzip(request.environ)
+    max_age = current_app.config['STATIC_MAX_AGE']
+    resp = send_from_directory(folder, filename + '.gz' if compressed else filename, cache_timeout=max_age,
+                               mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+    resp.headers['Cache-Control'] = 'public, max-age={}, immutable'.format(max_age)
+    if compressed:
+        resp.headers['Content-Encoding'] = 'gzip'
+    if precompressed:
+        resp.vary.add('Accept-Encoding')
+    return resp
+
+
+def init_app(app):
+    manifest = load_manifest(app.static_folder)
+    if manifest:
+        app.url_defaults(partial(_fingerprinted_url, manifest))
+    app.view_functions['static'] = _static
@@ -6,6 +6,7 @@ from flask import redirect
 from flask import request
 from flask import url_for
 from flask import flash
+from flask import session
 from flask_login import login_user
 from flask_login import logout_user
 from flask_login import login_required
@@ -35,6 +36,8 @@ def login():
 @auth.route('/logout')
 def logout():
     logout_user()
+    # 删除按钮生成的csrf_token, 否则session_protection会在之后每个匿名请求中修改session, 页面无法缓存
+    session.pop('csrf_token', None)
     flash('You have been logged out!')
     return redirect(url_for('main.index'))
 
@@ -0,0 +1,140 @@
+# !/usr/bin/python
+# coding=utf-8
+
+import re
+import zlib
+
+'''
+响应的gzip压缩, WSGI中间件, GZIP_ENABLED开启;
+1. 请求的Accept-Encoding接受gzip, 响应是文本类型(COMPRESSIBLE_TYPES), 没有Content-Encoding并且没有Cache-Control: no-transform时压缩;
+2. 有Content-Length时小于GZIP_MIN_SIZE的响应不压缩; 流式响应(没有Content-Length)先缓冲到GZIP_MIN_SIZE再决定;
+3. 边读取边压缩, 每一块压缩后立即发送(Z_SYNC_FLUSH), 不等待整个响应生成;
+4. 压缩后删除Content-Length, 强ETag改为弱ETag; 可以压缩的响应都增加Vary: Accept-Encoding;
+'''
+
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'application/xml', 'image/svg+xml',
+                      'image/x-icon', 'image/vnd.microsoft.icon')
+_GZIP_RE = re.compile(r'(?:^|,)\s*gzip\s*(?:;\s*q=([0-9.]+))?\s*(?:,|$)', re.I)
+
+
+def accepts_gzip(environ):
+    match = _GZIP_RE.search(environ.get('HTTP_ACCEPT_ENCODING', ''))
+    if match is None:
+        return False
+    try:
+        return match.group(1) is None or float(match.group(1)) > 0
+    except ValueError:
+        return False
+
+
+def compressible(content_type):
+    return content_type.split(';')[0].strip().lower().startswith(COMPRESSIBLE_TYPES)
+
+
+def _header(headers, name):
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+class GzipMiddleware:
+    def __init__(self, app, min_size=1024, level=6):
+        """
+        app: wsgi application, min_size: bytes below which responses are sent as they are
+        """
+        self.app = app
+        self.min_size = min_size
+        self.level = level
+
+    def __call__(self, environ, start_response):
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return self.app(environ, start_response)
+        response = _GzipResponse(self, start_response, accepts_gzip(environ))
+        return response.iterate(self.app(environ, response.start_response))
+
+
+class _GzipResponse:
+    def __init__(self, middleware, start_response, accepted):
+        self._middleware = middleware
+        self._start_response = start_response
+        self._accepted = accepted
+        self._status = None
+        self._headers = None
+        self._exc_info = None
+        # start_response返回的write()写入的数据, 在响应体之前发送
+        self._written = []
+
+    def start_response(self, status, headers, exc_info=None):
+        self._status = status
+        self._headers = headers
+        self._exc_info = exc_info
+        return self._written.append
+
+    def _eligible(self):
+        """
+        return True if the response can be compressed, without looking at its size
+        """
+        headers = self._headers
+        if self._status[:3] in ('204', '206', '304') or _header(headers, 'Content-Encoding') is not None:
+            return False
+        if not compressible(_header(headers, 'Content-Type') or ''):
+            return False
+        return 'no-transform' not in (_header(headers, 'Cache-Control') or '')
+
+    def _start(self, eligible, compress):
+        headers = self._headers
+        if not eligible:
+            self._start_response(self._status, headers, self._exc_info)
+            return
+        if compress:
+            headers = [(key, value) for key, value in headers if key.lower() not in ('content-length', 'etag')]
+            etag = _header(self._headers, 'ETag')
+            if etag is not None:
+                headers.append(('ETag', etag if etag.startswith('W/') else 'W/' + etag))
+            headers.append(('Content-Encoding', 'gzip'))
+        vary = _header(headers, 'Vary')
+        if vary is None:
+            headers.append(('Vary', 'Accept-Encoding'))
+        elif 'accept-encoding' not in vary.lower() and vary.strip() != '*':
+            headers = [(key, value) for key, value in headers if key.lower() != 'vary']
+            headers.append(('Vary', vary + ', Accept-Encoding'))
+        self._start_response(self._status, headers, self._exc_info)
+
+    def iterate(self, body):
+        try:
+            chunks = iter(body)
+            eligible = self._eligible()
+            compress = eligible and self._accepted
+            length = _header(self._headers, 'Content-Length')
+            if compress and length is not None and length.isdigit() and int(length) < self._middleware.min_size:
+                compress = False
+            buffered = list(self._written)
+            size = sum(len(chunk) for chunk in buffered)
+            if compress and length is None:
+                # 流式响应, 缓冲到min_size或者响应结束
+                for chunk in chunks:
+                    buffered.append(chunk)
+                    size += len(chunk)
+                    if size >= self._middleware.min_size:
+                        break
+                else:
+                    compress = size >= self._middleware.min_size
+            self._start(eligible, compress)
+            if not compress:
+                for chunk in buffered:
+                    yield chunk
+                for chunk in chunks:
+                    yield chunk
+                return
+            compressor = zlib.compressobj(self._middleware.level, zlib.DEFLATED, 31)
+            data = compressor.compress(b''.join(buffered))
+            yield data + compressor.flush(zlib.Z_SYNC_FLUSH)
+            for chunk in chunks:
+                if chunk:
+                    yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            yield compressor.flush()
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
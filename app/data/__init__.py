@@ -2,3 +2,8 @@
 # coding=utf-8
 from . import db_posts
 from . import db_users
+from . import backend
+from . import db_feed
+from . import db_mail
+from . import db_pages
+from . import transfer
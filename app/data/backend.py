@@ -0,0 +1,63 @@
+# !/usr/bin/python
+# coding=utf-8
+
+'''
+存储后端; 用户, 文章和关注关系保存在redis(默认)或者关系数据库中, 由STORAGE_BACKEND选择;
+时间线, 邮件队列, 页面缓存等始终使用redis;
+1. 后端是实现了USER_API或POST_API中所有函数的模块, 函数的参数和返回值与redis实现(db_users, db_posts)相同;
+2. redis: db_users, db_posts; sql: sql_users, sql_posts, 连接SQL_DATABASE_URI(sqlite或mysql);
+3. users, posts 转发到当前后端的模块, 调用方不需要知道使用的是哪个后端;
+'''
+
+USER_API = ('reg_user', 'get_user', 'get_user_by_name', 'get_user_by_id', 'get_users_by_ids', 'change_password',
+            'is_email_reg', 'is_username_reg', 'confirm', 'update_last_seen', 'update_profile',
+            'update_admin_profile', 'follow', 'unfollow', 'is_followed', 'is_followed_by', 'followers_by_page',
+            'following_by_page', 'followers_count', 'following_count', 'all_followers', 'all_followings',
+            'max_user_id', 'followed_among')
+
+POST_API = ('publish_post', 'update_post_content', 'update_post_contents', 'iter_post_sources', 'get_post',
+            'get_post_author', 'get_posts', 'delete_post', 'purge_deleted', 'deleted_count', 'total_posts',
+            'total_posts_by_author', 'posts_by_page', 'posts_by_author')
+
+
+class _Backend:
+    def __init__(self, api):
+        self._api = api
+        self._module = None
+
+    def use(self, module):
+        missing = [name for name in self._api if not callable(getattr(module, name, None))]
+        if missing:
+            raise TypeError('{0} does not implement {1}'.format(module.__name__, ', '.join(missing)))
+        self._module = module
+
+    def __getattr__(self, name):
+        if name not in self._api:
+            raise AttributeError(name)
+        if self._module is None:
+            # create_app之前使用时默认redis
+            from . import db_users, db_posts
+            self.use(db_users if self._api is USER_API else db_posts)
+        return getattr(self._module, name)
+
+
+users = _Backend(USER_API)
+posts = _Backend(POST_API)
+
+
+def init_app(app):
+    backend = app.config.get('STORAGE_BACKEND', 'redis')
+    if backend == 'redis':
+        from . import db_users, db_posts, shards
+        shards.init_app(app)
+        db_users.init_cache(app)
+        users.use(db_users)
+        posts.use(db_posts)
+    elif backend == 'sql':
+        from . import sql, sql_users, sql_posts
+        sql.init_app(app)
+        sql_users.init_cache(app)
+        users.use(sql_users)
+        posts.use(sql_posts)
+    else:
+        raise ValueError('unknown STORAGE_BACKEND {}'.format(backend))
@@ -0,0 +1,213 @@
+# !/usr/bin/python
+# coding=utf-8
+
+import atexit
+import os
+import threading
+import time
+from collections import OrderedDict
+
+'''
+进程内缓存;
+1. LRUCache 有容量上限的LRU缓存, 每个条目带有过期时间TTL;
+2. InvalidationListener 通过redis pub/sub订阅失效消息, 每个gunicorn worker收到消息后删除自己缓存中的旧条目;
+   订阅连接断开期间可能丢失消息, 因此重连后清空整个缓存, 其余情况由TTL限制数据的过期时间;
+3. WriteBehindBuffer 延迟合并写入; 同一个key在throttle秒内只接受一次写入, 后台线程每interval秒批量写入,
+   进程退出时写入剩余数据; 进程崩溃时最多丢失interval秒的数据, 只用于丢失后无影响的数据(例如last_seen);
+   写入失败的数据保留, 下次写入时重试; interval为0时每次put立即写入, 失败同样保留, 不抛出异常;
+'''
+
+
+class LRUCache:
+    def __init__(self, max_size=1024, ttl=60):
+        """
+        max_size: maximum number of entries, 0 disables the cache
+        ttl: seconds an entry stays valid
+        """
+        self._max_size = max_size
+        self._ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, max_size, ttl):
+        with self._lock:
+            self._max_size = max_size
+            self._ttl = ttl
+            self._items.clear()
+
+    @property
+    def enabled(self):
+        return self._max_size > 0
+
+    def get(self, key):
+        """
+        return cached value of key, None if missing or expired
+        """
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            expire, value = item
+            if expire < time.time():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._items[key] = (time.time() + self._ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self._max_size:
+                self._items.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+class InvalidationListener:
+    def __init__(self, channel, cache, convert=str):
+        """
+        channel: redis pub/sub channel carrying invalidated keys
+        convert: convert message data(str) to cache key
+        """
+        self._channel = channel
+        self._cache = cache
+        self._convert = convert
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def execute(self, pipe, key):
+        """
+        execute pipe together with an invalidation message of key
+        return the results of the commands queued in pipe
+        """
+        pipe.publish(self._channel, key)
+        ret = pipe.execute()
+        self._cache.pop(key)
+        return ret[:-1]
+
+    def ensure_running(self, client):
+        """
+        start the listener thread once per process, forked workers start their own
+        """
+        if self._pid == os.getpid() or not self._cache.enabled:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # fork之前的缓存内容可能已经过期, 子进程中清空
+            self._cache.clear()
+            self._pid = os.getpid()
+            thread = threading.Thread(target=self._listen, args=[client], name='cache-invalidation')
+            thread.daemon = True
+            thread.start()
+
+    def _listen(self, client):
+        while True:
+            try:
+                pubsub = client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self._channel)
+                # 订阅之前的消息已经丢失
+                self._cache.clear()
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self._cache.pop(self._convert(message['data'].decode('utf-8')))
+            except Exception as e:
+                print('cache invalidation listener of {0} error: {1}'.format(self._channel, e))
+                self._cache.clear()
+                time.sleep(1)
+
+
+class WriteBehindBuffer:
+    def __init__(self, flush, interval=5, throttle=60):
+        """
+        flush: function writing a dict key -> value in one batch
+        interval: seconds between two flushes, 0 writes every accepted value immediately
+        throttle: seconds a key is not written again after a write is accepted
+        """
+        self._flush = flush
+        self._interval = interval
+        self._throttle = throttle
+        self._pending = {}
+        self._accepted = {}
+        self._pid = None
+        self._lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def configure(self, interval, throttle):
+        self.flush()
+        with self._lock:
+            self._interval = interval
+            self._throttle = throttle
+            self._accepted.clear()
+
+    def put(self, key, value):
+        """
+        buffer value of key, return False if it is dropped by the throttle
+        """
+        if self._interval > 0:
+            self._ensure_running()
+        now = time.time()
+        with self._lock:
+            if now - self._accepted.get(key, 0) < self._throttle:
+                return False
+            self._accepted[key] = now
+            self._pending[key] = value
+            if self._interval > 0:
+                return True
+        # 立即写入, 同时重试之前失败的数据; 失败时保留到下一次写入
+        self.flush()
+        return True
+
+    def flush(self):
+        """
+        write all buffered values, return the number of keys written
+        """
+        now = time.time()
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._accepted = {key: accepted for key, accepted in self._accepted.items()
+                              if now - accepted < self._throttle}
+        if pending:
+            try:
+                self._flush(pending)
+            except Exception as e:
+                print('write behind flush of {0} keys error: {1}'.format(len(pending), e))
+                # 保留未写入的数据, 下次重试; 期间新的值优先
+                with self._lock:
+                    pending.update(self._pending)
+                    self._pending = pending
+                return 0
+        return len(pending)
+
+    def _ensure_running(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # fork之前父进程缓冲的数据由父进程写入
+            self._pending.clear()
+            self._pid = os.getpid()
+            thread = threading.Thread(target=self._run, name='write-behind')
+            thread.daemon = True
+            thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self._interval)
+            self.flush()
+
+    def __len__(self):
+        return len(self._pending)
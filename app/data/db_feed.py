@@ -0,0 +1,166 @@
+# !/usr/bin/python
+# coding=utf-8
+
+from .. import rd, rd_read
+from .backend import users, posts
+from .scripts import register_script
+
+'''
+关注的人的文章时间线, 推拉结合;
+1. 作者发件箱; 有序集合feed:outbox:author_id, 保存作者最近的文章ID, 分数为文章ID(文章ID递增, 即发表顺序);
+2. 用户时间线; 有序集合feed:timeline:user_id, 分数为文章ID, 保留最近timeline_size篇;
+    a. 发表文章时推送到所有关注者(包括作者自己)的时间线, 即写扩散;
+    b. 关注者数量达到阈值的作者加入集合feed:big_authors, 之后不再推送, 读取时间线时合并其发件箱, 即读扩散;
+       作者一旦加入不再移除, 否则其之前的文章不在任何时间线中;
+3. 集合feed:big_followed:user_id, 用户关注的大V作者; 关注, 取消关注时更新, 作者成为大V时加入其所有关注者的集合;
+   先加入feed:big_authors再读取关注者, 同时关注的用户在add_author中看到作者已经是大V, 不会遗漏;
+4. 分页使用游标, 游标是上一页最后一篇文章ID; 每页的redis操作数只与该用户关注的大V作者数量有关, 与关注人数和系统中的大V总数无关;
+5. 关注关系通过存储后端(backend.users)读取, 可以不在redis中;
+6. backfill 为功能上线之前的文章和关注关系生成发件箱, 大V集合和时间线, 可以重复执行;
+'''
+
+FEED_OUTBOX = 'feed:outbox:'
+FEED_TIMELINE = 'feed:timeline:'
+FEED_BIG_AUTHORS = 'feed:big_authors'
+FEED_BIG_FOLLOWED = 'feed:big_followed:'
+
+# KEYS: big authors, big followed of user, timeline of user, outbox of author; ARGV: author id, timeline size
+_add_author = register_script("""
+if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 1 then
+    redis.call('SADD', KEYS[2], ARGV[1])
+else
+    redis.call('ZUNIONSTORE', KEYS[3], 2, KEYS[3], KEYS[4], 'AGGREGATE', 'MAX')
+    redis.call('ZREMRANGEBYRANK', KEYS[3], 0, -tonumber(ARGV[2]) - 1)
+end
+""")
+
+# KEYS: big followed of user, outbox of author, timeline of user; ARGV: author id
+_remove_author = register_script("""
+redis.call('SREM', KEYS[1], ARGV[1])
+for _, post_id in ipairs(redis.call('ZRANGE', KEYS[2], 0, -1)) do
+    redis.call('ZREM', KEYS[3], post_id)
+end
+""")
+
+
+def _trim(pipe, key, size):
+    pipe.zremrangebyrank(key, 0, -size - 1)
+
+
+def push_post(post_id, author_id, fanout_threshold, timeline_size):
+    """
+    add a new post to the outbox of author and push it to the timelines of followers
+    """
+    outbox = FEED_OUTBOX + '{}'.format(author_id)
+    pipe = rd.pipeline(transaction=False)
+    pipe.zadd(outbox, post_id, post_id)
+    _trim(pipe, outbox, timeline_size)
+    pipe.sismember(FEED_BIG_AUTHORS, author_id)
+    _, _, is_big = pipe.execute()
+    if not is_big and users.followers_count(author_id) >= fanout_threshold:
+        _become_big(author_id)
+        is_big = True
+    # 作者自己的时间线总是推送
+    followers = [] if is_big else users.all_followers(author_id)
+    for user_id in [author_id] + followers:
+        timeline = FEED_TIMELINE + '{}'.format(user_id)
+        pipe.zadd(timeline, post_id, post_id)
+        _trim(pipe, timeline, timeline_size)
+    pipe.execute()
+
+
+def _become_big(author_id):
+    """
+    stop pushing posts of author_id, timelines of its followers read its outbox instead
+    """
+    rd.sadd(FEED_BIG_AUTHORS, author_id)
+    pipe = rd.pipeline(transaction=False)
+    for follower in users.all_followers(author_id):
+        pipe.sadd(FEED_BIG_FOLLOWED + '{}'.format(follower), author_id)
+        if len(pipe) >= 500:
+            pipe.execute()
+    pipe.execute()
+
+
+def remove_post(post_id, author_id):
+    """
+    remove a deleted post from the outbox of author, timelines skip it when loading
+    """
+    return rd.zrem(FEED_OUTBOX + '{}'.format(author_id), post_id)
+
+
+def add_author(user_id, author_id, timeline_size):
+    """
+    user_id starts following author_id, copy recent posts of author_id to the timeline of user_id,
+    or remember author_id in the big authors followed by user_id
+    """
+    _add_author(keys=[FEED_BIG_AUTHORS, FEED_BIG_FOLLOWED + '{}'.format(user_id), FEED_TIMELINE + '{}'.format(user_id),
+                      FEED_OUTBOX + '{}'.format(author_id)], args=[author_id, timeline_size])
+
+
+def remove_author(user_id, author_id):
+    """
+    user_id stops following author_id, remove posts of author_id from the timeline of user_id
+    """
+    _remove_author(keys=[FEED_BIG_FOLLOWED + '{}'.format(user_id), FEED_OUTBOX + '{}'.format(author_id),
+                         FEED_TIMELINE + '{}'.format(user_id)], args=[author_id])
+
+
+def timeline(user_id, cursor, count):
+    """
+    return (post ids, next cursor) of the timeline of user_id, newest first
+    cursor: None for the first page, posts older than cursor are returned
+    next cursor is None on the last page
+    """
+    max_score = '+inf' if cursor is None else '({}'.format(cursor)
+    pipe = rd_read.pipeline(transaction=False)
+    pipe.zrevrangebyscore(FEED_TIMELINE + '{}'.format(user_id), max_score, '-inf', start=0, num=count)
+    pipe.smembers(FEED_BIG_FOLLOWED + '{}'.format(user_id))
+    post_ids, followed = pipe.execute()
+    post_ids = set(int(post_id) for post_id in post_ids)
+    if followed:
+        for author_id in followed:
+            pipe.zrevrangebyscore(FEED_OUTBOX + '{}'.format(int(author_id)), max_score, '-inf', start=0, num=count)
+        for author_posts in pipe.execute():
+            post_ids.update(int(post_id) for post_id in author_posts)
+    post_ids = sorted(post_ids, reverse=True)[:count]
+    next_cursor = post_ids[-1] if len(post_ids) == count else None
+    return post_ids, next_cursor
+
+
+def backfill(fanout_threshold, timeline_size, batch_size=100):
+    """
+    build outboxes, big authors and timelines from the existing posts and follow relations
+    yield (phase, number of users done) after every batch of users
+    """
+    max_user_id = users.max_user_id()
+    for start in range(1, max_user_id + 1, batch_size):
+        user_ids = range(start, min(start + batch_size, max_user_id + 1))
+        pipe = rd.pipeline(transaction=False)
+        for author_id in user_ids:
+            post_ids, _ = posts.posts_by_author(author_id, 1, timeline_size)
+            if post_ids:
+                outbox = FEED_OUTBOX + '{}'.format(author_id)
+                pipe.zadd(outbox, *[value for post_id in post_ids for value in (post_id, int(post_id))])
+                _trim(pipe, outbox, timeline_size)
+            if users.followers_count(author_id) >= fanout_threshold:
+                pipe.sadd(FEED_BIG_AUTHORS, author_id)
+        pipe.execute()
+        yield 'outboxes', user_ids[-1]
+    big_authors = set(int(author_id) for author_id in rd.smembers(FEED_BIG_AUTHORS))
+    for start in range(1, max_user_id + 1, batch_size):
+        user_ids = range(start, min(start + batch_size, max_user_id + 1))
+        pipe = rd.pipeline(transaction=False)
+        for user_id in user_ids:
+            followings = users.all_followings(user_id)
+            timeline = FEED_TIMELINE + '{}'.format(user_id)
+            # 作者自己的文章总是在时间线中
+            sources = [timeline, FEED_OUTBOX + '{}'.format(user_id)]
+            sources += [FEED_OUTBOX + '{}'.format(author_id) for author_id in followings if author_id not in big_authors]
+            pipe.zunionstore(timeline, sources, aggregate='MAX')
+            _trim(pipe, timeline, timeline_size)
+            followed = [author_id for author_id in followings if author_id in big_authors]
+            if followed:
+                pipe.sadd(FEED_BIG_FOLLOWED + '{}'.format(user_id), *followed)
+        pipe.execute()
+        yield 'timelines', user_ids[-1]
@@ -0,0 +1,100 @@
+# !/usr/bin/python
+# coding=utf-8
+
+import json
+from .. import rd
+from .. import util
+from .scripts import register_script
+
+'''
+待发送邮件队列;
+1. mail:queue 列表, 待发送的邮件, 每封邮件是一个json字符串, LPUSH加入, 从右侧取出;
+2. mail:inflight 有序集合, 已取出正在发送的邮件, 分数为超时时间; worker崩溃时超时后重新加入队列;
+3. mail:retry 有序集合, 发送失败等待重试的邮件, 分数为下次重试时间;
+4. mail:failed 列表, 重试次数用完仍然失败的邮件;
+'''
+
+MAIL_QUEUE = 'mail:queue'
+MAIL_INFLIGHT = 'mail:inflight'
+MAIL_RETRY = 'mail:retry'
+MAIL_FAILED = 'mail:failed'
+
+# KEYS: queue inflight; ARGV: count deadline
+_take = register_script("""
+local messages = {}
+for i = 1, tonumber(ARGV[1]) do
+    local message = redis.call('RPOP', KEYS[1])
+    if not message then
+        break
+    end
+    redis.call('ZADD', KEYS[2], ARGV[2], message)
+    messages[#messages + 1] = message
+end
+return messages
+""")
+
+# KEYS: source zset, queue; ARGV: now
+_requeue_due = register_script("""
+local messages = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+for _, message in ipairs(messages) do
+    redis.call('ZREM', KEYS[1], message)
+    redis.call('LPUSH', KEYS[2], message)
+end
+return #messages
+""")
+
+
+def enqueue(message):
+    """
+    message: dict, must be json serializable
+    """
+    return rd.lpush(MAIL_QUEUE, json.dumps(message))
+
+
+def requeue_due(now):
+    """
+    move timed out in flight messages and retries that are due back to the queue
+    """
+    return _requeue_due(keys=[MAIL_INFLIGHT, MAIL_QUEUE], args=[now]) + \
+        _requeue_due(keys=[MAIL_RETRY, MAIL_QUEUE], args=[now])
+
+
+def take(count, deadline):
+    """
+    take at most count messages, they are requeued if not acked before deadline
+    return list of (raw message, message dict)
+    """
+    raws = util.convert(_take(keys=[MAIL_QUEUE, MAIL_INFLIGHT], args=[count, deadline]))
+    return [(raw, json.loads(raw)) for raw in raws]
+
+
+def ack(raw):
+    return rd.zrem(MAIL_INFLIGHT, raw)
+
+
+def retry(raw, message, when):
+    """
+    schedule message to be retried at when, message['attempts'] should have been updated
+    """
+    pipe = rd.pipeline()
+    pipe.zrem(MAIL_INFLIGHT, raw)
+    pipe.zadd(MAIL_RETRY, json.dumps(message), when)
+    pipe.execute()
+
+
+def fail(raw, message):
+    pipe = rd.pipeline()
+    pipe.zrem(MAIL_INFLIGHT, raw)
+    pipe.lpush(MAIL_FAILED, json.dumps(message))
+    pipe.execute()
+
+
+def next_due():
+    """
+    return the earliest time a retry or in flight message is due, None if there is none
+    """
+    pipe = rd.pipeline(transaction=False)
+    pipe.zrange(MAIL_RETRY, 0, 0, withscores=True)
+    pipe.zrange(MAIL_INFLIGHT, 0, 0, withscores=True)
+    due = [items[0][1] for items in pipe.execute() if items]
+    return min(due) if due else None
@@ -0,0 +1,105 @@
+# !/usr/bin/python
+# coding=utf-8
+
+from .. import rd, rd_read
+from .scripts import register_script
+
+'''
+匿名访问的整页缓存;
+1. page:path 字符串, 渲染好的页面, path包括查询参数, 带有过期时间;
+2. page:tag:tag 集合, 带有该标签的页面key; 修改数据时按标签删除受影响的页面;
+    a. index 首页的所有分页;
+    b. user:user_id 用户主页, 以及该用户的文章页面(作者信息会显示在文章中);
+    c. post:post_id 文章页面;
+3. page:lock:path 字符串, 页面未命中时只有拿到锁的请求渲染页面, 其他请求等待渲染结果;
+4. page:version:tag 字符串, 标签对应数据的版本号, 用于条件GET的ETag和Last-Modified;
+   版本号是修改时间的秒数, 同一秒内多次修改时加1, 保证严格递增; 带有过期时间, 过期后下一次读取时重新生成;
+'''
+
+PAGE = 'page:'
+PAGE_TAG = 'page:tag:'
+PAGE_LOCK = 'page:lock:'
+PAGE_VERSION = 'page:version:'
+
+# KEYS: tag sets
+_invalidate = register_script("""
+local count = 0
+for _, tag in ipairs(KEYS) do
+    for _, page in ipairs(redis.call('SMEMBERS', tag)) do
+        count = count + redis.call('DEL', page)
+    end
+    redis.call('DEL', tag)
+end
+return count
+""")
+
+# KEYS: version keys, ARGV: now, ttl
+_bump_versions = register_script("""
+for _, key in ipairs(KEYS) do
+    local version = math.max((tonumber(redis.call('GET', key)) or 0) + 1, tonumber(ARGV[1]))
+    redis.call('SET', key, version, 'EX', ARGV[2])
+end
+""")
+
+# KEYS: version keys, ARGV: now, ttl; missing versions are set to now
+_init_versions = register_script("""
+local versions = {}
+for i, key in ipairs(KEYS) do
+    redis.call('SET', key, ARGV[1], 'EX', ARGV[2], 'NX')
+    versions[i] = redis.call('GET', key)
+end
+return versions
+""")
+
+
+def get_page(path):
+    return rd.get(PAGE + path)
+
+
+def store_page(path, body, tags, ttl):
+    """
+    store rendered page of path, tags: list of tags invalidating the page
+    """
+    pipe = rd.pipeline(transaction=False)
+    pipe.setex(PAGE + path, body, ttl)
+    for tag in tags:
+        pipe.sadd(PAGE_TAG + tag, PAGE + path)
+        # 标签集合中的页面可能已经过期, 集合本身也需要过期
+        pipe.expire(PAGE_TAG + tag, ttl)
+    pipe.execute()
+
+
+def invalidate(tags):
+    """
+    delete the pages with any of tags, return the number of pages deleted
+    """
+    return _invalidate(keys=[PAGE_TAG + tag for tag in tags])
+
+
+def lock_page(path, timeout):
+    """
+    return True if the lock of path is acquired, it expires after timeout seconds
+    """
+    return bool(rd.set(PAGE_LOCK + path, 1, ex=timeout, nx=True))
+
+
+def unlock_page(path):
+    rd.delete(PAGE_LOCK + path)
+
+
+def bump_versions(tags, now, ttl):
+    """
+    advance the versions of tags to now, or by 1 if they are already at or past now
+    """
+    _bump_versions(keys=[PAGE_VERSION + tag for tag in tags], args=[int(now), ttl])
+
+
+def get_versions(tags, now, ttl):
+    """
+    return the versions of tags as a list of int, missing versions are created as now
+    """
+    keys = [PAGE_VERSION + tag for tag in tags]
+    versions = rd_read.mget(keys)
+    if None in versions:
+        versions = _init_versions(keys=keys, args=[int(now), ttl])
+    return [int(version) for version in versions]
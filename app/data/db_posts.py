@@ -1,106 +1,362 @@
 # !/usr/bin/python
 # coding=utf-8
 
+import calendar
 from datetime import datetime
-from .. import rd
+from .. import rd, rd_read
 from .. import util
+from .scripts import register_script
+from . import migrate
+from . import paging
+from . import shards
 
 '''
-1. 文章详细信息; 使用redis中的散列类型保存; key是'post:id'; 字段包括: title author time content category;
+1. 文章详细信息; 使用redis中的散列类型保存; key是'post:id'; 字段包括: title author time content category body;
+   body是用户输入的markdown原文, content是渲染并过滤之后的html; version是内容修改次数, 新文章没有该字段;
 2. 文章总数; 保存于posts:count中; 只增不减;
-3. 文章ID列表; 使用列表类型posts:list记录文章列表;
-    a. 新文章发布使用LPUSH将文章加入到列表中;
-    b. 删除文章 LREM
-    c. 文章分页显示 LRANGE
-4. 用户文章列表; 保存一个用户的所有文章; 用户名对应一个POST ID列表; posts:author
-4. 删除文章列表; 使用列表类型保存 posts:del:list
+3. 文章ID索引; 使用有序集合posts:by_time记录文章列表, 分数为发表时间;
+    a. 新文章发布使用ZADD将文章加入到索引中;
+    b. 删除文章 ZREM
+    c. 文章分页显示 按游标ZREVRANGEBYSCORE或者按页码ZREVRANGE, 深度分页和第一页代价相同
+4. 用户文章索引; 保存一个用户的所有文章; 有序集合posts:by_author:author_id, 分数为发表时间;
+5. 删除文章列表; 使用列表类型保存 posts:del_list; 删除文章时从索引中ZREM并加入该列表,
+   文章散列中标记deleted, 读取时跳过; 后台任务分批从列表中取出并删除文章散列post:id;
+   旧版本的posts:list迁移完成之前不回收, 否则不在posts:by_time中的旧文章都会被当作已删除;
+6. 旧版本使用列表posts:list和posts:author:author_id, 使用 manage.py migrate_post_index 在线迁移;
+   旧版本删除文章时没有从作者列表中删除, 迁移时跳过删除列表中的文章, 以及散列已经被回收的文章;
+7. 页面读取使用rd_read(配置了从库时读从库), 写入, 回收和迁移使用rd;
+8. 文章散列和作者文章索引通过shards访问, 配置REDIS_SHARDS后分别按文章ID和作者ID分布在各个节点上;
+   文章总数, 文章索引和删除列表在主库; 分片时发表, 删除和回收不使用脚本, 分步写入各个节点;
 '''
 
-# 文章列表
-POSTS_LIST = 'posts:list'
+# 文章索引
+POSTS_INDEX = 'posts:by_time'
 # 文章总数
 POSTS_COUNT = 'posts:count'
 # 文章删除列表
 POSTS_DEL_LIST = 'posts:del_list'
-# 每个作者文章列表
-POST_AUTHOR_LIST = 'posts:author:'
+# 每个作者文章索引
+POST_AUTHOR_INDEX = 'posts:by_author:'
 # post infomation
 POST_INFO = 'post:'
+# 旧版本的文章列表
+POSTS_LIST = 'posts:list'
+POST_AUTHOR_LIST = 'posts:author:'
 
 
-def publish_post(title, author_id, content, category):
+# KEYS: posts:count posts:by_time posts:by_author:author_id; ARGV: post key prefix, timestamp, field value ...
+_publish_post = register_script("""
+local post_id = redis.call('INCR', KEYS[1])
+local post_key = ARGV[1] .. post_id
+redis.call('HSET', post_key, 'post_id', post_id)
+for i = 3, #ARGV, 2 do
+    redis.call('HSET', post_key, ARGV[i], ARGV[i + 1])
+end
+redis.call('ZADD', KEYS[2], ARGV[2], post_id)
+redis.call('ZADD', KEYS[3], ARGV[2], post_id)
+return post_id
+""")
+
+
+def publish_post(title, author_id, content, category, body):
     """
     publish post
+    content: rendered html, body: markdown source
+    return post id
     """
+    now = datetime.utcnow()
+    score = calendar.timegm(now.utctimetuple()) + now.microsecond / 1e6
+    if not shards.enabled():
+        return _publish_post(keys=[POSTS_COUNT, POSTS_INDEX, POST_AUTHOR_INDEX + '{}'.format(author_id)],
+                             args=[POST_INFO, score, 'title', title, 'author_id', author_id, 'content', content,
+                                   'category', category, 'time', now, 'body', body])
+    # 先写入文章散列再加入索引, 读取索引时不会遇到不存在的文章
     post_id = rd.incr(POSTS_COUNT)
-    pipe = rd.pipeline()
-    pipe.multi()
-    rd.hmset(POST_INFO + '{}'.format(post_id), {'post_id': post_id, 'title': title, 'author_id': author_id,
-                                                'content': content, 'category': category, 'time': datetime.utcnow()})
-    rd.lpush(POSTS_LIST, post_id)
-    rd.lpush(POST_AUTHOR_LIST + '{}'.format(author_id), post_id)
+    pipe = shards.pipeline()
+    pipe.hmset(POST_INFO + '{}'.format(post_id), {'post_id': post_id, 'title': title, 'author_id': author_id,
+                                                   'content': content, 'category': category, 'time': now,
+                                                   'body': body})
+    pipe.zadd(POST_AUTHOR_INDEX + '{}'.format(author_id), post_id, score)
+    pipe.zadd(POSTS_INDEX, post_id, score)
     pipe.execute()
+    return post_id
+
+
+def _update_content(pipe, post_id, content, body):
+    # version随内容更新递增, 渲染好的文章片段缓存以文章ID和version为key
+    pipe.hmset(POST_INFO + '{}'.format(post_id), {'content': content, 'body': body})
+    pipe.hincrby(POST_INFO + '{}'.format(post_id), 'version', 1)
+
+
+def update_post_content(post_id, content, body):
+    """
+     update post content and bump its version
+     content: rendered html, body: markdown source
+    """
+    pipe = shards.pipeline(transaction=True)
+    _update_content(pipe, post_id, content, body)
+    return pipe.execute()[0]
 
 
-def update_post_content(post_id, content):
+def iter_post_sources(batch_size):
     """
-     update post content
+    yield lists of (post_id, body, content, version) of all posts,
+    body is None for posts published without markdown source
     """
-    return rd.hset(POST_INFO + '{}'.format(post_id), 'content', content)
+    last_id = int(rd.get(POSTS_COUNT) or 0)
+    for start in range(1, last_id + 1, batch_size):
+        post_ids = range(start, min(start + batch_size, last_id + 1))
+        pipe = shards.pipeline()
+        for post_id in post_ids:
+            pipe.hmget(POST_INFO + '{}'.format(post_id), 'body', 'content', 'version')
+        yield [(post_id, body, content, int(version or 0))
+               for post_id, (body, content, version) in zip(post_ids, util.convert(pipe.execute()))
+               if content is not None]
+
+
+# KEYS: post keys; ARGV: version content body of each post
+# 文章被删除, 回收或者读取之后被修改(version变化)时不写入, 返回写入的文章在KEYS中的序号
+_update_contents = register_script("""
+local updated = {}
+for i, key in ipairs(KEYS) do
+    local base = (i - 1) * 3
+    if redis.call('EXISTS', key) == 1 and redis.call('HEXISTS', key, 'deleted') == 0
+            and (redis.call('HGET', key, 'version') or '0') == ARGV[base + 1] then
+        redis.call('HMSET', key, 'content', ARGV[base + 2], 'body', ARGV[base + 3])
+        redis.call('HINCRBY', key, 'version', 1)
+        updated[#updated + 1] = i
+    end
+end
+return updated
+""")
+
+
+def update_post_contents(posts):
+    """
+    posts: list of (post_id, content, body, version), version is the one read with the source;
+    posts deleted or edited since then are skipped
+    return ids of the posts updated
+    """
+    # 一个脚本只能访问同一个节点上的key, 按节点分组, 每个节点一次往返
+    groups = {}
+    for post in posts:
+        groups.setdefault(shards.node(POST_INFO + '{}'.format(post[0])), []).append(post)
+    updated = []
+    for client, group in groups.items():
+        args = []
+        for post_id, content, body, version in group:
+            args.extend([version, content, body])
+        indexes = _update_contents(keys=[POST_INFO + '{}'.format(post[0]) for post in group], args=args,
+                                   client=client)
+        updated.extend(group[int(i) - 1][0] for i in indexes)
+    return updated
+
+
+# KEYS: posts:by_time posts:del_list; ARGV: post key prefix, author index prefix, post id
+_delete_post = register_script("""
+local author_id = redis.call('HGET', ARGV[1] .. ARGV[3], 'author_id')
+if not author_id or redis.call('ZREM', KEYS[1], ARGV[3]) == 0 then
+    return false
+end
+redis.call('ZREM', ARGV[2] .. author_id, ARGV[3])
+redis.call('HSET', ARGV[1] .. ARGV[3], 'deleted', 1)
+redis.call('LPUSH', KEYS[2], ARGV[3])
+return author_id
+""")
+
+# KEYS: posts:del_list posts:by_time posts:list; ARGV: post key prefix, count
+# posts:list还没有迁移时posts:by_time不完整, 不回收
+_purge_deleted = register_script("""
+if redis.call('TYPE', KEYS[3]).ok == 'list' then
+    return false
+end
+local purged = 0
+for i = 1, tonumber(ARGV[2]) do
+    local post_id = redis.call('RPOP', KEYS[1])
+    if not post_id then
+        break
+    end
+    if not redis.call('ZSCORE', KEYS[2], post_id) then
+        redis.call('DEL', ARGV[1] .. post_id)
+        purged = purged + 1
+    end
+end
+return purged
+""")
 
 
 def delete_post(post_id):
     """
-    delete post
+    delete post, the post infomation is reclaimed later by purge_deleted
+    return author id, None if the post does not exist
+    """
+    if not shards.enabled():
+        author_id = _delete_post(keys=[POSTS_INDEX, POSTS_DEL_LIST], args=[POST_INFO, POST_AUTHOR_INDEX, post_id])
+        return int(author_id) if author_id is not None else None
+    author_id = get_post_author(post_id)
+    # ZREM成功的请求负责删除, 并发删除同一篇文章时只有一个成功
+    if author_id is None or rd.zrem(POSTS_INDEX, post_id) == 0:
+        return None
+    pipe = shards.pipeline()
+    pipe.zrem(POST_AUTHOR_INDEX + '{}'.format(author_id), post_id)
+    pipe.hset(POST_INFO + '{}'.format(post_id), 'deleted', 1)
+    pipe.lpush(POSTS_DEL_LIST, post_id)
+    pipe.execute()
+    return author_id
+
+
+def purge_deleted(batch_size):
     """
+    reclaim the infomation of at most batch_size deleted posts
+    return the number of posts reclaimed, None if posts:list is not migrated yet
+    """
+    if not shards.enabled():
+        return _purge_deleted(keys=[POSTS_DEL_LIST, POSTS_INDEX, POSTS_LIST], args=[POST_INFO, batch_size])
+    # 迁移只会把posts:list变为空, 检查之后不会再变回列表
+    if util.convert(rd.type(POSTS_LIST)) == 'list':
+        return None
     pipe = rd.pipeline()
-    pipe.multi()
-    rd.lrem(POSTS_LIST, post_id, 0)
-    rd.lpush(POSTS_DEL_LIST, post_id)
+    pipe.lrange(POSTS_DEL_LIST, -batch_size, -1)
+    pipe.ltrim(POSTS_DEL_LIST, 0, -batch_size - 1)
+    post_ids = pipe.execute()[0]
+    if not post_ids:
+        return 0
+    pipe = rd.pipeline(transaction=False)
+    for post_id in post_ids:
+        pipe.zscore(POSTS_INDEX, post_id)
+    post_ids = [post_id for post_id, score in zip(post_ids, pipe.execute()) if score is None]
+    pipe = shards.pipeline()
+    for post_id in post_ids:
+        pipe.delete(POST_INFO + '{}'.format(util.convert(post_id)))
     pipe.execute()
+    return len(post_ids)
+
+
+def deleted_count():
+    """
+    return the number of deleted posts waiting to be reclaimed
+    """
+    return rd.llen(POSTS_DEL_LIST)
 
 
 def total_posts():
     """
     return total posts number
     """
-    return rd.llen(POSTS_LIST)
+    return rd_read.zcard(POSTS_INDEX)
 
 
 def total_posts_by_author(author_id):
     """
     return total posts number of author
     """
-    return rd.llen(POST_AUTHOR_LIST + '{}'.format(author_id))
+    key = POST_AUTHOR_INDEX + '{}'.format(author_id)
+    return shards.node(key, read=True).zcard(key)
 
 
-def posts_by_page(page_id, per_page):
+def posts_by_page(page_id, per_page, cursor=None):
     """
     paging display
-    page_id: start from 1
-    post ID list key is str type
+    page_id: start from 1, ignored if cursor is given
+    return (post ids, next cursor), latest first
     """
-    pages = int(rd.llen(POSTS_LIST) / per_page + 1)
-    if 0 < page_id <= pages:
-        return util.convert(rd.lrange(POSTS_LIST, (page_id - 1) * per_page, page_id * per_page - 1))
-    print('invaild param page id[{0}, {1}]'.format(1, pages))
+    posts, next_cursor = paging.zpage(POSTS_INDEX, page_id, per_page, cursor)
+    return [post_id for post_id, _ in posts], next_cursor
 
 
 def get_post(post_id):
     """
     get post infomation
-    return dict
+    return dict, None if the post is missing or deleted
+    """
+    key = POST_INFO + '{}'.format(post_id)
+    post_info = util.convert(shards.node(key, read=True).hgetall(key))
+    if len(post_info) != 0 and 'deleted' not in post_info:
+        return post_info
+
+
+def get_post_author(post_id):
+    """
+    return author id of post, None if the post is missing
+    """
+    key = POST_INFO + '{}'.format(post_id)
+    author_id = shards.node(key, read=True).hget(key, 'author_id')
+    return int(author_id) if author_id is not None else None
+
+
+def get_posts(post_ids):
+    """
+    get infomation of several posts in one pipelined round trip
+    return list of dict, in the order of post_ids, missing and deleted posts are skipped
     """
-    return util.convert(rd.hgetall(POST_INFO + '{}'.format(post_id)))
+    if not post_ids:
+        return []
+    pipe = shards.pipeline(read=True)
+    for post_id in post_ids:
+        pipe.hgetall(POST_INFO + '{}'.format(post_id))
+    return [post_info for post_info in util.convert(pipe.execute())
+            if len(post_info) != 0 and 'deleted' not in post_info]
 
 
-def posts_by_author(author_id, page_id, per_page):
+def posts_by_author(author_id, page_id, per_page, cursor=None):
     """
     paging display
     get posts list by author
+    return (post ids, next cursor), latest first
+    """
+    posts, next_cursor = paging.zpage(POST_AUTHOR_INDEX + '{}'.format(author_id), page_id, per_page, cursor)
+    return [post_id for post_id, _ in posts], next_cursor
+
+
+def _time_scores(members, positions):
+    # 散列已经被回收或者没有发表时间的文章返回None, 迁移时跳过
+    pipe = shards.pipeline()
+    for post_id in members:
+        pipe.hget(POST_INFO + '{}'.format(post_id), 'time')
+    scores = []
+    for post_time in util.convert(pipe.execute()):
+        if not post_time:
+            scores.append(None)
+            continue
+        post_time = datetime.strptime(post_time, '%Y-%m-%d %H:%M:%S.%f' if '.' in post_time else '%Y-%m-%d %H:%M:%S')
+        scores.append(calendar.timegm(post_time.utctimetuple()) + post_time.microsecond / 1e6)
+    return scores
+
+
+# KEYS: post keys; 已经回收的文章不重新创建散列
+_mark_deleted = register_script("""
+for i = 1, #KEYS do
+    if redis.call('EXISTS', KEYS[i]) == 1 then
+        redis.call('HSET', KEYS[i], 'deleted', 1)
+    end
+end
+""")
+
+
+def _mark_posts_deleted(post_ids, batch_size):
+    """
+    mark the existing posts of post_ids deleted, one script call per shard node and batch
+    """
+    groups = {}
+    for post_id in post_ids:
+        key = POST_INFO + '{}'.format(post_id)
+        groups.setdefault(shards.node(key), []).append(key)
+    for client, keys in groups.items():
+        for start in range(0, len(keys), batch_size):
+            _mark_deleted(keys=keys[start:start + batch_size], client=client)
+
+
+def migrate_post_lists(batch_size=500):
+    """
+    online migration of the post indexes from lists to sorted sets scored by publish time
+    yield (list key, number of posts moved) for every converted key
     """
-    pages = int(rd.llen(POST_AUTHOR_LIST + '{}'.format(author_id)) / per_page + 1)
-    if 0 < page_id <= pages:
-        return util.convert(rd.lrange(POST_AUTHOR_LIST + '{}'.format(author_id), (page_id - 1) * per_page,
-                                      page_id * per_page - 1))
-    print('posts_by_author invaild param author {0} page id[{1}, {2}]: {3}'.format(author_id, 1, pages, page_id))
+    # 旧版本删除文章只从posts:list中LREM, 作者列表中仍然有这些文章, 迁移时跳过并标记deleted;
+    # 已经回收(散列不存在)的文章不在删除列表中, 由_time_scores跳过
+    deleted = set(util.convert(rd.lrange(POSTS_DEL_LIST, 0, -1)))
+    _mark_posts_deleted(deleted, batch_size)
+    if util.convert(rd.type(POSTS_LIST)) == 'list':
+        yield POSTS_LIST, migrate.list_to_zset(POSTS_LIST, POSTS_INDEX, batch_size, _time_scores, deleted)
+    for list_key in migrate.scan_lists(POST_AUTHOR_LIST + '*', batch_size):
+        set_key = POST_AUTHOR_INDEX + list_key[len(POST_AUTHOR_LIST):]
+        yield list_key, migrate.list_to_zset(list_key, set_key, batch_size, _time_scores, deleted)
@@ -1,39 +1,131 @@
 # !/usr/bin/python
 # coding=utf-8
+import time
+import zlib
 from datetime import datetime
-from .. import rd
+from .. import rd, rd_read
+from .. import redis_pool
 from .. import util
+from .cache import LRUCache, InvalidationListener, WriteBehindBuffer
+from .scripts import register_script
+from . import migrate
+from . import paging
+from . import shards
 
 '''
 1. 用户详细信息; 使用redis中的散列类型保存, key是'user:id';
 2. 用户总数; 保存于users:count中;
-3. email.to.id 根据email查询到具体用户ID; 这里可以调整为
-4. name.to.id 根据用户名查询到具体用户ID
+3. email.to.id 根据email查询到具体用户ID; 按email的crc32拆分为LOOKUP_BUCKETS个散列email.to.id:桶号,
+   每个散列较小, 使用压缩编码并且可以分片; 拆分之前的email.to.id仍然可以读取, 使用 manage.py split_lookups 迁移;
+4. name.to.id 根据用户名查询到具体用户ID, 与email.to.id相同拆分为name.to.id:桶号
+5. 进程内缓存用户信息(LRU + TTL), 用户信息修改时通过频道user:invalidate通知所有进程删除缓存;
+   last_seen不触发失效, 缓存中的last_seen最多落后TTL秒
+6. last_seen延迟写入; 每个用户LAST_SEEN_THROTTLE秒内只记录一次, 每LAST_SEEN_FLUSH_INTERVAL秒批量写入redis
+7. 读取使用rd_read(配置了从库时读从库), 写入使用rd; 写入之后读主库的请求不使用进程内缓存
+8. 用户, 关注关系和查找表的key通过shards访问, 配置REDIS_SHARDS后按用户ID分布在各个节点上, 见shards;
 '''
 
+USER_INVALIDATE_CHANNEL = 'user:invalidate'
+EMAIL_LOOKUP = 'email.to.id'
+NAME_LOOKUP = 'name.to.id'
+# 查找表的桶数, 修改之后需要重新拆分
+LOOKUP_BUCKETS = 1024
+
+user_cache = LRUCache()
+_invalidation = InvalidationListener(USER_INVALIDATE_CHANNEL, user_cache, int)
+
+
+def _write_last_seen(last_seen):
+    pipe = shards.pipeline()
+    for user_id, utctime in last_seen.items():
+        pipe.hset('user:%d' % user_id, 'last_seen', utctime)
+    pipe.execute()
+
+
+last_seen_buffer = WriteBehindBuffer(_write_last_seen)
+
+
+def init_cache(app):
+    user_cache.configure(app.config.get('USER_CACHE_SIZE', 1024), app.config.get('USER_CACHE_TTL', 60))
+    last_seen_buffer.configure(app.config.get('LAST_SEEN_FLUSH_INTERVAL', 5), app.config.get('LAST_SEEN_THROTTLE', 60))
+
+
+def _bucket(lookup, value):
+    return '{0}:{1}'.format(lookup, zlib.crc32(value.encode('utf-8')) % LOOKUP_BUCKETS)
+
+
+def _lookup(lookup, value):
+    """
+    return user id of value in the lookup table, falls back to the table before splitting
+    """
+    bucket = _bucket(lookup, value)
+    user_id = shards.node(bucket, read=True).hget(bucket, value)
+    if user_id is None:
+        user_id = rd_read.hget(lookup, value)
+    return user_id
+
+
+# KEYS: name bucket, email bucket, users:count, name.to.id, email.to.id;
+# ARGV: name email user key prefix invalidate channel field value ...
+_reg_user = register_script("""
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 or redis.call('HEXISTS', KEYS[2], ARGV[2]) == 1 or
+   redis.call('HEXISTS', KEYS[4], ARGV[1]) == 1 or redis.call('HEXISTS', KEYS[5], ARGV[2]) == 1 then
+    return 0
+end
+local user_id = redis.call('INCR', KEYS[3])
+for i = 5, #ARGV, 2 do
+    redis.call('HSET', ARGV[3] .. user_id, ARGV[i], ARGV[i + 1])
+end
+redis.call('HSET', KEYS[1], ARGV[1], user_id)
+redis.call('HSET', KEYS[2], ARGV[2], user_id)
+redis.call('PUBLISH', ARGV[4], user_id)
+return user_id
+""")
+
 
 def reg_user(username, pwd, email, role_id):
     """
     add new user pwd: hash pwd
+    return user id, 0 if username or email has been registered
     """
+    now = datetime.utcnow()
+    fields = {'name': username, 'password': pwd, 'email': email, 'role_id': role_id, 'member_since': now,
+              'confirmed': 0, 'about_me': '', 'location': '', 'last_seen': now}
+    name_key, email_key = _bucket(NAME_LOOKUP, username), _bucket(EMAIL_LOOKUP, email)
+    if not shards.enabled():
+        args = [username, email, 'user:', USER_INVALIDATE_CHANNEL]
+        for field, value in fields.items():
+            args += [field, value]
+        return _reg_user(keys=[name_key, email_key, 'users:count', NAME_LOOKUP, EMAIL_LOOKUP], args=args)
+    # 分片时查找表和用户散列在不同的节点上; 先写入用户散列, 再用HSETNX占用用户名和email, 失败时撤销
+    if is_username_reg(username) or is_email_reg(email):
+        return 0
     user_id = rd.incr('users:count')
-    # 保存用户信息
-    pipe = rd.pipeline()
-    pipe.multi()
-    rd.hmset('user:%d' % user_id, {'name': username, 'password': pwd, 'email': email, 'role_id': role_id,
-                                   'member_since': datetime.utcnow(), 'confirmed': 0, 'about_me': '', 'location': '',
-                                   'last_seen': datetime.utcnow()})
-    rd.hset('email.to.id', email, user_id)
-    rd.hset('name.to.id', username, user_id)
-    pipe.execute()
+    user_key = 'user:{}'.format(user_id)
+    shards.node(user_key).hmset(user_key, fields)
+    if not shards.node(name_key).hsetnx(name_key, username, user_id):
+        shards.node(user_key).delete(user_key)
+        return 0
+    if not shards.node(email_key).hsetnx(email_key, email, user_id):
+        shards.node(name_key).hdel(name_key, username)
+        shards.node(user_key).delete(user_key)
+        return 0
+    rd.publish(USER_INVALIDATE_CHANNEL, user_id)
     return user_id
 
 
+def _cached(user_id):
+    # 写入之后读主库的请求不使用缓存, 缓存可能是从库复制之前的数据
+    if redis_pool.is_pinned():
+        return None
+    return user_cache.get(user_id)
+
+
 def get_user(email):
     """
     get user infomation by user email
     """
-    user_id = rd.hget('email.to.id', email)
+    user_id = _lookup(EMAIL_LOOKUP, email)
     if user_id is not None:
         return get_user_by_id(user_id.decode("utf-8"))
 
@@ -42,7 +134,7 @@ def get_user_by_name(name):
     """
     get user infomation by user name
     """
-    user_id = rd.hget('name.to.id', name)
+    user_id = _lookup(NAME_LOOKUP, name)
     if user_id is not None:
         return get_user_by_id(user_id.decode("utf-8"))
 
@@ -51,45 +143,94 @@ def get_user_by_id(user_id):
     """
     get user infomation by user id
     """
-    user_info = util.convert(rd.hgetall('user:{}'.format(user_id)))
-    if len(user_info) != 0:
+    _invalidation.ensure_running(rd)
+    user_info = _cached(int(user_id))
+    if user_info is None:
+        user_key = 'user:{}'.format(user_id)
+        user_info = util.convert(shards.node(user_key, read=True).hgetall(user_key))
+        if len(user_info) == 0:
+            return None
         user_info['user_id'] = int(user_id)
-        return user_info
+        user_cache.set(int(user_id), user_info)
+    return dict(user_info)
+
+
+def get_users_by_ids(user_ids):
+    """
+    get infomation of several users in one pipelined round trip
+    return dict user_id -> user infomation, missing users are skipped
+    """
+    _invalidation.ensure_running(rd)
+    users = {}
+    missing = []
+    for user_id in set(int(user_id) for user_id in user_ids):
+        user_info = _cached(user_id)
+        if user_info is not None:
+            users[user_id] = dict(user_info)
+        else:
+            missing.append(user_id)
+    if missing:
+        pipe = shards.pipeline(read=True)
+        for user_id in missing:
+            pipe.hgetall('user:{}'.format(user_id))
+        for user_id, user_info in zip(missing, util.convert(pipe.execute())):
+            if len(user_info) != 0:
+                user_info['user_id'] = user_id
+                user_cache.set(user_id, user_info)
+                users[user_id] = dict(user_info)
+    return users
 
 
 def change_password(user_id, pwd):
-    return rd.hset('user:%d' % user_id, 'password', pwd)
+    pipe = shards.pipeline(transaction=True)
+    pipe.hset('user:%d' % user_id, 'password', pwd)
+    return _invalidation.execute(pipe, user_id)[0]
 
 
 def is_email_reg(email):
-    return rd.hexists('email.to.id', email)
+    return _lookup(EMAIL_LOOKUP, email) is not None
 
 
 def is_username_reg(name):
-    return rd.hexists('name.to.id', name)
+    return _lookup(NAME_LOOKUP, name) is not None
 
 
 def confirm(user_id):
-    return rd.hset('user:%d' % user_id, 'confirmed', 1)
+    pipe = shards.pipeline(transaction=True)
+    pipe.hset('user:%d' % user_id, 'confirmed', 1)
+    return _invalidation.execute(pipe, user_id)[0]
 
 
 def update_last_seen(user_id, utctime):
-    return rd.hset('user:%d' % user_id, 'last_seen', utctime)
+    """
+    buffered, return False if dropped because last_seen of user_id was updated recently
+    """
+    return last_seen_buffer.put(user_id, utctime)
 
 
 def update_profile(user_id, username, location, about_me):
-    return rd.hmset('user:%d' % user_id, {'name': username, 'location': location, 'about_me': about_me})
+    pipe = shards.pipeline(transaction=True)
+    pipe.hmset('user:%d' % user_id, {'name': username, 'location': location, 'about_me': about_me})
+    return _invalidation.execute(pipe, user_id)[0]
 
 
 def update_admin_profile(user_id, user):
-    return rd.hmset('user:%d' % user_id, {'name': user.username, 'email': user.email, 'confirmed': user.confirmed,
-                                          'role_id': user.role_id, 'location': user.location, 'about_me': user.about_me})
+    pipe = shards.pipeline(transaction=True)
+    pipe.hmset('user:%d' % user_id, {'name': user.username, 'email': user.email, 'confirmed': user.confirmed,
+                                     'role_id': user.role_id, 'location': user.location, 'about_me': user.about_me})
+    return _invalidation.execute(pipe, user_id)[0]
 
 """
-1. 用户关注者使用列表类型保存， 键值为：user:follower:user_id
-2. 用户关注的人列表，同样也是用列表类型保存， 键值为：user:following:user_id
+1. 用户关注者使用有序集合保存， 键值为：user:followers:user_id, 成员为关注者ID, 分数为关注时间;
+2. 用户关注的人，同样也是用有序集合保存， 键值为：user:followings:user_id, 成员为被关注者ID, 分数为关注时间;
+3. 是否关注 ZSCORE O(1); 关注/取消关注 ZADD/ZREM O(log N); 分页 ZREVRANGE 按关注时间倒序;
+4. 旧版本使用列表 user:follower:user_id 和 user:following:user_id 保存, 使用 manage.py migrate_follows 在线迁移;
+   迁移完成之前取消关注时同时从旧列表中删除, 防止迁移时重新加入
 """
 
+USER_FOLLOWER_SET = 'user:followers:'
+USER_FOLLOWING_SET = 'user:followings:'
+# 旧版本的关注列表
 USER_FOLLOWER_LIST = 'user:follower:'
 USER_FOLLOWING_LIST = 'user:following:'
 
@@ -98,10 +239,10 @@ def follow(user_id, follower):
     """
      user_id following follower
     """
-    pipe = rd.pipeline()
-    pipe.multi()
-    rd.lpush(USER_FOLLOWING_LIST + '{}'.format(user_id), follower)
-    rd.lpush(USER_FOLLOWER_LIST + '{}'.format(follower), user_id)
+    now = time.time()
+    pipe = shards.pipeline(transaction=True)
+    pipe.zadd(USER_FOLLOWING_SET + '{}'.format(user_id), follower, now)
+    pipe.zadd(USER_FOLLOWER_SET + '{}'.format(follower), user_id, now)
     pipe.execute()
 
 
@@ -109,70 +250,140 @@ def unfollow(user_id, follower):
     """
      user_id cancel follow followers
     """
-    pipe = rd.pipeline()
-    pipe.multi()
-    rd.lrem(USER_FOLLOWING_LIST + '{}'.format(user_id), follower)
-    rd.lrem(USER_FOLLOWER_LIST + '{}'.format(follower), user_id)
+    pipe = shards.pipeline(transaction=True)
+    pipe.zrem(USER_FOLLOWING_SET + '{}'.format(user_id), follower)
+    pipe.zrem(USER_FOLLOWER_SET + '{}'.format(follower), user_id)
+    pipe.lrem(USER_FOLLOWING_LIST + '{}'.format(user_id), follower)
+    pipe.lrem(USER_FOLLOWER_LIST + '{}'.format(follower), user_id)
     pipe.execute()
 
 
 def is_followed(user_id, follower):
     """
      whether user_id has followed followers
-     效率可能较低但暂未想到好的方法
     """
-    followings = rd.lrange(USER_FOLLOWING_LIST + '{}'.format(user_id), 1, -1)
-    if '{}'.format(follower).encode() in followings:
-        return True
-    else:
-        return False
+    key = USER_FOLLOWING_SET + '{}'.format(user_id)
+    return shards.node(key, read=True).zscore(key, follower) is not None
 
 
 def is_followed_by(user_id, follower):
     """
      whether user_is has been followed by follower
     """
-    followers = rd.lrange(USER_FOLLOWER_LIST + '{}'.format(user_id), 1, -1)
-    if '{}'.format(follower).encode() in followers:
-        return True
-    else:
-        return False
+    key = USER_FOLLOWER_SET + '{}'.format(user_id)
+    return shards.node(key, read=True).zscore(key, follower) is not None
 
 
-def followers_by_page(user_id, page_id, per_page):
+def followers_by_page(user_id, page_id, per_page, cursor=None):
     """
     paging display
     get followers list by user_id
+    return (list of (user_id, follow timestamp), next cursor), latest first
     """
-    count = int(rd.llen(USER_FOLLOWER_LIST + '{}'.format(user_id)) / per_page + 1)
-    if 0 < page_id <= count:
-        return util.convert(rd.lrange(USER_FOLLOWER_LIST + '{}'.format(user_id), (page_id - 1) * per_page,
-                                      page_id * per_page - 1))
-    print('followers_by_page invaild param user_id {0} page id[{1}, {2}]: {3}'.format(user_id, 1, count, page_id))
+    follows, next_cursor = paging.zpage(USER_FOLLOWER_SET + '{}'.format(user_id), page_id, per_page, cursor)
+    return [(int(follower), score) for follower, score in follows], next_cursor
 
 
-def following_by_page(user_id, page_id, per_page):
+def following_by_page(user_id, page_id, per_page, cursor=None):
     """
     paging display
     get has been following user list by user_id
+    return (list of (user_id, follow timestamp), next cursor), latest first
     """
-    pages = int(rd.llen(USER_FOLLOWING_LIST + '{}'.format(user_id)) / per_page + 1)
-    if 0 < page_id <= pages:
-        return util.convert(rd.lrange(USER_FOLLOWING_LIST + '{}'.format(user_id), (page_id - 1) * per_page,
-                                      page_id * per_page - 1))
-    print('following_by_page invaild param user_id {0} page id[{1}, {2}]: {3}'.format(user_id, 1, pages, page_id))
+    follows, next_cursor = paging.zpage(USER_FOLLOWING_SET + '{}'.format(user_id), page_id, per_page, cursor)
+    return [(int(following), score) for following, score in follows], next_cursor
 
 
 def followers_count(user_id):
     """
      get user the total of followers
     """
-    return rd.llen(USER_FOLLOWER_LIST + '{}'.format(user_id))
+    key = USER_FOLLOWER_SET + '{}'.format(user_id)
+    return shards.node(key, read=True).zcard(key)
 
 
 def following_count(user_id):
     """
      get the count of user has followed
     """
-    return rd.llen(USER_FOLLOWING_LIST + '{}'.format(user_id))
+    key = USER_FOLLOWING_SET + '{}'.format(user_id)
+    return shards.node(key, read=True).zcard(key)
+
+
+def all_followers(user_id):
+    """
+    return ids of all followers of user_id
+    """
+    key = USER_FOLLOWER_SET + '{}'.format(user_id)
+    return [int(follower) for follower in shards.node(key, read=True).zrange(key, 0, -1)]
+
+
+def all_followings(user_id):
+    """
+    return ids of all users followed by user_id
+    """
+    key = USER_FOLLOWING_SET + '{}'.format(user_id)
+    return [int(followed) for followed in shards.node(key, read=True).zrange(key, 0, -1)]
+
+
+def max_user_id():
+    """
+    return the largest user id ever assigned, ids start from 1
+    """
+    return int(rd.get('users:count') or 0)
+
+
+def followed_among(user_id, author_ids):
+    """
+    return the set of author_ids followed by user_id, checked in one pipelined round trip
+    """
+    if not author_ids:
+        return set()
+    pipe = shards.pipeline(read=True)
+    for author_id in author_ids:
+        pipe.zscore(USER_FOLLOWING_SET + '{}'.format(user_id), author_id)
+    return set(int(author_id) for author_id, score in zip(author_ids, pipe.execute()) if score is not None)
+
+
+def _move_lookups(lookup, entries):
+    pipe = shards.pipeline()
+    for value, user_id in entries:
+        # 迁移开始之后注册的用户已经在桶中
+        pipe.hsetnx(_bucket(lookup, value), value, user_id)
+    pipe.execute()
+    rd.hdel(lookup, *[value for value, _ in entries])
+
+
+def split_lookups(batch_size=500):
+    """
+    online migration of email.to.id and name.to.id into LOOKUP_BUCKETS buckets
+    yield (lookup, number of entries moved) for every batch
+    """
+    for lookup in (EMAIL_LOOKUP, NAME_LOOKUP):
+        entries = []
+        for value, user_id in rd.hscan_iter(lookup, count=batch_size):
+            entries.append((util.convert(value), user_id))
+            if len(entries) >= batch_size:
+                _move_lookups(lookup, entries)
+                yield lookup, len(entries)
+                entries = []
+        if entries:
+            _move_lookups(lookup, entries)
+            yield lookup, len(entries)
+
+
+def migrate_follow_lists(batch_size=500):
+    """
+    online migration of the follow graph from lists to sorted sets
+    yield (list key, number of members moved) for every converted key
+    """
+    base_score = time.time()
+
+    def scores(members, positions):
+        # 旧列表中没有关注时间, LPUSH的顺序决定先后
+        return [base_score - position for position in positions]
 
+    for list_prefix, set_prefix in ((USER_FOLLOWING_LIST, USER_FOLLOWING_SET), (USER_FOLLOWER_LIST, USER_FOLLOWER_SET)):
+        for list_key in migrate.scan_lists(list_prefix + '*', batch_size):
+            set_key = set_prefix + list_key[len(list_prefix):]
+            yield list_key, migrate.list_to_zset(list_key, set_key, batch_size, scores)
@@ -0,0 +1,58 @@
+# !/usr/bin/python
+# coding=utf-8
+
+from redis import WatchError
+from .. import rd
+from .. import util
+
+'''
+在线将列表类型的ID列表迁移到有序集合;
+1. 每批从列表尾部(最早LPUSH的成员)取出, 在同一个事务中ZADD NX到有序集合并LTRIM删除, 迁移可以中断后重新执行;
+2. WATCH列表, 迁移期间列表被修改(例如LREM)时重试该批;
+3. 有序集合中已经存在的成员(迁移开始后新写入的)保留原来的分数;
+4. skip中的成员和分数为None的成员(例如旧版本已经删除或回收的文章)只从列表中删除, 不加入有序集合,
+   之前的迁移已经加入的从有序集合中删除;
+'''
+
+
+def list_to_zset(list_key, set_key, batch_size, scores, skip=frozenset()):
+    """
+    scores: function(members, positions) return scores of members, positions are indexes from the list head,
+        None for a member to skip
+    skip: members removed from the list without being added to the sorted set
+    return the number of members moved
+    """
+    moved = 0
+    with rd.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(list_key)
+                length = pipe.llen(list_key)
+                if length == 0:
+                    return moved
+                members = util.convert(pipe.lrange(list_key, -batch_size, -1))
+                member_scores = scores(members, range(length - len(members), length))
+                pipe.multi()
+                skipped = []
+                for member, score in zip(members, member_scores):
+                    if member in skip or score is None:
+                        skipped.append(member)
+                    else:
+                        pipe.execute_command('ZADD', set_key, 'NX', score, member)
+                if skipped:
+                    pipe.zrem(set_key, *skipped)
+                pipe.ltrim(list_key, 0, -len(members) - 1)
+                pipe.execute()
+                moved += len(members)
+            except WatchError:
+                continue
+
+
+def scan_lists(pattern, batch_size):
+    """
+    yield keys of list type matching pattern
+    """
+    for key in rd.scan_iter(match=pattern, count=batch_size):
+        key = util.convert(key)
+        if util.convert(rd.type(key)) == 'list':
+            yield key
@@ -0,0 +1,45 @@
+# !/usr/bin/python
+# coding=utf-8
+
+from .. import util
+from . import shards
+
+'''
+有序集合分页, 从分数最大的成员开始;
+1. 游标; 上一页最后一个成员的(分数, 成员)编码成不透明的字符串, 下一页从游标之后开始(ZREVRANGEBYSCORE),
+   与页数无关, 只需O(log N + M);
+2. 没有游标时按页码取(ZREVRANGE), 有序集合按排名查找同样是O(log N + M);
+3. 分数相同的成员按字典序倒序排列, 游标之后多取TIE_SLACK个成员, 跳过已经显示过的同分数成员;
+'''
+
+TIE_SLACK = 16
+
+
+def zpage(key, page_id, per_page, cursor=None):
+    """
+    return (list of (member, score), next cursor), next cursor is None on the last page
+    page_id: start from 1, ignored if cursor is valid
+    """
+    client = shards.node(key, read=True)
+    position = util.decode_cursor(cursor)
+    if position is not None:
+        max_score, last_member = position
+        items = []
+        start = 0
+        while True:
+            batch = util.convert(client.zrevrangebyscore(key, repr(max_score), '-inf', start=start,
+                                                         num=per_page + TIE_SLACK, withscores=True))
+            items += [(member, score) for member, score in batch if score != max_score or member < last_member]
+            # 同分数的成员超过TIE_SLACK个时继续取
+            if len(items) >= per_page or len(batch) < per_page + TIE_SLACK:
+                break
+            start += len(batch)
+        items = items[:per_page]
+    elif page_id >= 1:
+        items = util.convert(client.zrevrange(key, (page_id - 1) * per_page, page_id * per_page - 1, withscores=True))
+    else:
+        items = []
+    next_cursor = None
+    if len(items) == per_page:
+        next_cursor = util.encode_cursor(items[-1][1], items[-1][0])
+    return items, next_cursor
@@ -0,0 +1,23 @@
+# !/usr/bin/python
+# coding=utf-8
+
+import hashlib
+import redis.client
+from .. import rd
+
+'''
+lua脚本; 需要先分配ID再使用ID的写操作(INCR之后HMSET, LPUSH)无法放在MULTI/EXEC中, 使用脚本保证原子性并且只需一次往返;
+脚本的sha1在本地计算, 直接使用EVALSHA, 执行时才访问当前进程的客户端; redis中没有该脚本时(例如重启之后)自动SCRIPT LOAD一次
+'''
+
+
+class Script(redis.client.Script):
+    def __init__(self, registered_client, script):
+        # 不访问客户端, 模块可以在create_app之前导入
+        self.registered_client = registered_client
+        self.script = script
+        self.sha = hashlib.sha1(script.encode('utf-8')).hexdigest()
+
+
+def register_script(lua):
+    return Script(rd, lua)
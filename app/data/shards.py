@@ -0,0 +1,250 @@
+# !/usr/bin/python
+# coding=utf-8
+
+import bisect
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from .. import rd, rd_read
+from .. import redis_pool
+from .. import util
+
+'''
+用户和文章数据的客户端分片;
+1. REDIS_SHARDS列出分片节点 host:port,host:port; 未配置时所有数据都在主库(rd), 与分片之前相同;
+2. 只有SHARDED_PREFIXES开头的key分片: 用户, 文章, 作者文章索引, 关注关系, 拆分后的email/name查找表;
+   计数器, 全局文章索引, 删除列表, 时间线, 页面缓存和邮件队列仍然在主库;
+3. 一致性哈希; 每个节点在环上有SHARD_VNODES个虚拟节点, 增加一个节点时只有约1/N的key需要移动;
+4. hash tag; key中有{tag}时按tag分片, 否则按key末尾的ID分片, 同一个ID的key在同一个节点上:
+   user:5 user:followers:5 user:followings:5 posts:by_author:5 在同一个节点; post:5 按文章ID分片;
+5. pipeline() 把命令按节点分组, 每个节点一个管道, 依次执行后按命令顺序返回结果;
+   每个节点上的命令可以是一个事务, 跨节点的写入不是原子的;
+6. reshard 在节点变化后把不属于所在节点的key按批复制(DUMP/RESTORE管道)到新的节点, cleanup删除原节点上的key;
+'''
+
+SHARDED_PREFIXES = ('user:', 'post:', 'posts:by_author:', 'email.to.id:', 'name.to.id:')
+# 不带key的命令, 在主库执行
+_PRIMARY_COMMANDS = ('publish',)
+_ID_RE = re.compile(r':(\d+)$')
+
+
+def _hash(value):
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:8], 16)
+
+
+def hash_tag(key):
+    """
+    return the part of key deciding its node: {tag}, else the trailing id, else the whole key
+    """
+    start = key.find('{')
+    if start != -1:
+        end = key.find('}', start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    match = _ID_RE.search(key)
+    if match is not None:
+        return match.group(1)
+    return key
+
+
+def is_sharded(key):
+    return key.startswith(SHARDED_PREFIXES)
+
+
+class HashRing:
+    def __init__(self, nodes, vnodes=160):
+        """
+        nodes: node names, vnodes: points of every node on the ring
+        """
+        ring = sorted((_hash('{0}#{1}'.format(node, i)), node) for node in nodes for i in range(vnodes))
+        self._hashes = [point for point, _ in ring]
+        self._nodes = [node for _, node in ring]
+
+    def get_node(self, key):
+        """
+        return the node name holding key
+        """
+        index = bisect.bisect(self._hashes, _hash(hash_tag(key)))
+        return self._nodes[index % len(self._nodes)]
+
+
+class _Shards:
+    def __init__(self, addresses, vnodes, config):
+        self.pid = os.getpid()
+        self.clients = OrderedDict(('{0}:{1}'.format(*address), _create_client(config, address))
+                                   for address in addresses)
+        self.ring = HashRing(list(self.clients), vnodes)
+
+
+_config = None
+_shards = None
+_lock = threading.Lock()
+
+
+def _create_client(config, address):
+    return redis_pool.InstrumentedRedis(connection_pool=redis_pool.create_pool(config, address))
+
+
+def init_app(app):
+    global _config, _shards
+    with _lock:
+        _config = app.config
+        _shards = None
+
+
+def _get_shards():
+    """
+    return shards of this process, None if REDIS_SHARDS is not configured
+    """
+    global _shards
+    shards = _shards
+    if shards is None or shards.pid != os.getpid():
+        if _config is None or not _config.get('REDIS_SHARDS'):
+            return None
+        with _lock:
+            if _shards is None or _shards.pid != os.getpid():
+                _shards = _Shards(redis_pool.parse_addresses(_config['REDIS_SHARDS']),
+                                  _config.get('SHARD_VNODES', 160), _config)
+            shards = _shards
+    return shards
+
+
+def enabled():
+    return _get_shards() is not None
+
+
+def node(key, read=False):
+    """
+    client of the node holding key, the primary for keys which are not sharded
+    read: reads of unsharded keys may go to a replica
+    """
+    shards = _get_shards()
+    if shards is None or not is_sharded(key):
+        return rd_read if read else rd
+    return shards.clients[shards.ring.get_node(key)]
+
+
+def nodes():
+    """
+    return clients of all nodes holding sharded keys
+    """
+    shards = _get_shards()
+    if shards is None:
+        return [rd]
+    return list(shards.clients.values())
+
+
+class ShardedPipeline:
+    def __init__(self, shards, transaction, read):
+        self._shards = shards
+        self._transaction = transaction
+        self._read = read
+        self._commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self._commands.append((name, args, kwargs))
+            return self
+        return queue
+
+    def __len__(self):
+        return len(self._commands)
+
+    def _node_name(self, name, args):
+        if name in _PRIMARY_COMMANDS or not is_sharded(util.convert(args[0])):
+            return None
+        return self._shards.ring.get_node(util.convert(args[0]))
+
+    def execute(self, raise_on_error=True):
+        commands, self._commands = self._commands, []
+        groups = OrderedDict()
+        for index, (name, args, _) in enumerate(commands):
+            groups.setdefault(self._node_name(name, args), []).append(index)
+        results = [None] * len(commands)
+        for node_name, indexes in groups.items():
+            if node_name is None:
+                client = rd_read if self._read else rd
+            else:
+                client = self._shards.clients[node_name]
+            pipe = client.pipeline(self._transaction)
+            for index in indexes:
+                name, args, kwargs = commands[index]
+                getattr(pipe, name)(*args, **kwargs)
+            for index, result in zip(indexes, pipe.execute(raise_on_error)):
+                results[index] = result
+        return results
+
+
+def pipeline(transaction=False, read=False):
+    """
+    pipeline sending every command to the node holding its key, one round trip per node
+    without shards it is a pipeline of the primary (or rd_read when read)
+    """
+    shards = _get_shards()
+    if shards is None:
+        return (rd_read if read else rd).pipeline(transaction)
+    return ShardedPipeline(shards, transaction, read)
+
+
+def _scan_sharded(client, batch_size):
+    """
+    yield batches of the sharded keys on client
+    """
+    batch = []
+    for prefix in SHARDED_PREFIXES:
+        for key in client.scan_iter(match=prefix + '*', count=batch_size):
+            key = util.convert(key)
+            batch.append(key)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def reshard(addresses, sources, batch_size, cleanup=False):
+    """
+    copy every sharded key to its node on the ring of addresses, sources are extra nodes to read from
+    (for example removed nodes, or the primary when sharding is enabled for the first time)
+    cleanup: delete keys from the nodes they do not belong to instead, run it after the new nodes are in use
+    yield (source, target, number of keys) of every batch
+    """
+    targets = OrderedDict(('{0}:{1}'.format(*address), _create_client(_config, address)) for address in addresses)
+    ring = HashRing(list(targets), _config.get('SHARD_VNODES', 160))
+    source_clients = OrderedDict(targets)
+    for address in sources:
+        name = '{0}:{1}'.format(*address)
+        if name not in source_clients:
+            source_clients[name] = _create_client(_config, address)
+    for source, client in source_clients.items():
+        for keys in _scan_sharded(client, batch_size):
+            moves = OrderedDict()
+            for key in keys:
+                target = ring.get_node(key)
+                if target != source:
+                    moves.setdefault(target, []).append(key)
+            for target, target_keys in moves.items():
+                pipe = client.pipeline(transaction=False)
+                if cleanup:
+                    for key in target_keys:
+                        pipe.delete(key)
+                    pipe.execute()
+                    yield source, target, len(target_keys)
+                    continue
+                for key in target_keys:
+                    pipe.pttl(key)
+                    pipe.dump(key)
+                dumps = pipe.execute()
+                pipe = targets[target].pipeline(transaction=False)
+                copied = 0
+                for key, ttl, data in zip(target_keys, dumps[0::2], dumps[1::2]):
+                    # 扫描之后被删除的key
+                    if data is None:
+                        continue
+                    # 没有过期时间时PTTL为None(redis-py 2.x)或-1; redis-py 2.x的restore()不支持REPLACE
+                    pipe.execute_command('RESTORE', key, ttl if ttl and ttl > 0 else 0, data, 'REPLACE')
+                    copied += 1
+                pipe.execute()
+                yield source, target, copied
@@ -0,0 +1,212 @@
+# !/usr/bin/python
+# coding=utf-8
+
+import calendar
+from datetime import datetime
+from .. import util
+from . import sql
+
+'''
+文章的关系数据库实现, 参数和返回值与db_posts相同;
+1. 文章表blog_posts; ts是发表时间戳, 分页按(ts, id)倒序; 索引(deleted, ts, id)和(author_id, deleted, ts, id);
+2. 删除文章只标记deleted, 读取和计数时跳过; 后台任务分批删除已标记的行;
+3. 批量读取使用一条IN查询, 批量更新使用executemany;
+'''
+
+_POST_COLUMNS = ('id', 'title', 'author_id', 'content', 'category', 'time', 'body', 'version')
+_SELECT_POST = 'SELECT {} FROM blog_posts'.format(', '.join(_POST_COLUMNS))
+
+
+def _post_info(row):
+    # 与redis散列相同, 所有字段都是字符串; 没有markdown原文的旧文章没有body
+    post_info = {column: str(value) for column, value in zip(_POST_COLUMNS[1:], row[1:]) if value is not None}
+    post_info['post_id'] = str(row[0])
+    return post_info
+
+
+def publish_post(title, author_id, content, category, body):
+    """
+    publish post
+    content: rendered html, body: markdown source
+    return post id
+    """
+    now = datetime.utcnow()
+    with sql.cursor() as cur:
+        return cur.execute('INSERT INTO blog_posts (author_id, title, content, body, category, time, ts) '
+                           'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           (author_id, title, content, body, category, str(now),
+                            calendar.timegm(now.utctimetuple()) + now.microsecond / 1e6)).lastrowid
+
+
+_UPDATE_CONTENT = 'UPDATE blog_posts SET content = ?, body = ?, version = version + 1 WHERE id = ?'
+
+
+def update_post_content(post_id, content, body):
+    """
+     update post content and bump its version
+     content: rendered html, body: markdown source
+    """
+    with sql.cursor() as cur:
+        return cur.execute(_UPDATE_CONTENT, (content, body, post_id)).rowcount == 1
+
+
+def iter_post_sources(batch_size):
+    """
+    yield lists of (post_id, body, content, version) of all posts,
+    body is None for posts published without markdown source
+    """
+    last_id = 0
+    while True:
+        with sql.cursor() as cur:
+            rows = cur.execute('SELECT id, body, content, version FROM blog_posts WHERE id > ? ORDER BY id LIMIT ?',
+                               (last_id, batch_size)).fetchall()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        yield [(int(post_id), body, content, int(version)) for post_id, body, content, version in rows]
+
+
+def update_post_contents(posts):
+    """
+    posts: list of (post_id, content, body, version), version is the one read with the source;
+    posts deleted or edited since then are skipped
+    return ids of the posts updated, written in one transaction
+    """
+    updated = []
+    with sql.cursor() as cur:
+        for post_id, content, body, version in posts:
+            if cur.execute(_UPDATE_CONTENT + ' AND version = ? AND deleted = 0',
+                           (content, body, post_id, version)).rowcount == 1:
+                updated.append(post_id)
+    return updated
+
+
+def delete_post(post_id):
+    """
+    mark post deleted, the row is reclaimed later by purge_deleted
+    return author id, None if the post does not exist
+    """
+    with sql.cursor() as cur:
+        row = cur.execute('SELECT author_id FROM blog_posts WHERE id = ? AND deleted = 0', (post_id,)).fetchone()
+        if row is None or cur.execute('UPDATE blog_posts SET deleted = 1 WHERE id = ? AND deleted = 0',
+                                      (post_id,)).rowcount == 0:
+            return None
+    return int(row[0])
+
+
+def purge_deleted(batch_size):
+    """
+    reclaim at most batch_size deleted posts
+    return the number of posts reclaimed
+    """
+    with sql.cursor() as cur:
+        post_ids = [row[0] for row in cur.execute('SELECT id FROM blog_posts WHERE deleted = 1 LIMIT ?',
+                                                  (batch_size,)).fetchall()]
+        if not post_ids:
+            return 0
+        return cur.execute('DELETE FROM blog_posts WHERE id IN ({})'.format(sql.in_clause(post_ids)),
+                           post_ids).rowcount
+
+
+def deleted_count():
+    """
+    return the number of deleted posts waiting to be reclaimed
+    """
+    with sql.cursor() as cur:
+        return cur.execute('SELECT COUNT(*) FROM blog_posts WHERE deleted = 1').fetchone()[0]
+
+
+def total_posts():
+    """
+    return total posts number
+    """
+    with sql.cursor() as cur:
+        return cur.execute('SELECT COUNT(*) FROM blog_posts WHERE deleted = 0').fetchone()[0]
+
+
+def total_posts_by_author(author_id):
+    """
+    return total posts number of author
+    """
+    with sql.cursor() as cur:
+        return cur.execute('SELECT COUNT(*) FROM blog_posts WHERE author_id = ? AND deleted = 0',
+                           (author_id,)).fetchone()[0]
+
+
+def _page(where, params, page_id, per_page, cursor):
+    """
+    page of post ids matching where, latest first, keyset paging on (ts, id) when cursor is given
+    """
+    position = util.decode_cursor(cursor)
+    statement = 'SELECT id, ts FROM blog_posts WHERE deleted = 0' + where
+    params = list(params)
+    if position is not None:
+        max_score, last_member = position
+        statement += ' AND (ts < ? OR (ts = ? AND id < ?))'
+        params += [max_score, max_score, int(last_member)]
+    elif page_id < 1:
+        return [], None
+    statement += ' ORDER BY ts DESC, id DESC LIMIT ?'
+    params.append(per_page)
+    if position is None:
+        statement += ' OFFSET ?'
+        params.append((page_id - 1) * per_page)
+    with sql.cursor() as cur:
+        rows = cur.execute(statement, params).fetchall()
+    next_cursor = None
+    if len(rows) == per_page:
+        next_cursor = util.encode_cursor(rows[-1][1], rows[-1][0])
+    return [str(post_id) for post_id, _ in rows], next_cursor
+
+
+def posts_by_page(page_id, per_page, cursor=None):
+    """
+    paging display
+    page_id: start from 1, ignored if cursor is given
+    return (post ids, next cursor), latest first
+    """
+    return _page('', (), page_id, per_page, cursor)
+
+
+def get_post(post_id):
+    """
+    get post infomation
+    return dict, None if the post is missing or deleted
+    """
+    with sql.cursor() as cur:
+        row = cur.execute(_SELECT_POST + ' WHERE id = ? AND deleted = 0', (post_id,)).fetchone()
+    if row is not None:
+        return _post_info(row)
+
+
+def get_post_author(post_id):
+    """
+    return author id of post, None if the post is missing
+    """
+    with sql.cursor() as cur:
+        row = cur.execute('SELECT author_id FROM blog_posts WHERE id = ?', (post_id,)).fetchone()
+    return int(row[0]) if row is not None else None
+
+
+def get_posts(post_ids):
+    """
+    get infomation of several posts in one query
+    return list of dict, in the order of post_ids, missing and deleted posts are skipped
+    """
+    post_ids = [int(post_id) for post_id in post_ids]
+    if not post_ids:
+        return []
+    with sql.cursor() as cur:
+        rows = cur.execute(_SELECT_POST + ' WHERE deleted = 0 AND id IN ({})'.format(sql.in_clause(post_ids)),
+                           post_ids).fetchall()
+    posts = {int(row[0]): _post_info(row) for row in rows}
+    return [posts[post_id] for post_id in post_ids if post_id in posts]
+
+
+def posts_by_author(author_id, page_id, per_page, cursor=None):
+    """
+    paging display
+    get posts list by author
+    return (post ids, next cursor), latest first
+    """
+    return _page(' AND author_id = ?', (author_id,), page_id, per_page, cursor)
@@ -0,0 +1,280 @@
+# !/usr/bin/python
+# coding=utf-8
+
+import time
+from datetime import datetime
+from .. import util
+from .cache import WriteBehindBuffer
+from . import sql
+
+'''
+用户和关注关系的关系数据库实现, 参数和返回值与db_users相同;
+1. 用户表blog_users, name和email唯一索引, 注册时由唯一索引保证不重复;
+2. 关注关系表blog_follows, 主键(follower_id, followed_id), 按(followed_id, ts)和(follower_id, ts)建立索引,
+   粉丝和关注列表按关注时间倒序分页;
+3. 没有进程内用户缓存, 请求内的重复查询由models中的UserIdentityMap合并;
+4. last_seen延迟写入, 与db_users相同, 使用executemany批量更新;
+'''
+
+_USER_COLUMNS = ('id', 'name', 'email', 'password', 'role_id', 'confirmed', 'about_me', 'location',
+                 'member_since', 'last_seen')
+_SELECT_USER = 'SELECT {} FROM blog_users'.format(', '.join(_USER_COLUMNS))
+
+
+def _user_info(row):
+    # 与redis散列相同, 所有字段都是字符串, user_id是int
+    user_info = {column: str(value) for column, value in zip(_USER_COLUMNS[1:], row[1:])}
+    user_info['user_id'] = int(row[0])
+    return user_info
+
+
+def _write_last_seen(last_seen):
+    with sql.cursor() as cur:
+        cur.executemany('UPDATE blog_users SET last_seen = ? WHERE id = ?',
+                        [(str(utctime), user_id) for user_id, utctime in last_seen.items()])
+
+
+last_seen_buffer = WriteBehindBuffer(_write_last_seen)
+
+
+def init_cache(app):
+    last_seen_buffer.configure(app.config.get('LAST_SEEN_FLUSH_INTERVAL', 5), app.config.get('LAST_SEEN_THROTTLE', 60))
+
+
+def reg_user(username, pwd, email, role_id):
+    """
+    add new user pwd: hash pwd
+    return user id, 0 if username or email has been registered
+    """
+    now = str(datetime.utcnow())
+    try:
+        with sql.cursor() as cur:
+            return cur.execute('INSERT INTO blog_users (name, email, password, role_id, confirmed, about_me, location, '
+                               'member_since, last_seen) VALUES (?, ?, ?, ?, 0, ?, ?, ?, ?)',
+                               (username, email, pwd, role_id, '', '', now, now)).lastrowid
+    except sql.integrity_error():
+        return 0
+
+
+def _select_user(column, value):
+    with sql.cursor() as cur:
+        row = cur.execute(_SELECT_USER + ' WHERE {} = ?'.format(column), (value,)).fetchone()
+    if row is not None:
+        return _user_info(row)
+
+
+def get_user(email):
+    """
+    get user infomation by user email
+    """
+    return _select_user('email', email)
+
+
+def get_user_by_name(name):
+    """
+    get user infomation by user name
+    """
+    return _select_user('name', name)
+
+
+def get_user_by_id(user_id):
+    """
+    get user infomation by user id
+    """
+    return _select_user('id', int(user_id))
+
+
+def get_users_by_ids(user_ids):
+    """
+    get infomation of several users in one query
+    return dict user_id -> user infomation, missing users are skipped
+    """
+    user_ids = list(set(int(user_id) for user_id in user_ids))
+    if not user_ids:
+        return {}
+    with sql.cursor() as cur:
+        rows = cur.execute(_SELECT_USER + ' WHERE id IN ({})'.format(sql.in_clause(user_ids)), user_ids).fetchall()
+    return {int(row[0]): _user_info(row) for row in rows}
+
+
+def _update_user(user_id, **fields):
+    with sql.cursor() as cur:
+        cur.execute('UPDATE blog_users SET {} WHERE id = ?'.format(', '.join('{} = ?'.format(name) for name in fields)),
+                    list(fields.values()) + [user_id])
+    return True
+
+
+def change_password(user_id, pwd):
+    return _update_user(user_id, password=pwd)
+
+
+def _exists(column, value):
+    with sql.cursor() as cur:
+        return cur.execute('SELECT 1 FROM blog_users WHERE {} = ?'.format(column), (value,)).fetchone() is not None
+
+
+def is_email_reg(email):
+    return _exists('email', email)
+
+
+def is_username_reg(name):
+    return _exists('name', name)
+
+
+def confirm(user_id):
+    return _update_user(user_id, confirmed=1)
+
+
+def update_last_seen(user_id, utctime):
+    """
+    buffered, return False if dropped because last_seen of user_id was updated recently
+    """
+    return last_seen_buffer.put(user_id, utctime)
+
+
+def update_profile(user_id, username, location, about_me):
+    return _update_user(user_id, name=username, location=location, about_me=about_me)
+
+
+def update_admin_profile(user_id, user):
+    return _update_user(user_id, name=user.username, email=user.email, confirmed=int(user.confirmed),
+                        role_id=user.role_id, location=user.location, about_me=user.about_me)
+
+
+def follow(user_id, follower):
+    """
+     user_id following follower
+    """
+    with sql.cursor() as cur:
+        cur.execute('REPLACE INTO blog_follows (follower_id, followed_id, ts) VALUES (?, ?, ?)',
+                    (user_id, follower, time.time()))
+
+
+def unfollow(user_id, follower):
+    """
+     user_id cancel follow followers
+    """
+    with sql.cursor() as cur:
+        cur.execute('DELETE FROM blog_follows WHERE follower_id = ? AND followed_id = ?', (user_id, follower))
+
+
+def _is_following(follower_id, followed_id):
+    with sql.cursor() as cur:
+        return cur.execute('SELECT 1 FROM blog_follows WHERE follower_id = ? AND followed_id = ?',
+                           (follower_id, followed_id)).fetchone() is not None
+
+
+def is_followed(user_id, follower):
+    """
+     whether user_id has followed followers
+    """
+    return _is_following(user_id, follower)
+
+
+def is_followed_by(user_id, follower):
+    """
+     whether user_is has been followed by follower
+    """
+    return _is_following(follower, user_id)
+
+
+def _follows_page(column, other, user_id, page_id, per_page, cursor):
+    """
+    page of (other, ts) where column is user_id, latest first, keyset paging on (ts, other) when cursor is given
+    """
+    position = util.decode_cursor(cursor)
+    statement = 'SELECT {0}, ts FROM blog_follows WHERE {1} = ?'.format(other, column)
+    params = [user_id]
+    if position is not None:
+        max_score, last_member = position
+        statement += ' AND (ts < ? OR (ts = ? AND {} < ?))'.format(other)
+        params += [max_score, max_score, int(last_member)]
+    elif page_id < 1:
+        return [], None
+    statement += ' ORDER BY ts DESC, {} DESC LIMIT ?'.format(other)
+    params.append(per_page)
+    if position is None:
+        statement += ' OFFSET ?'
+        params.append((page_id - 1) * per_page)
+    with sql.cursor() as cur:
+        follows = [(int(member), score) for member, score in cur.execute(statement, params).fetchall()]
+    next_cursor = None
+    if len(follows) == per_page:
+        next_cursor = util.encode_cursor(follows[-1][1], follows[-1][0])
+    return follows, next_cursor
+
+
+def followers_by_page(user_id, page_id, per_page, cursor=None):
+    """
+    paging display
+    get followers list by user_id
+    return (list of (user_id, follow timestamp), next cursor), latest first
+    """
+    return _follows_page('followed_id', 'follower_id', user_id, page_id, per_page, cursor)
+
+
+def following_by_page(user_id, page_id, per_page, cursor=None):
+    """
+    paging display
+    get has been following user list by user_id
+    return (list of (user_id, follow timestamp), next cursor), latest first
+    """
+    return _follows_page('follower_id', 'followed_id', user_id, page_id, per_page, cursor)
+
+
+def _count(column, user_id):
+    with sql.cursor() as cur:
+        return cur.execute('SELECT COUNT(*) FROM blog_follows WHERE {} = ?'.format(column), (user_id,)).fetchone()[0]
+
+
+def followers_count(user_id):
+    """
+     get user the total of followers
+    """
+    return _count('followed_id', user_id)
+
+
+def following_count(user_id):
+    """
+     get the count of user has followed
+    """
+    return _count('follower_id', user_id)
+
+
+def all_followers(user_id):
+    """
+    return ids of all followers of user_id
+    """
+    with sql.cursor() as cur:
+        return [int(row[0]) for row in cur.execute('SELECT follower_id FROM blog_follows WHERE followed_id = ?',
+                                                   (user_id,)).fetchall()]
+
+
+def all_followings(user_id):
+    """
+    return ids of all users followed by user_id
+    """
+    with sql.cursor() as cur:
+        return [int(row[0]) for row in cur.execute('SELECT followed_id FROM blog_follows WHERE follower_id = ?',
+                                                   (user_id,)).fetchall()]
+
+
+def max_user_id():
+    """
+    return the largest user id, ids start from 1
+    """
+    with sql.cursor() as cur:
+        return cur.execute('SELECT MAX(id) FROM blog_users').fetchone()[0] or 0
+
+
+def followed_among(user_id, author_ids):
+    """
+    return the set of author_ids followed by user_id, checked in one query
+    """
+    author_ids = [int(author_id) for author_id in author_ids]
+    if not author_ids:
+        return set()
+    with sql.cursor() as cur:
+        rows = cur.execute('SELECT followed_id FROM blog_follows WHERE follower_id = ? AND followed_id IN ({})'.format(
+            sql.in_clause(author_ids)), [user_id] + author_ids).fetchall()
+    return set(int(row[0]) for row in rows)
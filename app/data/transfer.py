@@ -0,0 +1,181 @@
+# !/usr/bin/python
+# coding=utf-8
+
+import json
+import re
+from .. import util
+from .db_users import USER_FOLLOWING_SET
+from . import shards
+
+'''
+数据导入导出;
+1. parse_aof 流式解析AOF文件, 每次只读入一条命令, 内存占用与文件大小无关; 文件末尾不完整的命令(写入时宕机)被丢弃;
+2. replay 将命令按批放入管道发送到目标redis; 只重放源数据库(SELECT)中的命令, MULTI/EXEC被去掉, 批次之间不保证原子性;
+   FLUSHDB/FLUSHALL会清空目标redis, 除非allow_flush, 否则遇到时抛出AOFError; 重放之前用count_flushes检查整个文件;
+3. export_keyspace 使用SCAN遍历用户, 文章和关注关系(分片时遍历每个节点), 按批用管道读取, 输出每行一个json对象;
+   默认不导出用户的密码散列;
+'''
+
+# 去掉的命令, 重放时目标数据库由客户端决定, 事务边界不需要保留
+_SKIPPED = {b'SELECT', b'MULTI', b'EXEC'}
+# 清空目标redis的命令
+_FLUSHES = {b'FLUSHDB', b'FLUSHALL'}
+
+
+class AOFError(Exception):
+    pass
+
+
+def _read_line(stream):
+    line = stream.readline()
+    if not line:
+        return None
+    if not line.endswith(b'\r\n'):
+        # 文件末尾被截断
+        return None
+    return line[:-2]
+
+
+def parse_aof(stream):
+    """
+    yield (db, command) of a binary AOF stream, command is a list of bytes
+    """
+    db = 0
+    while True:
+        line = _read_line(stream)
+        if line is None:
+            return
+        if line.startswith(b'REDIS'):
+            raise AOFError('AOF with an RDB preamble is not supported, rewrite it with aof-use-rdb-preamble no')
+        if not line.startswith(b'*'):
+            raise AOFError('unexpected line in AOF: {!r}'.format(line[:64]))
+        command = []
+        for _ in range(int(line[1:])):
+            header = _read_line(stream)
+            if header is None:
+                return
+            if not header.startswith(b'$'):
+                raise AOFError('unexpected bulk header in AOF: {!r}'.format(header[:64]))
+            size = int(header[1:])
+            value = stream.read(size + 2)
+            if len(value) < size + 2:
+                return
+            command.append(value[:-2])
+        name = command[0].upper()
+        if name == b'SELECT':
+            db = int(command[1])
+        yield db, command
+
+
+def count_flushes(commands, source_db=0):
+    """
+    return the number of FLUSHDB and FLUSHALL among the (db, command) pairs of source_db
+    """
+    return sum(1 for db, command in commands if db == source_db and command[0].upper() in _FLUSHES)
+
+
+def replay(commands, client, batch_size, source_db=0, allow_flush=False):
+    """
+    send the (db, command) pairs of source_db to client in pipelined batches
+    allow_flush: replay FLUSHDB and FLUSHALL, otherwise AOFError is raised when one is met
+    yield (commands sent, errors) of each batch
+    """
+    pipe = client.pipeline(transaction=False)
+    for db, command in commands:
+        if db != source_db or command[0].upper() in _SKIPPED:
+            continue
+        if command[0].upper() in _FLUSHES and not allow_flush:
+            raise AOFError('{} in the AOF would empty the target redis'.format(command[0].decode('utf-8').upper()))
+        pipe.execute_command(command[0].decode('utf-8').upper(), *command[1:])
+        if len(pipe) >= batch_size:
+            yield _flush(pipe)
+    if len(pipe):
+        yield _flush(pipe)
+
+
+def _flush(pipe):
+    count = len(pipe)
+    errors = [ret for ret in pipe.execute(raise_on_error=False) if isinstance(ret, Exception)]
+    for error in errors[:3]:
+        print('replay error: {}'.format(error))
+    return count, len(errors)
+
+
+def _scan(pattern, batch_size):
+    for client in shards.nodes():
+        for key in client.scan_iter(match=pattern, count=batch_size):
+            yield key
+
+
+def _scan_hashes(pattern, key_re, batch_size):
+    """
+    yield (id, dict) of hashes whose keys match key_re, read batch_size keys per pipeline
+    """
+    keys = []
+    for key in _scan(pattern, batch_size):
+        key = key.decode('utf-8')
+        match = key_re.match(key)
+        if match is not None:
+            keys.append((int(match.group(1)), key))
+        if len(keys) >= batch_size:
+            for item in _read_hashes(keys):
+                yield item
+            keys = []
+    for item in _read_hashes(keys):
+        yield item
+
+
+def _read_hashes(keys):
+    if not keys:
+        return []
+    pipe = shards.pipeline()
+    for _, key in keys:
+        pipe.hgetall(key)
+    return [(item_id, fields) for (item_id, _), fields in zip(keys, util.convert(pipe.execute())) if fields]
+
+
+def _scan_follows(batch_size):
+    keys = []
+    key_re = re.compile(r'^' + re.escape(USER_FOLLOWING_SET) + r'(\d+)$')
+    for key in _scan(USER_FOLLOWING_SET + '*', batch_size):
+        match = key_re.match(key.decode('utf-8'))
+        if match is not None:
+            keys.append(int(match.group(1)))
+        if len(keys) >= batch_size:
+            for item in _read_follows(keys):
+                yield item
+            keys = []
+    for item in _read_follows(keys):
+        yield item
+
+
+def _read_follows(user_ids):
+    if not user_ids:
+        return []
+    pipe = shards.pipeline()
+    for user_id in user_ids:
+        pipe.zrange(USER_FOLLOWING_SET + '{}'.format(user_id), 0, -1, withscores=True)
+    return [(user_id, [[int(member), score] for member, score in followings])
+            for user_id, followings in zip(user_ids, pipe.execute()) if followings]
+
+
+def export_keyspace(out, batch_size, passwords=False):
+    """
+    write users, posts and followings to out as json lines
+    passwords: include the password hashes of users
+    yield (type, number of records written) after each type
+    """
+    for record_type, items in (('user', _scan_hashes('user:*', re.compile(r'^user:(\d+)$'), batch_size)),
+                               ('post', _scan_hashes('post:*', re.compile(r'^post:(\d+)$'), batch_size))):
+        count = 0
+        for item_id, fields in items:
+            if record_type == 'user' and not passwords:
+                fields.pop('password', None)
+            out.write(json.dumps({'type': record_type, 'id': item_id, 'fields': fields}) + '\n')
+            count += 1
+        yield record_type, count
+    count = 0
+    for user_id, followings in _scan_follows(batch_size):
+        out.write(json.dumps({'type': 'follow', 'id': user_id, 'following': followings}) + '\n')
+        count += 1
+    yield 'follow', count
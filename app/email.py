@@ -1,23 +1,79 @@
 # !/usr/bin/python
 # coding=utf-8
 
-from threading import Thread
+import smtplib
+import socket
+import time
 from flask import current_app
 from flask import render_template
 from flask_mail import Message
 from . import mail
+from . import celery
+from .data import db_mail
 
-
-def send_sync_mail(app, msg):
-    with app.app_context():
-        mail.send(msg)
+'''
+邮件发送;
+1. 请求中只渲染邮件并加入redis中的邮件队列, 不等待SMTP服务器; 通知worker失败时不重试, 由定时任务发送;
+2. celery worker执行send_queued_mail取出邮件, 每批邮件复用一个SMTP连接发送;
+3. 发送失败的邮件按指数退避重试, 超过MAIL_MAX_RETRIES次后放入失败列表;
+4. celery beat定期执行send_queued_mail, 处理到期的重试以及worker崩溃后超时的邮件;
+'''
 
 
 def send_mail(to, subject, template, **kwargs):
     app = current_app._get_current_object()
-    msg = Message(app.config['MAIL_SUBJECT_PREFIX'] + subject, sender=app.config['MAIL_SENDER'], recipients=[to])
-    msg.body = render_template(template + '.txt', **kwargs)
-    msg.html = render_template(template + '.html', **kwargs)
-    thread = Thread(target=send_sync_mail, args=[app, msg])
-    thread.start()
-    send_sync_mail(app, msg)
+    db_mail.enqueue({'subject': app.config['MAIL_SUBJECT_PREFIX'] + subject, 'sender': app.config['MAIL_SENDER'],
+                     'recipients': [to], 'body': render_template(template + '.txt', **kwargs),
+                     'html': render_template(template + '.html', **kwargs), 'attempts': 0})
+    try:
+        # 不重试连接broker, broker不可用时不阻塞请求
+        send_queued_mail.apply_async(retry=False)
+    except Exception as e:
+        # 邮件已经保存在队列中, 由定时任务发送
+        print('send_mail notify worker error: {}'.format(e))
+
+
+@celery.task(ignore_result=True)
+def send_queued_mail():
+    """
+    send all queued mails, must run in app context
+    """
+    config = current_app.config
+    db_mail.requeue_due(time.time())
+    while True:
+        batch = db_mail.take(config['MAIL_QUEUE_BATCH'], time.time() + config['MAIL_SEND_TIMEOUT'])
+        if not batch:
+            break
+        _send_batch(batch)
+
+
+def _send_batch(batch):
+    pending = list(batch)
+    try:
+        with mail.connect() as connection:
+            while pending:
+                raw, message = pending[0]
+                try:
+                    connection.send(Message(message['subject'], sender=message['sender'],
+                                            recipients=message['recipients'], body=message['body'],
+                                            html=message['html']))
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException) as e:
+                    _retry(raw, message, e)
+                else:
+                    db_mail.ack(raw)
+                pending.pop(0)
+    except (smtplib.SMTPException, socket.error) as e:
+        # 连接失败, 剩余的邮件全部重试
+        for raw, message in pending:
+            _retry(raw, message, e)
+
+
+def _retry(raw, message, error):
+    config = current_app.config
+    message['attempts'] += 1
+    message['error'] = str(error)
+    if message['attempts'] > config['MAIL_MAX_RETRIES']:
+        print('send mail to {0} failed: {1}'.format(message['recipients'], error))
+        db_mail.fail(raw, message)
+    else:
+        db_mail.retry(raw, message, time.time() + config['MAIL_RETRY_BACKOFF'] * 2 ** (message['attempts'] - 1))
@@ -9,6 +9,7 @@ main = Blueprint('main', __name__)
 
 from . import views
 from . import errors
+from . import fragments
 
 
 
@@ -64,6 +64,11 @@ class PostForm(FlaskForm):
     submit = SubmitField('Submit')
 
 
+class DeleteForm(FlaskForm):
+    # 只有csrf_token, 文章列表中的删除按钮使用模板中的csrf_token()
+    pass
+
+
 
 
 
@@ -0,0 +1,28 @@
+# !/usr/bin/python
+# coding=utf-8
+
+from flask import render_template, request, Markup
+from . import main
+from ..data.cache import LRUCache
+
+'''
+文章片段缓存;
+_post.html渲染的文章主体(头像, 作者, 标题, 时间, 内容)与访问者无关, 渲染结果缓存在进程内;
+key包括文章ID和文章的version, 修改内容时version递增, 旧的片段不再命中, 由LRU淘汰;
+作者的用户名和邮箱(头像)可以被修改, 同样放在key中; 编辑/删除等与访问者相关的链接在_posts.html中渲染, 不缓存;
+'''
+
+_fragment_cache = LRUCache(1024, 3600)
+
+
+@main.app_template_global()
+def post_fragment(post):
+    """
+    return the rendered _post.html of post, cached by post id and version
+    """
+    key = (post.post_id, post.version, post.author, post.author_email, request.is_secure)
+    html = _fragment_cache.get(key)
+    if html is None:
+        html = Markup(render_template('_post.html', post=post))
+        _fragment_cache.set(key, html)
+    return html
@@ -1,40 +1,89 @@
 # !/usr/bin/python
 # coding=utf-8
-from flask import render_template, request
+from flask import render_template, request, make_response
 from flask import redirect, url_for, flash, abort
 from flask_login import login_required
 from flask_login import current_user
+from flask_wtf.csrf import generate_csrf
 from . import main
 from ..models import get_user_by_name, update_frofile, update_admin_profile
 from ..models import get_user_by_id, Permission, Pagination
-from ..models import publish_post, posts_by_page, posts_by_author
-from ..models import total_posts, total_posts_by_author, get_post
-from ..models import update_post_content, Relation, FOLLOWERS_NUM_PAGE
-from .forms import EditProfileForm, EditProfileFormAdmin, PostForm
+from ..models import publish_post, posts_by_page, posts_by_author, followed_posts
+from ..models import total_posts, total_posts_by_author, get_post, get_post_author
+from ..models import update_post_content, delete_post, Relation, FOLLOWERS_NUM_PAGE
+from .forms import EditProfileForm, EditProfileFormAdmin, PostForm, DeleteForm
 from ..decorators import admin_required, permission_required
+from .. import page_cache
 import html2text
 
 
+def _user_tags(username):
+    user_info = get_user_by_name(username)
+    if user_info is not None:
+        return ('user:{}'.format(user_info.id),)
+
+
+def _post_tags(post_id):
+    author_id = get_post_author(post_id)
+    if author_id is not None:
+        return 'post:{}'.format(post_id), 'user:{}'.format(author_id)
+
+
+@main.app_context_processor
+def inject_csrf_token():
+    # 只在渲染删除按钮时调用, 匿名用户的页面不写入session, 仍然可以缓存
+    return dict(csrf_token=generate_csrf)
+
+
 @main.route('/', methods=['GET', 'POST'])
+@page_cache.page(lambda: ('index',))
+@page_cache.cached
 def index():
     form = PostForm()
     if current_user.can(Permission.WRITE_ARTICLES) and form.validate_on_submit():
         publish_post(form.title.data, current_user.id, form.body.data, '')
         return redirect(url_for('.index'))
+    show_followed = current_user.is_authenticated and bool(request.cookies.get('show_followed', ''))
+    if show_followed:
+        cursor = request.args.get('cursor', None, type=int)
+        posts, next_cursor = followed_posts(current_user.id, cursor)
+        return render_template('index.html', form=form, posts=posts, permission=Permission,
+                               show_followed=show_followed, cursor=cursor, next_cursor=next_cursor)
+    page_cache.tag('index')
     page = request.args.get('page', 1, type=int)
-    posts = posts_by_page(page)
-    pagination = Pagination(page, posts, total_posts())
-    return render_template('index.html', form=form, posts=posts, permission=Permission, pagination=pagination)
+    posts, next_cursor = posts_by_page(page, request.args.get('cursor'))
+    pagination = Pagination(page, posts, total_posts(), next_cursor=next_cursor)
+    return render_template('index.html', form=form, posts=posts, permission=Permission, pagination=pagination,
+                           show_followed=show_followed)
+
+
+@main.route('/all')
+@login_required
+def show_all():
+    resp = make_response(redirect(url_for('.index')))
+    resp.set_cookie('show_followed', '', max_age=30 * 24 * 60 * 60)
+    return resp
+
+
+@main.route('/followed')
+@login_required
+def show_followed():
+    resp = make_response(redirect(url_for('.index')))
+    resp.set_cookie('show_followed', '1', max_age=30 * 24 * 60 * 60)
+    return resp
 
 
 @main.route('/user/<username>')
+@page_cache.page(_user_tags)
+@page_cache.cached
 def user(username):
     user_info = get_user_by_name(username)
     if user_info is None:
         abort(404)
+    page_cache.tag('user:{}'.format(user_info.id))
     page = request.args.get('page', 1, type=int)
-    posts = posts_by_author(user_info.id, page)
-    pagination = Pagination(page, posts, total_posts_by_author(user_info.id))
+    posts, next_cursor = posts_by_author(user_info.id, page, request.args.get('cursor'))
+    pagination = Pagination(page, posts, total_posts_by_author(user_info.id), next_cursor=next_cursor)
     return render_template('user.html', user=user_info, posts=posts, pagination=pagination,
                            permission=Permission, relation=Relation)
 
@@ -83,8 +132,13 @@ def edit_profile_admin(user_id):
 
 
 @main.route('/post/<int:post_id>')
+@page_cache.page(_post_tags)
+@page_cache.cached
 def post(post_id):
     post_info = get_post(post_id)
+    if post_info is None:
+        abort(404)
+    page_cache.tag('post:{}'.format(post_id), 'user:{}'.format(post_info.author_id))
     return render_template('post.html', posts=[post_info])
 
 
@@ -92,6 +146,8 @@ def post(post_id):
 @login_required
 def edit_post(post_id):
     post_info = get_post(post_id)
+    if post_info is None:
+        abort(404)
     # 管理员权限可以修改其他人的
     if current_user.id != post_info.author_id and not current_user.can(Permission.ADMINISTER):
         abort(403)
@@ -101,10 +157,25 @@ def edit_post(post_id):
         update_post_content(post_id, form.body.data)
         flash('The post has been updated.')
         return redirect(url_for('.post', post_id=post_id))
-    form.body.data = html2text.html2text(post_info.content)
+    form.body.data = post_info.body if post_info.body is not None else html2text.html2text(post_info.content)
     return render_template('edit_post.html', form=form)
 
 
+@main.route('/delete/<int:post_id>', methods=['POST'])
+@login_required
+def delete(post_id):
+    if not DeleteForm().validate_on_submit():
+        abort(400)
+    post_info = get_post(post_id)
+    if post_info is None:
+        abort(404)
+    if current_user.id != post_info.author_id and not current_user.can(Permission.ADMINISTER):
+        abort(403)
+    delete_post(post_id)
+    flash('The post has been deleted.')
+    return redirect(url_for('.index'))
+
+
 @main.route('/follow/<username>')
 @login_required
 @permission_required(Permission.FOLLOW)
@@ -144,12 +215,22 @@ def followers(username):
         flash('Invalid user!')
         return redirect(url_for('.index'))
     page = request.args.get('page', 1, type=int)
-    followers_p = Relation.followers_by_page(user_info.id, page)
-    pagination = Pagination(page, followers_p, Relation.followers_count(user_info.id), FOLLOWERS_NUM_PAGE)
+    followers_p, next_cursor = Relation.followers_by_page(user_info.id, page, request.args.get('cursor'))
+    pagination = Pagination(page, followers_p, Relation.followers_count(user_info.id), FOLLOWERS_NUM_PAGE,
+                            next_cursor)
     return render_template('followers.html', user=user_info, title='Follower of', endpoint='.followers',
-                           pagination=pagination, )
+                           pagination=pagination, follows=followers_p)
 
 
 @main.route('/following/<username>')
 def following(username):
-    pass
+    user_info = get_user_by_name(username)
+    if user_info is None:
+        flash('Invalid user!')
+        return redirect(url_for('.index'))
+    page = request.args.get('page', 1, type=int)
+    following_p, next_cursor = Relation.following_by_page(user_info.id, page, request.args.get('cursor'))
+    pagination = Pagination(page, following_p, Relation.following_count(user_info.id), FOLLOWERS_NUM_PAGE,
+                            next_cursor)
+    return render_template('followers.html', user=user_info, title='Followed by', endpoint='.following',
+                           pagination=pagination, follows=following_p)
@@ -0,0 +1,288 @@
+# !/usr/bin/python
+# coding=utf-8
+
+import bisect
+import hmac
+import json
+import os
+import socket
+import threading
+import time
+from flask import request, g, has_request_context, Response, abort
+
+'''
+请求和redis访问的统计, /metrics以Prometheus文本格式输出;
+1. redis_commands_total 每个endpoint和命令的redis命令数, 管道中的命令分别计数;
+2. redis_roundtrip_seconds 每次往返(单个命令或整个管道)的耗时; redis_pipeline_commands 管道的命令数;
+3. redis_commands_per_request 每个请求的redis命令数, 可以直接看出N+1这类问题;
+4. http_request_duration_seconds 请求处理时间;
+5. redis_pool_* 当前进程连接池的使用情况;
+没有请求上下文的redis访问(celery任务, 后台线程)的endpoint为background;
+统计数据保存在进程内, 每个序列带有进程的pid标签; 每个worker每METRICS_PUBLISH_INTERVAL秒把自己的统计写入redis
+(metrics:worker:主机名:pid, 过期时间为3个间隔), /metrics输出同一主机上所有worker的统计, 抓取任意一个worker即可;
+退出的worker的统计在过期后消失, 汇总时使用sum by (...)并且不依赖pid; METRICS_PUBLISH_INTERVAL为0时只输出当前进程;
+/metrics只允许METRICS_ALLOWED_IPS中的地址或者带有Authorization: Bearer METRICS_TOKEN的请求访问, 都没有配置时返回403;
+'''
+
+# 每个worker的统计快照
+METRICS_WORKER = 'metrics:worker:'
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144)
+PIPELINE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+# 连接池统计中的瞬时值, 其余是累计值
+POOL_GAUGES = ('in_use', 'max_connections')
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, _escape(value)) for name, value in labels) + '}'
+
+
+class Counter:
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self._label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(labels), value] for labels, value in self._values.items()]
+
+    def render(self, snapshots):
+        """
+        snapshots: dict pid -> snapshot of the metric in that process
+        """
+        lines = ['# HELP {0} {1}'.format(self.name, self.help_text), '# TYPE {0} counter'.format(self.name)]
+        for pid, labels, value in sorted((pid, tuple(labels), value) for pid, values in snapshots.items()
+                                         for labels, value in values):
+            lines.append('{0}{1} {2}'.format(self.name, _format_labels([('pid', pid)] +
+                                                                       list(zip(self._label_names, labels))), value))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, label_names, buckets):
+        self.name = name
+        self.help_text = help_text
+        self._label_names = label_names
+        self._buckets = buckets
+        # labels -> [每个桶的计数(不累加), +Inf桶计数, 总和]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self._buckets) + 1) + [0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def totals(self, labels):
+        """
+        return (number of observations, sum of observations) of labels
+        """
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                return 0, 0
+            return sum(counts[:-1]), counts[-1]
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(labels), list(counts)] for labels, counts in self._values.items()]
+
+    def render(self, snapshots):
+        """
+        snapshots: dict pid -> snapshot of the metric in that process
+        """
+        lines = ['# HELP {0} {1}'.format(self.name, self.help_text), '# TYPE {0} histogram'.format(self.name)]
+        items = sorted((pid, tuple(labels), counts) for pid, values in snapshots.items() for labels, counts in values)
+        for pid, labels, counts in items:
+            labels = [('pid', pid)] + list(zip(self._label_names, labels))
+            total = 0
+            for bound, count in zip(self._buckets + ('+Inf',), counts[:-1]):
+                total += count
+                lines.append('{0}_bucket{1} {2}'.format(self.name, _format_labels(labels + [('le', bound)]), total))
+            lines.append('{0}_sum{1} {2}'.format(self.name, _format_labels(labels), counts[-1]))
+            lines.append('{0}_count{1} {2}'.format(self.name, _format_labels(labels), total))
+        return lines
+
+
+redis_commands = Counter('redis_commands_total', 'Redis commands issued', ('endpoint', 'command'))
+redis_roundtrip = Histogram('redis_roundtrip_seconds', 'Latency of a Redis command or pipeline',
+                            ('endpoint',), LATENCY_BUCKETS)
+redis_pipeline = Histogram('redis_pipeline_commands', 'Commands sent in one pipeline', ('endpoint',), PIPELINE_BUCKETS)
+redis_per_request = Histogram('redis_commands_per_request', 'Redis commands issued by one request',
+                              ('endpoint',), COUNT_BUCKETS)
+request_duration = Histogram('http_request_duration_seconds', 'Time spent handling a request',
+                             ('endpoint', 'method', 'status'), REQUEST_BUCKETS)
+METRICS = (redis_commands, redis_roundtrip, redis_pipeline, redis_per_request, request_duration)
+_config = {}
+_publisher_pid = None
+_publisher_lock = threading.Lock()
+
+
+def _endpoint():
+    if has_request_context():
+        return request.endpoint or 'none'
+    return 'background'
+
+
+def observe_redis(commands, seconds, pipeline=False):
+    """
+    record one round trip to redis
+    commands: names of the commands sent
+    """
+    endpoint = _endpoint()
+    for command in commands:
+        redis_commands.inc((endpoint, command))
+    redis_roundtrip.observe((endpoint,), seconds)
+    if pipeline:
+        redis_pipeline.observe((endpoint,), len(commands))
+    if has_request_context():
+        g.redis_commands = g.get('redis_commands', 0) + len(commands)
+        g.redis_seconds = g.get('redis_seconds', 0) + seconds
+
+
+def _before_request():
+    g.request_start = time.time()
+    g.redis_commands = 0
+    g.redis_seconds = 0
+    if _config.get('publish_interval'):
+        _ensure_publishing()
+
+
+def _after_request(response):
+    if 'request_start' in g and request.endpoint != 'metrics':
+        endpoint = request.endpoint or 'none'
+        request_duration.observe((endpoint, request.method, str(response.status_code)),
+                                 time.time() - g.request_start)
+        redis_per_request.observe((endpoint,), g.redis_commands)
+    return response
+
+
+def snapshot():
+    """
+    return the metrics of this process, serializable as json
+    """
+    from .redis_pool import pool_stats
+    data = {metric.name: metric.snapshot() for metric in METRICS}
+    data['redis_pool'] = pool_stats()
+    return data
+
+
+def _worker_key(pid):
+    return '{0}{1}:{2}'.format(METRICS_WORKER, socket.gethostname(), pid)
+
+
+def publish():
+    """
+    write the snapshot of this process to redis for /metrics of the other workers on this host
+    """
+    from .redis_pool import get_client
+    interval = _config['publish_interval']
+    get_client().set(_worker_key(os.getpid()), json.dumps(snapshot()), ex=max(1, int(interval * 3)))
+
+
+def _publish_loop():
+    while True:
+        time.sleep(_config['publish_interval'])
+        try:
+            publish()
+        except Exception as e:
+            print('publish metrics error: {}'.format(e))
+
+
+def _ensure_publishing():
+    global _publisher_pid
+    if _publisher_pid == os.getpid():
+        return
+    with _publisher_lock:
+        if _publisher_pid == os.getpid():
+            return
+        # fork之后子进程重新启动线程
+        _publisher_pid = os.getpid()
+        thread = threading.Thread(target=_publish_loop, name='metrics-publisher')
+        thread.daemon = True
+        thread.start()
+
+
+def _collect():
+    """
+    return dict pid -> snapshot of the workers on this host, only this process when publishing is disabled
+    """
+    pid = os.getpid()
+    snapshots = {pid: snapshot()}
+    if not _config.get('publish_interval'):
+        return snapshots
+    from .redis_pool import get_client
+    try:
+        publish()
+        client = get_client()
+        keys = list(client.scan_iter(match=_worker_key('*'), count=100))
+        for key, value in zip(keys, client.mget(keys) if keys else []):
+            worker = int(key.rsplit(b':', 1)[1])
+            if value is not None and worker != pid:
+                snapshots[worker] = json.loads(value.decode('utf-8'))
+    except Exception as e:
+        print('collect metrics of other workers error: {}'.format(e))
+    return snapshots
+
+
+def render():
+    """
+    return all metrics in Prometheus text format
+    """
+    snapshots = _collect()
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render({pid: data.get(metric.name, []) for pid, data in snapshots.items()}))
+    pools = {}
+    for pid, data in snapshots.items():
+        for name, value in data.get('redis_pool', {}).items():
+            pools.setdefault(name, []).append((pid, value))
+    for name, values in sorted(pools.items()):
+        lines.append('# TYPE redis_pool_{0} {1}'.format(name, 'gauge' if name in POOL_GAUGES else 'counter'))
+        for pid, value in sorted(values):
+            lines.append('redis_pool_{0}{1} {2}'.format(name, _format_labels([('pid', pid)]), value))
+    return '\n'.join(lines) + '\n'
+
+
+def _authorized():
+    token = _config.get('token')
+    if token:
+        expected = 'Bearer {}'.format(token).encode('utf-8')
+        if hmac.compare_digest(request.headers.get('Authorization', '').encode('utf-8'), expected):
+            return True
+    return request.remote_addr in _config.get('allowed_ips', ())
+
+
+def _metrics():
+    if not _authorized():
+        abort(403)
+    return Response(render(), mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    _config.update(token=app.config.get('METRICS_TOKEN'),
+                   allowed_ips=[ip.strip() for ip in (app.config.get('METRICS_ALLOWED_IPS') or '').split(',')
+                                if ip.strip()],
+                   publish_interval=app.config.get('METRICS_PUBLISH_INTERVAL', 0))
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.add_url_rule('/metrics', 'metrics', _metrics)
@@ -1,18 +1,25 @@
 # !/usr/bin/python
 # coding=utf-8
 from datetime import datetime
-from flask import current_app, request
+from flask import current_app, request, g, has_app_context
 from flask_login import AnonymousUserMixin
 from flask_login import UserMixin
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 from werkzeug.security import check_password_hash
 from werkzeug.security import generate_password_hash
-from .data import db_users, db_posts
-from . import login_manager
+from .data import db_feed
+from .data.backend import users as user_store, posts as post_store
+from . import login_manager, page_cache, profiler, redis_pool
+from functools import partial
+from bleach.linkifier import LinkifyFilter, DEFAULT_CALLBACKS
+from bleach.sanitizer import Cleaner
+from .data.cache import LRUCache
 import hashlib
 import math
-import bleach
+import threading
+import time
 import markdown
+import html2text
 
 # maximum number of articles per page
 POST_NUM_PAGE = 10
@@ -117,7 +124,8 @@ class User(UserMixin):
         if data.get('confirm') != self._id:
             return False
         self._confirmed = True
-        db_users.confirm(self._id)
+        redis_pool.pin_primary()
+        user_store.confirm(self._id)
         return True
 
     def reset_pwd(self, token, new_pwd):
@@ -141,7 +149,7 @@ class User(UserMixin):
     def ping(self):
         utctime = datetime.utcnow()
         self._last_seen = utctime
-        db_users.update_last_seen(self._id, utctime)
+        user_store.update_last_seen(self._id, utctime)
 
     def gravatar(self, size=100, default='identicon', rating='g'):
         if request.is_secure:
@@ -233,49 +241,151 @@ class User(UserMixin):
         self._last_seen = value
 
 
-def get_user(email):
-    user_info = db_users.get_user(email)
-    if user_info is not None:
+class UserIdentityMap:
+    """
+    请求范围内的User对象映射, 保存在app context上;
+    同一个请求中多次查找同一个用户返回同一个User对象, 不再重复HGETALL
+    """
+    def __init__(self):
+        self._by_id = {}
+        self._by_name = {}
+        self._by_email = {}
+
+    @staticmethod
+    def current():
+        """
+        return identity map of the current app context, None outside of app context
+        """
+        if not has_app_context():
+            return None
+        if getattr(g, '_user_identity_map', None) is None:
+            g._user_identity_map = UserIdentityMap()
+        return g._user_identity_map
+
+    def get_by_id(self, user_id):
+        return self._by_id.get(int(user_id))
+
+    def get_by_name(self, name):
+        return self._by_name.get(name)
+
+    def get_by_email(self, email):
+        return self._by_email.get(email)
+
+    def add(self, user_info):
+        """
+        return the User already mapped for user_info, or a new mapped User
+        """
+        user = self._by_id.get(int(user_info['user_id']))
+        if user is None:
+            user = User(**user_info)
+            self._by_id[user.id] = user
+        self._by_name[user.username] = user
+        self._by_email[user.email] = user
+        return user
+
+    def discard(self, user_id):
+        """
+        forget user_id, called after the user has been modified
+        """
+        user = self._by_id.pop(int(user_id), None)
+        if user is not None:
+            self._by_name = {name: u for name, u in self._by_name.items() if u is not user}
+            self._by_email = {email: u for email, u in self._by_email.items() if u is not user}
+
+
+def _map_user(user_info):
+    if user_info is None:
+        return None
+    identity_map = UserIdentityMap.current()
+    if identity_map is None:
         return User(**user_info)
+    return identity_map.add(user_info)
+
+
+def _forget_user(user_id):
+    identity_map = UserIdentityMap.current()
+    if identity_map is not None:
+        identity_map.discard(user_id)
+
+
+def get_user(email):
+    identity_map = UserIdentityMap.current()
+    if identity_map is not None and identity_map.get_by_email(email) is not None:
+        return identity_map.get_by_email(email)
+    return _map_user(user_store.get_user(email))
 
 
 def get_user_by_id(user_id):
-    user_info = db_users.get_user_by_id(user_id)
-    if user_info is not None:
-        return User(**user_info)
+    identity_map = UserIdentityMap.current()
+    if identity_map is not None and identity_map.get_by_id(user_id) is not None:
+        return identity_map.get_by_id(user_id)
+    return _map_user(user_store.get_user_by_id(user_id))
 
 
 def get_user_by_name(name):
-    user_info = db_users.get_user_by_name(name)
-    if user_info is not None:
-        return User(**user_info)
+    identity_map = UserIdentityMap.current()
+    if identity_map is not None and identity_map.get_by_name(name) is not None:
+        return identity_map.get_by_name(name)
+    return _map_user(user_store.get_user_by_name(name))
+
+
+def get_users_by_ids(user_ids):
+    """
+    return dict user_id -> User, users not in the identity map are loaded in one round trip
+    """
+    identity_map = UserIdentityMap.current()
+    users = {}
+    missing = []
+    for user_id in user_ids:
+        user = identity_map.get_by_id(user_id) if identity_map is not None else None
+        if user is not None:
+            users[int(user_id)] = user
+        else:
+            missing.append(user_id)
+    if missing:
+        for user_id, user_info in user_store.get_users_by_ids(missing).items():
+            users[user_id] = _map_user(user_info)
+    return users
 
 
 def register_user(name, pwd, email):
+    redis_pool.pin_primary()
     if email == current_app.config['MAIL_ADMIN']:
-        return db_users.reg_user(name, generate_password_hash(pwd), email, ADMIN_ROLE)
+        return user_store.reg_user(name, generate_password_hash(pwd), email, ADMIN_ROLE)
     else:
-        return db_users.reg_user(name, generate_password_hash(pwd), email, USER_ROLE)
+        return user_store.reg_user(name, generate_password_hash(pwd), email, USER_ROLE)
 
 
 def change_password(user_id, pwd):
-    return db_users.change_password(user_id, generate_password_hash(pwd))
+    _forget_user(user_id)
+    redis_pool.pin_primary()
+    return user_store.change_password(user_id, generate_password_hash(pwd))
 
 
 def is_email_register(email):
-    return db_users.is_email_reg(email)
+    return user_store.is_email_reg(email)
 
 
 def is_name_register(username):
-    return db_users.is_username_reg(username)
+    return user_store.is_username_reg(username)
 
 
 def update_frofile(user_id, user_name, location, about_me):
-    return db_users.update_profile(user_id, user_name, location, about_me)
+    _forget_user(user_id)
+    redis_pool.pin_primary()
+    ret = user_store.update_profile(user_id, user_name, location, about_me)
+    # 作者信息显示在首页和文章页面中
+    page_cache.invalidate('index', 'user:{}'.format(user_id))
+    return ret
 
 
 def update_admin_profile(user_id, user):
-    return db_users.update_admin_profile(user_id, user)
+    _forget_user(user_id)
+    redis_pool.pin_primary()
+    ret = user_store.update_admin_profile(user_id, user)
+    # 作者信息显示在首页和文章页面中
+    page_cache.invalidate('index', 'user:{}'.format(user_id))
+    return ret
 
 login_manager.anonymous_user = AnonymousUser
 
@@ -289,14 +399,21 @@ def load_user(user_id):
 
 
 class Post:
-    def __init__(self, **kwargs):
+    def __init__(self, author=None, **kwargs):
+        """
+        author: User object of the post author, loaded from db if not given
+        """
         self._post_id = int(kwargs['post_id'])
         self._title = kwargs['title']
         self._author_id = int(kwargs['author_id'])
         self._content = kwargs['content']
         self._category = kwargs['category']
         self._time = kwargs['time']
-        self._author = get_user_by_id(self.author_id).username
+        # 旧文章没有保存markdown原文
+        self._body = kwargs.get('body')
+        self._version = int(kwargs.get('version', 0))
+        self._author_user = author if author is not None else get_user_by_id(self.author_id)
+        self._author = self._author_user.username
 
     def __str__(self):
         return '(post_id: {0._post_id}, title: {0._title}, author: {0._author}, time: {0._time})'.format(self)
@@ -321,6 +438,20 @@ class Post:
     def content(self, value):
         self._content = value
 
+    @property
+    def body(self):
+        """
+        markdown source, None for posts published before it was stored
+        """
+        return self._body
+
+    @property
+    def version(self):
+        """
+        bumped whenever the content changes
+        """
+        return self._version
+
     @property
     def category(self):
         return self._category
@@ -337,63 +468,159 @@ class Post:
     def author(self):
         return self._author
 
+    @property
+    def author_email(self):
+        return self._author_user.email
+
     def author_gravatar(self, size=100, default='identicon', rating='g'):
-        user = get_user_by_id(self.author_id)
-        return user.gravatar(size, default, rating)
+        return self._author_user.gravatar(size, default, rating)
+
+
+# 允许的html标签; 修改渲染规则后增加RENDER_VERSION, 并执行 python manage.py rerender_posts
+ALLOWED_TAGS = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
+                'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
+                'h1', 'h2', 'h3', 'p']
+RENDER_VERSION = 1
+
+# 渲染结果缓存, key是渲染版本和markdown原文的hash
+_render_cache = LRUCache(256, 3600)
+# Markdown和Cleaner对象可以重用但不是线程安全的, 每个线程一份
+_renderer = threading.local()
 
 
 def markdown_to_html(content):
     # 服务器端将Markdown转化为Html, 直接保存
-    allowed_tags = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
-                    'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
-                    'h1', 'h2', 'h3', 'p']
-    # print(content)
-    return bleach.linkify(bleach.clean(markdown.markdown(content, output_format='html'),
-                                       tags=allowed_tags, strip=True))
+    key = hashlib.sha1('{0}:{1}'.format(RENDER_VERSION, content).encode('utf-8')).hexdigest()
+    html = _render_cache.get(key)
+    if html is None:
+        start = time.time()
+        if not hasattr(_renderer, 'markdown'):
+            _renderer.markdown = markdown.Markdown(output_format='html')
+            _renderer.cleaner = Cleaner(tags=ALLOWED_TAGS, strip=True,
+                                        filters=[partial(LinkifyFilter, callbacks=DEFAULT_CALLBACKS)])
+        html = _renderer.cleaner.clean(_renderer.markdown.reset().convert(content))
+        _render_cache.set(key, html)
+        profiler.record('markdown', time.time() - start)
+    return html
+
+
+def rerender_posts(batch_size=100):
+    """
+    render all posts again with the current rules, posts without markdown source get it from their html
+    yield the number of posts rendered in each batch, posts edited or deleted meanwhile are left as they are
+    """
+    redis_pool.pin_primary()
+    for posts in post_store.iter_post_sources(batch_size):
+        rendered = []
+        for post_id, body, content, version in posts:
+            if body is None:
+                body = html2text.html2text(content)
+            rendered.append((post_id, markdown_to_html(body), body, version))
+        updated = post_store.update_post_contents(rendered)
+        if updated:
+            # 每批一次, 缓存的页面, ETag和代理中的页面都包含旧的html
+            authors = {post_info['author_id'] for post_info in post_store.get_posts(updated)}
+            page_cache.invalidate('index', *(['post:{}'.format(post_id) for post_id in updated] +
+                                             ['user:{}'.format(author_id) for author_id in authors]))
+        yield len(updated)
 
 
 def publish_post(title, author_id, content, category):
-    return db_posts.publish_post(title, author_id, markdown_to_html(content), category)
+    redis_pool.pin_primary()
+    post_id = post_store.publish_post(title, author_id, markdown_to_html(content), category, content)
+    db_feed.push_post(post_id, author_id, current_app.config['FEED_FANOUT_THRESHOLD'],
+                      current_app.config['FEED_TIMELINE_SIZE'])
+    page_cache.invalidate('index', 'user:{}'.format(author_id))
+    return post_id
+
+
+def load_posts(post_ids):
+    """
+    build Post objects of post_ids
+    posts and their distinct authors are fetched in two pipelined round trips
+    """
+    posts_info = post_store.get_posts(post_ids)
+    authors = get_users_by_ids(set(int(post_info['author_id']) for post_info in posts_info))
+    return [Post(author=authors.get(int(post_info['author_id'])), **post_info) for post_info in posts_info]
+
+
+def posts_by_page(page_id, cursor=None):
+    """
+    return (posts, next cursor), cursor is used instead of page_id if given
+    """
+    post_ids, next_cursor = post_store.posts_by_page(page_id, POST_NUM_PAGE, cursor)
+    return load_posts(post_ids), next_cursor
 
 
-def posts_by_page(page_id):
-    post_ids = db_posts.posts_by_page(page_id, POST_NUM_PAGE)
-    if post_ids is not None:
-        posts = []
-        for post_id in post_ids:
-            posts.append(Post(**db_posts.get_post(post_id)))
-        return posts
+def posts_by_author(author_id, page_id, cursor=None):
+    """
+    return (posts, next cursor), cursor is used instead of page_id if given
+    """
+    post_ids, next_cursor = post_store.posts_by_author(author_id, page_id, POST_NUM_PAGE, cursor)
+    return load_posts(post_ids), next_cursor
 
 
-def posts_by_author(author_id, page_id):
-    post_ids = db_posts.posts_by_author(author_id, page_id, POST_NUM_PAGE)
-    if post_ids is not None:
-        posts = []
-        for post_id in post_ids:
-            posts.append(Post(**db_posts.get_post(post_id)))
-        return posts
+def followed_posts(user_id, cursor=None):
+    """
+    posts of the users followed by user_id, newest first
+    return (posts, next cursor), next cursor is None on the last page
+    """
+    post_ids, next_cursor = db_feed.timeline(user_id, cursor, POST_NUM_PAGE)
+    return load_posts(post_ids), next_cursor
 
 
 def total_posts():
-    return db_posts.total_posts()
+    return post_store.total_posts()
 
 
 def total_posts_by_author(author_id):
-    return db_posts.total_posts_by_author(author_id)
+    return post_store.total_posts_by_author(author_id)
 
 
 def get_post(post_id):
-    post = db_posts.get_post(post_id)
+    post = post_store.get_post(post_id)
     if post is not None:
         return Post(**post)
 
 
+def get_post_author(post_id):
+    """
+    return author id of post without loading it, None if the post is missing
+    """
+    return post_store.get_post_author(post_id)
+
+
+def delete_post(post_id):
+    redis_pool.pin_primary()
+    author_id = post_store.delete_post(post_id)
+    if author_id is not None:
+        db_feed.remove_post(post_id, author_id)
+        page_cache.invalidate('index', 'user:{}'.format(author_id), 'post:{}'.format(post_id))
+    return author_id
+
+
+def purge_deleted_posts(batch_size=500):
+    """
+    reclaim deleted posts in batches, yield the number of posts reclaimed in each batch
+    """
+    while True:
+        purged = post_store.purge_deleted(batch_size)
+        # None: 文章索引还没有迁移, 暂不回收
+        if purged is None or purged == 0 and post_store.deleted_count() == 0:
+            break
+        yield purged
+
+
 def update_post_content(post_id, content):
-    return db_posts.update_post_content(post_id, markdown_to_html(content))
+    redis_pool.pin_primary()
+    ret = post_store.update_post_content(post_id, markdown_to_html(content), content)
+    # 首页和作者主页的所有分页都可能包含该文章
+    page_cache.invalidate('index', 'post:{}'.format(post_id), 'user:{}'.format(post_store.get_post_author(post_id)))
+    return ret
 
 
 class Pagination:
-    def __init__(self, page, items, total, per_page=POST_NUM_PAGE):
+    def __init__(self, page, items, total, per_page=POST_NUM_PAGE, next_cursor=None):
         # the current page number
         self._page = page
         # the number of items to be displayed on a page
@@ -402,6 +629,8 @@ class Pagination:
         self._total = total
         # the items for the current page
         self._items = items
+        # the cursor of the next page
+        self._next_cursor = next_cursor
         # the total number of pages
         if self._per_page == 0:
             self._pages = 0
@@ -450,6 +679,10 @@ class Pagination:
         if self.has_prev:
             return self._page - 1
 
+    @property
+    def prev_num(self):
+        return self.pre_num
+
     @property
     def next_num(self):
         """
@@ -458,26 +691,24 @@ class Pagination:
         if self.has_next:
             return self._page + 1
 
-    def next(self):
+    @property
+    def next_cursor(self):
         """
-        return a class Ragination
+         cursor of the next page, None if the next page has to be loaded by page number
         """
-        assert self.has_next, 'must be has next'
-        return Pagination(self.next_num, posts_by_page(self.next_num), self.total)
+        if self.has_next:
+            return self._next_cursor
 
-    def prev(self):
+    def iter_pages(self, left_edge=2, left_current=2, right_current=5, right_edge=2):
         """
-        return a class Ragination
+        yield page numbers of the left edge, the window around the current page and the right edge,
+        None for a gap; cost is O(window), not O(pages)
         """
-        assert self.has_prev, 'must be has prev'
-        return Pagination(self.pre_num, posts_by_page(self.pre_num), self.total)
-
-    def iter_pages(self, left_edge=2, left_current=2, right_current=5, right_edge=2):
         last = 0
-        for num in range(1, self.pages + 1):
-            if num <= left_edge or \
-                    (self._page - left_current - 1 < num < self._page + right_current) or \
-                    (num > self._pages - right_edge):
+        for start, end in sorted(((1, left_edge),
+                                  (self._page - left_current, self._page + right_current - 1),
+                                  (self._pages - right_edge + 1, self._pages))):
+            for num in range(max(start, last + 1), min(end, self._pages) + 1):
                 if last + 1 != num:
                     yield None
                 yield num
@@ -487,33 +718,57 @@ class Pagination:
 class Relation:
     @staticmethod
     def follow(user_id, follower):
-        db_users.follow(user_id, follower)
+        redis_pool.pin_primary()
+        user_store.follow(user_id, follower)
+        db_feed.add_author(user_id, follower, current_app.config['FEED_TIMELINE_SIZE'])
+        # 用户主页显示粉丝数和关注数
+        page_cache.invalidate('user:{}'.format(user_id), 'user:{}'.format(follower))
 
     @staticmethod
     def unfollow(user_id, follower):
-        db_users.unfollow(user_id, follower)
+        redis_pool.pin_primary()
+        user_store.unfollow(user_id, follower)
+        db_feed.remove_author(user_id, follower)
+        page_cache.invalidate('user:{}'.format(user_id), 'user:{}'.format(follower))
 
     @staticmethod
     def is_followed(user_id, follower):
-        db_users.is_followed(user_id, follower)
+        return user_store.is_followed(user_id, follower)
 
     @staticmethod
     def is_followed_by(user_id, follower):
-        db_users.is_followed_by(user_id, follower)
+        return user_store.is_followed_by(user_id, follower)
 
     @staticmethod
-    def followers_by_page(user_id, page_id, per_page=FOLLOWERS_NUM_PAGE):
-        return db_users.followers_by_page(user_id, page_id, per_page)
+    def _load_follows(follows):
+        """
+        follows: list of (user_id, follow timestamp)
+        return list of dict with keys user and timestamp
+        """
+        users = get_users_by_ids([user_id for user_id, _ in follows])
+        return [{'user': users[user_id], 'timestamp': datetime.utcfromtimestamp(timestamp)}
+                for user_id, timestamp in follows if user_id in users]
+
+    @staticmethod
+    def followers_by_page(user_id, page_id, cursor=None, per_page=FOLLOWERS_NUM_PAGE):
+        """
+        return (follows, next cursor)
+        """
+        follows, next_cursor = user_store.followers_by_page(user_id, page_id, per_page, cursor)
+        return Relation._load_follows(follows), next_cursor
 
     @staticmethod
-    def following_by_page(user_id, page_id, per_page=FOLLOWERS_NUM_PAGE):
-        return db_users.following_by_page(user_id, page_id, per_page)
-        
+    def following_by_page(user_id, page_id, cursor=None, per_page=FOLLOWERS_NUM_PAGE):
+        """
+        return (follows, next cursor)
+        """
+        follows, next_cursor = user_store.following_by_page(user_id, page_id, per_page, cursor)
+        return Relation._load_follows(follows), next_cursor
+
     @staticmethod
     def followers_count(user_id):
-        return db_users.followers_count(user_id)
+        return user_store.followers_count(user_id)
 
     @staticmethod
     def following_count(user_id):
-        return db_users.following_count(user_id)
-
+        return user_store.following_count(user_id)
@@ -0,0 +1,199 @@
+# !/usr/bin/python
+# coding=utf-8
+
+import calendar
+import hashlib
+import os
+import time
+from functools import wraps
+from flask import current_app, request, session, g, make_response
+from flask_login import current_user
+from werkzeug.http import http_date
+from .data import db_pages
+from . import purge
+
+'''
+匿名用户的整页缓存, PAGE_CACHE_ENABLED开启;
+1. 只缓存未登录用户的GET请求, 没有待显示的flash消息, 并且渲染过程中没有修改session;
+2. 视图渲染时调用tag()登记页面依赖的数据, 修改数据时invalidate()删除相关页面, 其余由PAGE_CACHE_TTL限制过期时间;
+   渲染过程中数据被修改时, 旧页面最多保留PAGE_CACHE_TTL秒;
+3. 同一页面同时未命中时, 只有拿到锁的请求渲染页面, 其他请求轮询等待结果; 页面没有被缓存(例如404)时下一个请求拿到锁渲染,
+   等待超过PAGE_CACHE_LOCK_TIMEOUT自行渲染;
+4. 条件GET, CONDITIONAL_GET_ENABLED开启; 与整页缓存的条件相同, 只对未登录用户的GET/HEAD请求生效;
+   每个标签有一个版本号, 修改数据时invalidate()增加版本号; 页面的ETag由依赖的标签版本号和模板摘要组成,
+   Last-Modified是其中最新的时间; 请求的If-None-Match(或If-Modified-Since)与之相符时直接返回304,
+   不读取文章, 不渲染模板; 在整页缓存之前检查;
+   last_seen等不影响版本号的字段, 在客户端重新验证时不会更新;
+5. 反向代理缓存, PROXY_CACHE_ENABLED开启; 同样只对未登录用户, 页面返回Cache-Control: public, s-maxage=PROXY_CACHE_TTL
+   和标签对应的surrogate key, 修改数据时invalidate()按标签清除代理中的页面, 见purge; 其他响应为private;
+'''
+
+
+def _enabled():
+    return current_app.config['PAGE_CACHE_ENABLED']
+
+
+def tag(*tags):
+    """
+    record the data the page being rendered depends on, see db_pages for the tags
+    """
+    if 'page_tags' in g:
+        g.page_tags.extend(tags)
+
+
+def invalidate(*tags):
+    """
+    delete cached pages depending on any of tags, bump the versions of tags and purge them from the reverse proxy
+    """
+    if not tags:
+        return
+    if _enabled():
+        db_pages.invalidate(tags)
+    if current_app.config['CONDITIONAL_GET_ENABLED']:
+        db_pages.bump_versions(tags, time.time(), current_app.config['PAGE_VERSION_TTL'])
+    purge.purge(tags)
+
+
+def _cacheable():
+    return request.method == 'GET' and current_user.is_anonymous and not session.get('_flashes')
+
+
+def _render(view, args, kwargs, path):
+    g.page_tags = []
+    resp = make_response(view(*args, **kwargs))
+    if resp.status_code == 200 and not resp.direct_passthrough and not session.modified:
+        db_pages.store_page(path, resp.get_data(), g.page_tags, current_app.config['PAGE_CACHE_TTL'])
+    resp.headers['X-Page-Cache'] = 'MISS'
+    return resp
+
+
+def _cached_response(body):
+    resp = make_response(body)
+    resp.headers['X-Page-Cache'] = 'HIT'
+    return resp
+
+
+def cached(view):
+    """
+    decorator of views whose pages are cached for anonymous users
+    """
+    @wraps(view)
+    def decorated(*args, **kwargs):
+        if not _enabled() or not _cacheable():
+            return view(*args, **kwargs)
+        path = request.full_path
+        body = db_pages.get_page(path)
+        if body is not None:
+            return _cached_response(body)
+        deadline = time.time() + current_app.config['PAGE_CACHE_LOCK_TIMEOUT']
+        while True:
+            if db_pages.lock_page(path, current_app.config['PAGE_CACHE_LOCK_TIMEOUT']):
+                try:
+                    return _render(view, args, kwargs, path)
+                finally:
+                    db_pages.unlock_page(path)
+            if time.time() >= deadline:
+                return _render(view, args, kwargs, path)
+            # 其他请求正在渲染该页面
+            time.sleep(current_app.config['PAGE_CACHE_POLL_INTERVAL'])
+            body = db_pages.get_page(path)
+            if body is not None:
+                return _cached_response(body)
+    return decorated
+
+
+_templates = {}
+
+
+def _templates_version():
+    """
+    return (digest, newest modification time) of the templates, pages change with them on deploy
+    """
+    folder = os.path.join(current_app.root_path, current_app.template_folder)
+    if folder not in _templates:
+        digest = hashlib.md5(current_app.config['CONDITIONAL_GET_SALT'].encode('utf-8'))
+        newest = 0
+        for root, dirs, files in os.walk(folder):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                with open(path, 'rb') as f:
+                    digest.update(f.read())
+                newest = max(newest, int(os.path.getmtime(path)))
+        _templates[folder] = (digest.hexdigest()[:8], newest)
+    return _templates[folder]
+
+
+def _validators(tags):
+    """
+    return (etag, last modified time) of the page of tags
+    """
+    digest, templates_time = _templates_version()
+    versions = db_pages.get_versions(tags, time.time(), current_app.config['PAGE_VERSION_TTL'])
+    return '-'.join([digest] + [str(version) for version in versions]), max(versions + [templates_time])
+
+
+def _not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since is not None:
+        return last_modified <= calendar.timegm(request.if_modified_since.utctimetuple())
+    return False
+
+
+def _set_validators(resp, etag, last_modified):
+    resp.set_etag(etag, weak=True)
+    resp.headers['Last-Modified'] = http_date(last_modified)
+    # 登录用户看到的页面不同, 也没有验证器
+    resp.vary.add('Cookie')
+
+
+def _set_proxy_headers(resp, tags):
+    """
+    let the reverse proxy cache the page of tags until it is purged, browsers revalidate every time
+    """
+    resp.cache_control.public = True
+    resp.cache_control.max_age = 0
+    resp.cache_control.s_maxage = current_app.config['PROXY_CACHE_TTL']
+    resp.headers[current_app.config['SURROGATE_KEY_HEADER']] = ' '.join(purge.surrogate_keys(tags))
+    resp.vary.add('Cookie')
+
+
+def _private(resp):
+    if current_app.config['PROXY_CACHE_ENABLED']:
+        resp.cache_control.private = True
+    return resp
+
+
+def page(tags_of):
+    """
+    decorator of pages shared by anonymous users, put it before cached
+    tags_of: called with the view arguments before the view, returns the tags of the page, None if there is no page
+    answers conditional GETs from the tag versions when CONDITIONAL_GET_ENABLED,
+    adds Cache-Control and surrogate keys for the reverse proxy when PROXY_CACHE_ENABLED
+    """
+    def decorator(view):
+        @wraps(view)
+        def decorated(*args, **kwargs):
+            conditional = current_app.config['CONDITIONAL_GET_ENABLED']
+            proxy = current_app.config['PROXY_CACHE_ENABLED']
+            tags = None
+            if (conditional or proxy) and request.method in ('GET', 'HEAD') and current_user.is_anonymous \
+                    and not session.get('_flashes'):
+                tags = tags_of(*args, **kwargs)
+            if not tags:
+                return _private(make_response(view(*args, **kwargs)))
+            validators = _validators(tags) if conditional else None
+            if validators is not None and _not_modified(*validators):
+                resp = current_app.response_class(status=304)
+            else:
+                resp = make_response(view(*args, **kwargs))
+                if resp.status_code != 200 or session.modified:
+                    return _private(resp)
+            if validators is not None:
+                _set_validators(resp, *validators)
+            if proxy:
+                _set_proxy_headers(resp, tags)
+            return resp
+        return decorated
+    return decorator
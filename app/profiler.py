@@ -0,0 +1,156 @@
+# !/usr/bin/python
+# coding=utf-8
+
+import cProfile
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from flask import current_app, request, g, has_request_context, before_render_template, template_rendered
+from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
+
+'''
+请求抽样分析;
+1. 按PROFILE_RATE的比例随机抽样请求; 或者请求头PROFILE_HEADER带有manage.py profile_token生成的签名, 线上不用重新部署即可分析指定请求;
+2. PROFILE_FORMAT=pstats 使用cProfile, 输出.prof文件, 使用python -m pstats或snakeviz查看;
+   PROFILE_FORMAT=collapsed 后台线程每PROFILE_SAMPLE_INTERVAL秒采样一次请求线程的调用栈, 输出折叠栈.folded文件, 用flamegraph.pl生成火焰图;
+3. 每个分析文件有同名的.json, 记录endpoint, 总耗时以及redis, markdown(包括bleach), jinja分别的耗时;
+   jinja的耗时包括模板中访问redis的时间;
+'''
+
+
+def generate_token(secret_key, expiration=3600):
+    """
+    return the value of PROFILE_HEADER which makes a request profiled
+    """
+    return Serializer(secret_key, expiration).dumps({'profile': True}).decode('utf-8')
+
+
+def _verify_token(token):
+    try:
+        return Serializer(current_app.config['SECRET_KEY']).loads(token).get('profile') is True
+    except Exception:
+        return False
+
+
+def record(category, seconds):
+    """
+    add seconds spent in category to the profile of the current request
+    """
+    if has_request_context() and 'profile_times' in g:
+        g.profile_times[category] = g.profile_times.get(category, 0) + seconds
+
+
+class StackSampler:
+    def __init__(self, thread_id, interval):
+        self._thread_id = thread_id
+        self._interval = interval
+        self._stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{0}:{1}'.format(os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            if stack:
+                self._stacks[';'.join(reversed(stack))] += 1
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self._stacks.items():
+                f.write('{0} {1}\n'.format(stack, count))
+
+
+def _should_profile():
+    token = request.headers.get(current_app.config['PROFILE_HEADER'])
+    if token is not None and _verify_token(token):
+        return True
+    return random.random() < current_app.config['PROFILE_RATE']
+
+
+def _before_request():
+    if not _should_profile():
+        return
+    g.profile_times = {}
+    g.profile_start = time.time()
+    g.template_depth = 0
+    if current_app.config['PROFILE_FORMAT'] == 'collapsed':
+        g.profiler = StackSampler(threading.current_thread().ident, current_app.config['PROFILE_SAMPLE_INTERVAL'])
+        g.profiler.start()
+    else:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # 同一时间只能有一个cProfile在运行(python 3.12起)
+            return
+        g.profiler = profiler
+
+
+def _teardown_request(exc):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return
+    elapsed = time.time() - g.profile_start
+    if isinstance(profiler, StackSampler):
+        profiler.stop()
+        suffix = '.folded'
+    else:
+        profiler.disable()
+        suffix = '.prof'
+    profile_dir = current_app.config['PROFILE_DIR']
+    endpoint = request.endpoint or 'none'
+    name = os.path.join(profile_dir, '{0}-{1}-{2}'.format(endpoint, int(time.time() * 1000), os.getpid()))
+    times = g.profile_times
+    summary = {'endpoint': endpoint, 'method': request.method, 'path': request.full_path,
+               'total': elapsed, 'redis': g.get('redis_seconds', 0), 'redis_commands': g.get('redis_commands', 0),
+               'markdown': times.get('markdown', 0), 'jinja': times.get('jinja', 0), 'error': repr(exc) if exc else None}
+    try:
+        if not os.path.isdir(profile_dir):
+            os.makedirs(profile_dir)
+        if suffix == '.prof':
+            profiler.dump_stats(name + suffix)
+        else:
+            profiler.dump(name + suffix)
+        with open(name + '.json', 'w') as f:
+            json.dump(summary, f)
+    except (IOError, OSError) as e:
+        print('write profile {0} error: {1}'.format(name, e))
+
+
+def _before_render(sender, template, context, **extra):
+    if 'profile_times' in g:
+        if g.template_depth == 0:
+            g.template_start = time.time()
+        g.template_depth += 1
+
+
+def _template_rendered(sender, template, context, **extra):
+    if 'profile_times' in g:
+        g.template_depth -= 1
+        # 嵌套的模板(例如文章片段)只计算最外层
+        if g.template_depth == 0:
+            record('jinja', time.time() - g.template_start)
+
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.teardown_request(_teardown_request)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_template_rendered, app)
@@ -0,0 +1,66 @@
+# !/usr/bin/python
+# coding=utf-8
+
+from urllib.request import Request, urlopen
+from .data.cache import WriteBehindBuffer
+
+'''
+反向代理缓存的surrogate key和清除;
+1. 页面标签对应的surrogate key: index -> index, user:id -> author-id, post:id -> post-id;
+   未登录用户的首页, 用户主页和文章页面在SURROGATE_KEY_HEADER中列出这些key, 见page_cache.page;
+2. 修改数据时page_cache.invalidate()调用purge(), 合并去重后由后台线程每PURGE_INTERVAL秒发送一次,
+   每个请求用PURGE_METHOD访问PURGE_URL, SURROGATE_KEY_HEADER中最多PURGE_BATCH_SIZE个key(空格分隔);
+3. 发送失败时保留, 下次重试; PURGE_INTERVAL为0时立即发送, 失败的key在下一次清除时重试; 没有配置PURGE_URL时不清除;
+   PURGE_INTERVAL应大于从库的复制延迟, 否则代理重新获取页面时可能从从库读到旧数据;
+'''
+
+_config = {}
+
+
+def surrogate_keys(tags):
+    """
+    return the surrogate keys of page tags
+    """
+    keys = []
+    for tag in tags:
+        kind, _, item_id = tag.partition(':')
+        if kind == 'user':
+            keys.append('author-' + item_id)
+        elif kind == 'post':
+            keys.append('post-' + item_id)
+        else:
+            keys.append(kind)
+    return keys
+
+
+def _send(pending):
+    keys = list(pending)
+    batch_size = _config['batch_size']
+    for start in range(0, len(keys), batch_size):
+        request = Request(_config['url'], method=_config['method'],
+                          headers={_config['header']: ' '.join(keys[start:start + batch_size])})
+        urlopen(request, timeout=_config['timeout']).close()
+
+
+# 同一个key可能多次修改, 每次都要清除, 不限制频率
+purge_buffer = WriteBehindBuffer(_send, throttle=0)
+
+
+def init_app(app):
+    _config.update(url=app.config['PURGE_URL'], method=app.config['PURGE_METHOD'],
+                   header=app.config['SURROGATE_KEY_HEADER'], batch_size=app.config['PURGE_BATCH_SIZE'],
+                   timeout=app.config['PURGE_TIMEOUT'])
+    purge_buffer.configure(app.config['PURGE_INTERVAL'], 0)
+
+
+def enabled():
+    return bool(_config.get('url'))
+
+
+def purge(tags):
+    """
+    queue purges of the pages with any of tags
+    """
+    if enabled():
+        for key in surrogate_keys(tags):
+            purge_buffer.put(key, True)
@@ -0,0 +1,273 @@
+# !/usr/bin/python
+# coding=utf-8
+
+import os
+import random
+import threading
+import time
+import redis
+from flask import request, g, has_request_context
+from redis.client import Pipeline
+from redis.connection import BlockingConnectionPool, UnixDomainSocketConnection
+from . import metrics
+
+'''
+redis连接池;
+1. 连接数上限REDIS_MAX_CONNECTIONS, 连接全部被占用时最多等待REDIS_POOL_TIMEOUT秒, 超时抛出ConnectionError;
+2. 设置REDIS_UNIX_SOCKET时使用unix domain socket连接, 否则使用TCP(REDIS_IP, REDIS_PORT)并可开启keepalive;
+3. 预先fork的服务器(gunicorn等)中, 父进程创建的连接不能在worker之间共享; fork之后子进程重新创建连接池;
+   不支持os.register_at_fork时, 在服务器的post_fork钩子中调用reset();
+4. pool_stats() 返回连接池的使用情况, 包括饱和次数和等待时间;
+5. 客户端记录每次往返的命令和耗时, 见metrics;
+6. 读写分离; 配置REDIS_REPLICAS后get_read_client()返回从库, 每个请求固定使用一个随机的从库, 从库连接失败或超时时改为读主库;
+   请求之外(celery任务, 命令行)总是读主库; 写入之后调用pin_primary(), 该会话REDIS_STICKY_SECONDS秒内都读主库(读己之写),
+   通过cookie记录, 不修改session;
+'''
+
+_config = None
+_client = None
+_replicas = None
+_lock = threading.Lock()
+
+
+class MetricsConnectionPool(BlockingConnectionPool):
+    """
+    BlockingConnectionPool recording checkouts, waits for a free connection and wait time
+    """
+    def reset(self):
+        super(MetricsConnectionPool, self).reset()
+        self._stats_lock = threading.Lock()
+        self.in_use = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.timeouts = 0
+
+    def get_connection(self, command_name, *keys, **options):
+        saturated = self.in_use >= self.max_connections
+        start = time.time()
+        try:
+            connection = super(MetricsConnectionPool, self).get_connection(command_name, *keys, **options)
+        except redis.ConnectionError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        with self._stats_lock:
+            self.in_use += 1
+            self.checkouts += 1
+            if saturated:
+                self.waits += 1
+                self.wait_seconds += time.time() - start
+        return connection
+
+    def release(self, connection):
+        if connection.pid == self.pid:
+            with self._stats_lock:
+                self.in_use -= 1
+        super(MetricsConnectionPool, self).release(connection)
+
+    def stats(self):
+        return {'max_connections': self.max_connections, 'in_use': self.in_use, 'checkouts': self.checkouts,
+                'waits': self.waits, 'wait_seconds': self.wait_seconds, 'timeouts': self.timeouts}
+
+
+class InstrumentedPipeline(Pipeline):
+    def execute(self, raise_on_error=True):
+        commands = [args[0] for args, _ in self.command_stack]
+        start = time.time()
+        try:
+            return super(InstrumentedPipeline, self).execute(raise_on_error)
+        finally:
+            if commands:
+                metrics.observe_redis(commands, time.time() - start, pipeline=True)
+
+
+class InstrumentedRedis(redis.Redis):
+    """
+    redis client recording every round trip in metrics
+    """
+    def execute_command(self, *args, **options):
+        start = time.time()
+        try:
+            return super(InstrumentedRedis, self).execute_command(*args, **options)
+        finally:
+            metrics.observe_redis([args[0]], time.time() - start)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+# 从库不可用: 连接失败或者读取超时(SOCKET_TIMEOUT), 两者在redis-py中没有继承关系
+_REPLICA_ERRORS = (redis.ConnectionError, redis.TimeoutError)
+
+
+class ReplicaPipeline(InstrumentedPipeline):
+    def execute(self, raise_on_error=True):
+        stack = list(self.command_stack)
+        try:
+            return super(ReplicaPipeline, self).execute(raise_on_error)
+        except _REPLICA_ERRORS as e:
+            print('redis replica error, read from primary: {}'.format(e))
+            pipe = get_client().pipeline(self.transaction)
+            pipe.command_stack = stack
+            return pipe.execute(raise_on_error)
+
+
+class ReplicaRedis(InstrumentedRedis):
+    """
+    read only client of a replica, reads from the primary when the replica is unreachable
+    """
+    def execute_command(self, *args, **options):
+        try:
+            return super(ReplicaRedis, self).execute_command(*args, **options)
+        except _REPLICA_ERRORS as e:
+            print('redis replica error, read from primary: {}'.format(e))
+            return get_client().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return ReplicaPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+def create_pool(config, address=None):
+    """
+    config: app.config
+    address: (host, port) of a replica, the primary if None
+    """
+    kwargs = {'db': config['REDIS_DB'], 'password': config['REDIS_PWD'],
+              'max_connections': config['REDIS_MAX_CONNECTIONS'], 'timeout': config['REDIS_POOL_TIMEOUT'],
+              'socket_timeout': config['REDIS_SOCKET_TIMEOUT']}
+    if address is None and config['REDIS_UNIX_SOCKET']:
+        kwargs.update(connection_class=UnixDomainSocketConnection, path=config['REDIS_UNIX_SOCKET'])
+    else:
+        host, port = address if address is not None else (config['REDIS_IP'], config['REDIS_PORT'])
+        kwargs.update(host=host, port=port,
+                      socket_connect_timeout=config['REDIS_CONNECT_TIMEOUT'], socket_keepalive=config['REDIS_KEEPALIVE'])
+    return MetricsConnectionPool(**kwargs)
+
+
+def url(config):
+    """
+    return redis url of config, used by celery broker
+    """
+    password = ':{}@'.format(config['REDIS_PWD']) if config['REDIS_PWD'] else ''
+    if config['REDIS_UNIX_SOCKET']:
+        return 'redis+socket://{0}{1}?virtual_host={2}'.format(password, config['REDIS_UNIX_SOCKET'], config['REDIS_DB'])
+    return 'redis://{0}{1}:{2}/{3}'.format(password, config['REDIS_IP'], config['REDIS_PORT'], config['REDIS_DB'])
+
+
+def init_app(app):
+    """
+    create the redis client of this process from app config
+    """
+    global _config, _client, _replicas
+    with _lock:
+        _config = app.config
+        _client = None
+        _replicas = None
+    get_client()
+
+
+def get_client():
+    global _client
+    if _client is None or _client.connection_pool.pid != os.getpid():
+        with _lock:
+            if _client is None or _client.connection_pool.pid != os.getpid():
+                assert _config is not None, 'redis is used before create_app'
+                _client = InstrumentedRedis(connection_pool=create_pool(_config))
+    return _client
+
+
+def parse_addresses(value):
+    """
+    return list of (host, port) of a comma separated list of host:port
+    """
+    addresses = []
+    for address in (value or '').split(','):
+        address = address.strip()
+        if address:
+            host, _, port = address.rpartition(':')
+            addresses.append((host, int(port)))
+    return addresses
+
+
+def _get_replicas():
+    global _replicas
+    if _replicas is None or (_replicas and _replicas[0].connection_pool.pid != os.getpid()):
+        with _lock:
+            if _replicas is None or (_replicas and _replicas[0].connection_pool.pid != os.getpid()):
+                assert _config is not None, 'redis is used before create_app'
+                _replicas = [ReplicaRedis(connection_pool=create_pool(_config, address))
+                             for address in parse_addresses(_config.get('REDIS_REPLICAS'))]
+    return _replicas
+
+
+def is_pinned():
+    """
+    whether reads of the current request go to the primary because its session wrote recently
+    """
+    if not has_request_context():
+        return False
+    if 'redis_pinned' not in g:
+        until = request.cookies.get(_config['REDIS_STICKY_COOKIE'])
+        try:
+            g.redis_pinned = until is not None and float(until) > time.time()
+        except ValueError:
+            g.redis_pinned = False
+    return g.redis_pinned
+
+
+def pin_primary():
+    """
+    read from the primary for the rest of this request and REDIS_STICKY_SECONDS after it, call it before writes
+    """
+    if has_request_context():
+        g.redis_pinned = True
+        g.redis_wrote = True
+
+
+def get_read_client():
+    """
+    client for reads: a replica of the current request, the primary outside of requests or when pinned
+    """
+    replicas = _get_replicas()
+    if not replicas or not has_request_context() or is_pinned():
+        return get_client()
+    if 'redis_replica' not in g:
+        g.redis_replica = random.randrange(len(replicas))
+    return replicas[g.redis_replica]
+
+
+def _set_sticky_cookie(response):
+    if g.get('redis_wrote'):
+        seconds = _config['REDIS_STICKY_SECONDS']
+        response.set_cookie(_config['REDIS_STICKY_COOKIE'], repr(time.time() + seconds), max_age=seconds,
+                            httponly=True)
+    return response
+
+
+def init_routing(app):
+    app.after_request(_set_sticky_cookie)
+
+
+def reset():
+    """
+    drop the clients inherited from the parent process, call it in the child after fork
+    """
+    global _client, _replicas, _lock
+    # fork时其他线程可能持有锁
+    _lock = threading.Lock()
+    _client = None
+    _replicas = None
+
+
+def pool_stats():
+    """
+    return usage statistics of the connection pool of this process
+    """
+    if _client is None:
+        return {}
+    return _client.connection_pool.stats()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset)
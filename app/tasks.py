@@ -0,0 +1,20 @@
+# !/usr/bin/python
+# coding=utf-8
+
+from flask import current_app
+from . import celery
+from .models import purge_deleted_posts
+
+'''
+celery定时执行的数据维护任务, 在celery_worker中运行(已经push了app context)
+'''
+
+
+@celery.task(ignore_result=True)
+def purge_posts():
+    """
+    reclaim the infomation of deleted posts
+    """
+    total = sum(purge_deleted_posts(current_app.config['POSTS_PURGE_BATCH']))
+    if total:
+        print('purge_posts: {} deleted posts reclaimed'.format(total))
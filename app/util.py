@@ -1,5 +1,7 @@
 # !/usr/bin/python
 # coding=utf-8
+import base64
+import binascii
 
 
 def convert(data):
@@ -11,7 +13,31 @@ def convert(data):
     if isinstance(data, dict):
         return dict(map(convert, data.items()))
     if isinstance(data, tuple):
-        return map(convert, data)
+        return tuple(map(convert, data))
     if isinstance(data, list):
         return list(map(convert, data))
     return data
+
+
+def encode_cursor(score, member):
+    """
+    opaque pagination cursor of a sorted set item
+    """
+    return base64.urlsafe_b64encode('{0!r}:{1}'.format(float(score), member).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    return (score, member) of cursor, None if cursor is missing or invalid
+    """
+    if not cursor:
+        return None
+    try:
+        score, member = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split(':', 1)
+        score = float(score)
+    except (ValueError, UnicodeError, binascii.Error):
+        return None
+    # nan
+    if score != score:
+        return None
+    return score, member
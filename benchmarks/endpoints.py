@@ -0,0 +1,288 @@
+# !/usr/bin/python
+# coding=utf-8
+
+import ipaddress
+import json
+import random
+import shutil
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+import redis
+from app import metrics, purge, redis_pool
+from app.models import register_user, is_email_register, get_user, publish_post, total_posts_by_author, Relation
+from app.data import backend, db_users, shards
+
+'''
+接口压力测试, 使用 python manage.py bench 运行;
+1. 在进程内用Flask测试客户端并发请求各个接口; 测试数据写入临时启动的redis-server(用完即停止),
+   没有安装redis-server时只允许使用回环地址上的redis, 其他redis需要用--target明确指定;
+   运行期间不使用从库和分片, 也不向反向代理发送清除请求;
+2. 首先写入测试数据: 用户bench0..benchN(密码bench), 每个用户的文章, 以及每个用户关注后面的几个用户; 已存在的数据不重复写入;
+3. 统计每个场景的吞吐量, p50/p95/p99延迟, 以及每个请求的redis命令数(来自metrics);
+4. 结果可以保存为json, 之后的运行与其比较, 证明优化是否有效;
+'''
+
+BENCH_PASSWORD = 'bench'
+# 运行期间修改的配置, 结束后恢复
+_TARGET_CONFIG = ('REDIS_UNIX_SOCKET', 'REDIS_IP', 'REDIS_PORT', 'REDIS_DB', 'REDIS_PWD', 'REDIS_REPLICAS',
+                  'REDIS_SHARDS', 'PURGE_URL')
+
+
+class TargetError(Exception):
+    pass
+
+
+def _name(i):
+    return 'bench{}'.format(i)
+
+
+def _email(i):
+    return 'bench{}@example.com'.format(i)
+
+
+def _is_loopback(config):
+    if config['REDIS_UNIX_SOCKET'] or not config['REDIS_IP']:
+        return False
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(config['REDIS_IP'])).is_loopback
+    except (socket.error, ValueError):
+        return False
+
+
+def _configure(app, values):
+    app.config.update(values)
+    redis_pool.init_app(app)
+    shards.init_app(app)
+    purge.init_app(app)
+
+
+@contextmanager
+def target(app, url=None):
+    """
+    point app at the redis the benchmark writes to: url (redis://host:port/db) if given, else a throwaway
+    redis-server, else the configured redis if it is on a loopback address, raise TargetError otherwise
+    replicas, shards and reverse proxy purges are disabled, the config is restored when done
+    """
+    saved = dict((name, app.config.get(name)) for name in _TARGET_CONFIG)
+    values = dict(REDIS_REPLICAS=None, REDIS_SHARDS=None, PURGE_URL=None)
+    server = None
+    if url:
+        kwargs = redis.ConnectionPool.from_url(url).connection_kwargs
+        values.update(REDIS_UNIX_SOCKET=kwargs.get('path'), REDIS_IP=kwargs.get('host'), REDIS_PORT=kwargs.get('port'),
+                      REDIS_DB=kwargs.get('db', 0), REDIS_PWD=kwargs.get('password'))
+    elif shutil.which('redis-server'):
+        from tests import start_redis_server
+        server, port = start_redis_server()
+        values.update(REDIS_UNIX_SOCKET=None, REDIS_IP='127.0.0.1', REDIS_PORT=port, REDIS_DB=0, REDIS_PWD=None)
+    elif not _is_loopback(app.config):
+        raise TargetError('redis-server is not installed and the configured redis {0} is not on a loopback address, '
+                          'rerun with --target to benchmark it'.format(app.config['REDIS_UNIX_SOCKET'] or
+                                                                        app.config['REDIS_IP']))
+    _configure(app, values)
+    try:
+        yield
+    finally:
+        # 缓冲的写入属于测试数据, 在恢复配置之前写入
+        db_users.last_seen_buffer.flush()
+        if server is not None:
+            server.terminate()
+            server.wait()
+        _configure(app, saved)
+
+
+def seed(users, posts, follows):
+    """
+    create bench users, posts per user and follows per user, run in an app context
+    """
+    for i in range(users):
+        if not is_email_register(_email(i)):
+            register_user(_name(i), BENCH_PASSWORD, _email(i))
+        user = get_user(_email(i))
+        if not user.confirmed:
+            backend.users.confirm(user.id)
+        for n in range(total_posts_by_author(user.id), posts):
+            publish_post('bench post {}'.format(n), user.id, '**bench** post {0} of {1}'.format(n, _name(i)), '')
+    for i in range(users):
+        user_id = get_user(_email(i)).id
+        for k in range(1, follows + 1):
+            followed_id = get_user(_email((i + k) % users)).id
+            if followed_id != user_id and not Relation.is_followed(user_id, followed_id):
+                Relation.follow(user_id, followed_id)
+
+
+def _login(client, i):
+    return client.post('/auth/login', data={'email': _email(i), 'password': BENCH_PASSWORD})
+
+
+class Scenario:
+    def __init__(self, name, endpoint, request, login=True, expect=200, check=None):
+        """
+        request: function(client, worker, iteration, users) -> response
+            users: dict with the number of bench users (count), follows per user in seed (follows),
+            user ids of the bench users (ids) and ids of their posts (post_ids)
+        login: log the client of each worker in before running, worker w is logged in as bench user w % count
+        expect: status code of a successful response, others are counted as errors
+        check: function(response, worker, iteration, users) -> False if the request did not do its work
+        """
+        self.name = name
+        self.endpoint = endpoint
+        self.request = request
+        self.login = login
+        self.expect = expect
+        self.check = check
+
+    def succeeded(self, resp, w, i, users):
+        if resp.status_code != self.expect:
+            return False
+        return self.check is None or self.check(resp, w, i, users)
+
+
+def _follow_target(w, i, users):
+    """
+    index of the bench user followed and unfollowed by worker w in iteration i,
+    neither the worker itself nor one of the users it follows in seed
+    """
+    count, follows = users['count'], users['follows']
+    return (w + follows + 1 + i % max(1, count - follows - 1)) % count
+
+
+def _follow_check(following):
+    def check(resp, w, i, users):
+        # 重定向到目标用户的主页(用户不存在时重定向到首页), 并且关注关系已经改变
+        target = _follow_target(w, i, users)
+        if not urlsplit(resp.headers.get('Location', '')).path.endswith('/user/{}'.format(_name(target))):
+            return False
+        return backend.users.is_followed(users['ids'][w % users['count']], users['ids'][target]) == following
+    return check
+
+
+SCENARIOS = [
+    Scenario('index', 'main.index', lambda client, w, i, users: client.get('/')),
+    Scenario('index_page', 'main.index', lambda client, w, i, users: client.get('/?page={}'.format(i % 5 + 1))),
+    Scenario('user', 'main.user',
+             lambda client, w, i, users: client.get('/user/{}'.format(_name(i % users['count'])))),
+    Scenario('post', 'main.post',
+             lambda client, w, i, users: client.get('/post/{}'.format(random.choice(users['post_ids'])))),
+    Scenario('followers', 'main.followers',
+             lambda client, w, i, users: client.get('/followers/{}'.format(_name(i % users['count'])))),
+    Scenario('login', 'auth.login', lambda client, w, i, users: _login(client, i % users['count']),
+             login=False, expect=302),
+    # follow和unfollow使用相同的目标, 依次运行后关注关系恢复原状; 目标循环使用, 再次关注同一用户时不写入
+    Scenario('follow', 'main.follow',
+             lambda client, w, i, users: client.get('/follow/{}'.format(_name(_follow_target(w, i, users)))),
+             expect=302, check=_follow_check(True)),
+    Scenario('unfollow', 'main.unfollow',
+             lambda client, w, i, users: client.get('/unfollow/{}'.format(_name(_follow_target(w, i, users)))),
+             expect=302, check=_follow_check(False)),
+]
+
+
+def _percentile(latencies, p):
+    if not latencies:
+        return 0
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100.0))]
+
+
+def run_scenario(app, scenario, concurrency, requests, users, anonymous=False):
+    """
+    run requests of scenario split over concurrency workers, each with its own client
+    return dict of results
+    """
+    clients = []
+    for w in range(concurrency):
+        client = app.test_client()
+        if scenario.login and not anonymous:
+            _login(client, w % users['count'])
+        clients.append(client)
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def worker(w, count):
+        client = clients[w]
+        local = []
+        failed = 0
+        for i in range(count):
+            start = time.time()
+            resp = scenario.request(client, w, i, users)
+            local.append(time.time() - start)
+            if not scenario.succeeded(resp, w, i, users):
+                failed += 1
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    commands_before = metrics.redis_per_request.totals((scenario.endpoint,))
+    threads = [threading.Thread(target=worker, args=(w, requests // concurrency + (w < requests % concurrency)))
+               for w in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    commands_after = metrics.redis_per_request.totals((scenario.endpoint,))
+    observed = commands_after[0] - commands_before[0]
+    latencies.sort()
+    return {'requests': len(latencies), 'errors': errors[0], 'seconds': elapsed,
+            'throughput': len(latencies) / elapsed if elapsed > 0 else 0,
+            'p50': _percentile(latencies, 50), 'p95': _percentile(latencies, 95), 'p99': _percentile(latencies, 99),
+            'redis_per_request': (commands_after[1] - commands_before[1]) / float(observed) if observed else 0}
+
+
+def run(app, names, concurrency, requests, users=20, posts=10, follows=5, anonymous=False):
+    """
+    seed data and run the scenarios in names (all if empty), return dict name -> results
+    """
+    app.config['WTF_CSRF_ENABLED'] = False
+    with app.app_context():
+        seed(users, posts, follows)
+        user_ids = [get_user(_email(i)).id for i in range(users)]
+        post_ids = []
+        for user_id in user_ids:
+            post_ids.extend(backend.posts.posts_by_author(user_id, 1, posts)[0])
+    scenario_users = {'count': users, 'follows': follows, 'ids': user_ids, 'post_ids': post_ids}
+    results = {}
+    for scenario in SCENARIOS:
+        if names and scenario.name not in names:
+            continue
+        # 预热, 填充各级缓存
+        run_scenario(app, scenario, 1, min(requests, 10), scenario_users, anonymous)
+        results[scenario.name] = run_scenario(app, scenario, concurrency, requests, scenario_users, anonymous)
+    return results
+
+
+def _change(value, base):
+    if not base:
+        return ''
+    return '{0:+.1f}%'.format((value - base) * 100.0 / base)
+
+
+def report(results, baseline=None):
+    """
+    return text table of results, with changes against baseline if given
+    """
+    columns = [('throughput', 'req/s', 1), ('p50', 'p50 ms', 1000), ('p95', 'p95 ms', 1000),
+               ('p99', 'p99 ms', 1000), ('redis_per_request', 'redis/req', 1)]
+    lines = ['{0:<12}{1:>8}{2:>8}'.format('scenario', 'reqs', 'errors') +
+             ''.join('{:>12}'.format(title) for _, title, _ in columns)]
+    for name, result in results.items():
+        lines.append('{0:<12}{1:>8}{2:>8}'.format(name, result['requests'], result['errors']) +
+                     ''.join('{:>12.2f}'.format(result[key] * scale) for key, _, scale in columns))
+        if baseline and name in baseline:
+            lines.append('{0:<12}{1:>8}{2:>8}'.format('  vs base', '', '') +
+                         ''.join('{:>12}'.format(_change(result[key], baseline[name][key])) for key, _, _ in columns))
+    return '\n'.join(lines)
+
+
+def save(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
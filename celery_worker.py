@@ -0,0 +1,10 @@
+# !/usr/bin/python
+# coding=utf-8
+
+# celery worker入口: celery -A celery_worker.celery worker -B
+import os
+from app import celery, create_app
+
+
+app = create_app(os.getenv('CONFIG_NAME') or 'default')
+app.app_context().push()
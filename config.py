@@ -8,14 +8,71 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY')
-    MAIL_SERVER = 'smtp.163.com'  # 电子邮件服务器的主机名或IP地址
-    MAIL_PORT = '25'  # 电子邮件服务器的端口
-    MAIL_USE_TLS = True  # 启用传输层安全
+    MAIL_SERVER = os.environ.get('MAIL_SERVER', 'smtp.163.com')  # 电子邮件服务器的主机名或IP地址
+    MAIL_PORT = int(os.environ.get('MAIL_PORT', 25))  # 电子邮件服务器的端口
+    MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS', '1') == '1'  # 启用传输层安全
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')  # 邮件账户用户名
     MAIL_PASSWORD = os.environ.get('MAIL_PWD')  # 邮件账户的密码
     MAIL_SUBJECT_PREFIX = os.environ.get('MAIL_SUBJECT_PREFIX')
     MAIL_SENDER = os.environ.get('MAIL_SENDER')
     MAIL_ADMIN = os.environ.get('MAIL_ADMIN')
+    MAIL_QUEUE_BATCH = 50  # 每个SMTP连接发送的邮件数
+    MAIL_QUEUE_INTERVAL = 60  # 定时发送队列中邮件的间隔(秒)
+    MAIL_SEND_TIMEOUT = 300  # 取出的邮件超过该时间未发送完成, 重新加入队列(秒)
+    MAIL_MAX_RETRIES = 5  # 发送失败的重试次数
+    MAIL_RETRY_BACKOFF = 30  # 第一次重试的等待时间, 之后每次加倍(秒)
+    CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL')  # 默认使用REDIS_*配置的redis
+    REDIS_UNIX_SOCKET = os.environ.get('REDIS_UNIX_SOCKET')  # unix domain socket路径, 设置后不使用REDIS_IP/REDIS_PORT
+    REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 32))  # 每个进程的最大连接数
+    REDIS_POOL_TIMEOUT = 5  # 连接全部被占用时等待空闲连接的时间(秒)
+    REDIS_SOCKET_TIMEOUT = 5  # 读写超时(秒)
+    REDIS_CONNECT_TIMEOUT = 2  # 建立连接超时(秒)
+    REDIS_KEEPALIVE = True  # TCP keepalive
+    REDIS_REPLICAS = os.environ.get('REDIS_REPLICAS')  # 从库列表 host:port,host:port; 与主库使用相同的DB和密码
+    REDIS_STICKY_SECONDS = 5  # 写入之后该会话读主库的时间(秒), 应大于从库的复制延迟
+    REDIS_STICKY_COOKIE = 'redis_primary'  # 记录读主库截止时间的cookie
+    REDIS_SHARDS = os.environ.get('REDIS_SHARDS')  # 用户和文章数据的分片节点 host:port,host:port; 未设置时不分片
+    SHARD_VNODES = 160  # 每个分片节点在一致性哈希环上的虚拟节点数, 修改后需要reshard
+    STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'redis')  # 用户, 文章和关注关系的存储: redis 或 sql
+    SQL_DATABASE_URI = os.environ.get('SQL_DATABASE_URI',
+                                      'sqlite:///' + os.path.join(basedir, 'blog.db'))  # sqlite或mysql(需要pymysql)
+    SQL_POOL_SIZE = 8  # 每个进程的最大数据库连接数
+    SQL_POOL_TIMEOUT = 5  # 连接全部被占用时等待空闲连接的时间(秒)
+    USER_CACHE_SIZE = 1024  # 进程内用户信息缓存的最大条目数, 0表示关闭缓存
+    USER_CACHE_TTL = 60  # 用户信息缓存的过期时间(秒)
+    LAST_SEEN_THROTTLE = 60  # 每个用户的last_seen在该时间内只更新一次(秒)
+    LAST_SEEN_FLUSH_INTERVAL = 5  # 批量写入last_seen的间隔(秒), 0表示立即写入
+    FEED_FANOUT_THRESHOLD = 1000  # 关注者达到该数量的作者不再推送到关注者时间线, 读取时合并
+    FEED_TIMELINE_SIZE = 800  # 每个时间线保留的文章数
+    POSTS_PURGE_BATCH = 500  # 每次回收已删除文章的数量
+    POSTS_PURGE_INTERVAL = 300  # 定时回收已删除文章的间隔(秒)
+    PAGE_CACHE_ENABLED = os.environ.get('PAGE_CACHE_ENABLED', '0') == '1'  # 缓存匿名用户访问的整个页面
+    PAGE_CACHE_TTL = 60  # 页面缓存的过期时间(秒)
+    PAGE_CACHE_LOCK_TIMEOUT = 5  # 等待其他请求渲染同一页面的最长时间(秒)
+    PAGE_CACHE_POLL_INTERVAL = 0.05  # 等待时检查页面缓存的间隔(秒)
+    CONDITIONAL_GET_ENABLED = os.environ.get('CONDITIONAL_GET_ENABLED', '0') == '1'  # 未登录用户的ETag/304
+    CONDITIONAL_GET_SALT = os.environ.get('CONDITIONAL_GET_SALT', '')  # 修改代码改变了页面时更换, 使所有ETag失效
+    PAGE_VERSION_TTL = 7 * 24 * 60 * 60  # 页面版本号的过期时间(秒)
+    PROXY_CACHE_ENABLED = os.environ.get('PROXY_CACHE_ENABLED', '0') == '1'  # 允许反向代理缓存未登录用户的页面
+    PROXY_CACHE_TTL = 24 * 60 * 60  # 代理缓存页面的时间(s-maxage, 秒), 修改数据时按surrogate key清除
+    SURROGATE_KEY_HEADER = os.environ.get('SURROGATE_KEY_HEADER', 'Surrogate-Key')  # varnish xkey使用xkey
+    PURGE_URL = os.environ.get('PURGE_URL')  # 反向代理的清除地址, 未配置时不清除
+    PURGE_METHOD = os.environ.get('PURGE_METHOD', 'PURGE')
+    PURGE_BATCH_SIZE = 256  # 每个清除请求的最大key数
+    PURGE_INTERVAL = 1  # 合并清除请求的间隔(秒), 0表示立即发送
+    PURGE_TIMEOUT = 5  # 清除请求的超时时间(秒)
+    GZIP_ENABLED = os.environ.get('GZIP_ENABLED', '1') == '1'  # 压缩文本响应, 前面的代理已经压缩时关闭
+    GZIP_MIN_SIZE = 1024  # 小于该长度(字节)的响应不压缩
+    GZIP_LEVEL = 6  # 响应的压缩级别, 预压缩的静态文件使用9
+    STATIC_MAX_AGE = 365 * 24 * 60 * 60  # 带指纹的静态文件的缓存时间(秒)
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # 请求/metrics时Authorization: Bearer的值, 未设置时只按地址限制
+    METRICS_ALLOWED_IPS = os.environ.get('METRICS_ALLOWED_IPS', '')  # 允许访问/metrics的地址, 逗号分隔; 经过反向代理时不要使用
+    METRICS_PUBLISH_INTERVAL = 15  # 每个worker把统计写入redis的间隔(秒), /metrics输出同一主机上所有worker的统计, 0表示只输出当前进程
+    PROFILE_RATE = float(os.environ.get('PROFILE_RATE', 0))  # 抽样分析的请求比例, 0表示只分析带有签名请求头的请求
+    PROFILE_HEADER = 'X-Profile'  # 携带manage.py profile_token签名的请求头
+    PROFILE_FORMAT = os.environ.get('PROFILE_FORMAT', 'pstats')  # pstats 或 collapsed(火焰图折叠栈)
+    PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(basedir, 'profiles'))  # 分析结果的保存目录
+    PROFILE_SAMPLE_INTERVAL = 0.001  # collapsed格式的调用栈采样间隔(秒)
 
     def __init__(self):
         pass
@@ -39,6 +96,7 @@ class TestConfig(Config):
     REDIS_PORT = os.environ.get('REDIS_TEST_PORT')
     REDIS_DB = os.environ.get('REDIS_TEST_DB')
     REDIS_PWD = os.environ.get('REDIS_TEST_PWD')
+    METRICS_PUBLISH_INTERVAL = 0  # 测试中不启动写入统计的线程
 
 config = {
     'development': DevelopmentConfig,
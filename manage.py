@@ -25,5 +25,166 @@ def test():
     unittest.TextTestRunner(verbosity=2).run(tests)
 
 
+@manager.option('-b', '--batch', dest='batch', default=500, type=int, help='members moved per transaction')
+def migrate_follows(batch):
+    """convert follow lists to sorted sets, safe to run while serving"""
+    from app.data import db_users
+    total = 0
+    for key, moved in db_users.migrate_follow_lists(batch):
+        total += moved
+        print('{0}: {1} moved'.format(key, moved))
+    print('follow graph migrated, {} members moved'.format(total))
+
+
+@manager.option('-b', '--batch', dest='batch', default=500, type=int, help='posts moved per transaction')
+def migrate_post_index(batch):
+    """convert post lists to sorted sets scored by publish time, safe to run while serving"""
+    from app.data import db_posts
+    total = 0
+    for key, moved in db_posts.migrate_post_lists(batch):
+        total += moved
+        print('{0}: {1} moved'.format(key, moved))
+    print('post index migrated, {} posts moved'.format(total))
+
+
+@manager.option('-b', '--batch', dest='batch', default=100, type=int, help='users per pipeline')
+def rebuild_feeds(batch):
+    """fill outboxes and timelines from existing posts and follows, safe to run again"""
+    from app.data import db_feed
+    for phase, done in db_feed.backfill(app.config['FEED_FANOUT_THRESHOLD'], app.config['FEED_TIMELINE_SIZE'], batch):
+        print('{0}: {1} users done'.format(phase, done))
+
+
+@manager.option('-b', '--batch', dest='batch', default=500, type=int, help='entries moved per pipeline')
+def split_lookups(batch):
+    """split email.to.id and name.to.id into buckets, safe to run while serving"""
+    from app.data import db_users
+    total = 0
+    for lookup, moved in db_users.split_lookups(batch):
+        total += moved
+        print('{0}: {1} moved'.format(lookup, moved))
+    print('lookups split, {} entries moved'.format(total))
+
+
+@manager.option('-n', '--nodes', dest='nodes', default=None, help='host:port,... of the shards, default REDIS_SHARDS')
+@manager.option('-f', '--from', dest='sources', default=None,
+                help='host:port,... of other nodes holding sharded keys, default the primary')
+@manager.option('-b', '--batch', dest='batch', default=500, type=int, help='keys moved per pipeline')
+@manager.option('--cleanup', dest='cleanup', action='store_true',
+                help='delete keys from the nodes they do not belong to, after the new shards are in use')
+def reshard(nodes, sources, batch, cleanup):
+    """copy sharded keys to their node on the hash ring of the shards"""
+    from app import redis_pool
+    from app.data import shards
+    addresses = redis_pool.parse_addresses(nodes or app.config['REDIS_SHARDS'])
+    if not addresses:
+        print('no shards, set REDIS_SHARDS or --nodes')
+        return
+    if sources is None:
+        sources = '{0}:{1}'.format(app.config['REDIS_IP'], app.config['REDIS_PORT'])
+    total = 0
+    for source, target, count in shards.reshard(addresses, redis_pool.parse_addresses(sources), batch, cleanup):
+        total += count
+        print('{0} -> {1}: {2} {3}'.format(source, target, count, 'deleted' if cleanup else 'copied'))
+    print('{0} keys {1}'.format(total, 'deleted' if cleanup else 'copied'))
+
+
+@manager.option('-b', '--batch', dest='batch', default=100, type=int, help='posts rendered per round trip')
+def rerender_posts(batch):
+    """render the html of all posts again from their markdown source"""
+    from app.models import rerender_posts as rerender
+    total = 0
+    for count in rerender(batch):
+        total += count
+        print('{} posts rendered'.format(total))
+
+
+@manager.option('-b', '--batch', dest='batch', default=500, type=int, help='posts reclaimed per round trip')
+def purge_posts(batch):
+    """reclaim the infomation of deleted posts"""
+    from app.models import purge_deleted_posts
+    total = 0
+    for count in purge_deleted_posts(batch):
+        total += count
+        print('{} deleted posts reclaimed'.format(total))
+
+
+@manager.command
+def build_static():
+    """write fingerprinted, gzip compressed copies of static files, run it on every deploy before starting workers"""
+    from app import assets
+    for filename, target in sorted(assets.build(app.static_folder).items()):
+        print('{0} -> {1}/{2}'.format(filename, assets.DIST, target))
+
+
+@manager.option('-e', '--expiration', dest='expiration', default=3600, type=int, help='seconds the token is valid')
+def profile_token(expiration):
+    """print the header making requests profiled"""
+    from app.profiler import generate_token
+    print('{0}: {1}'.format(app.config['PROFILE_HEADER'], generate_token(app.config['SECRET_KEY'], expiration)))
+
+
+@manager.option('-f', '--file', dest='path', default='migration/appendonly.aof', help='AOF file to load')
+@manager.option('-b', '--batch', dest='batch', default=10000, type=int, help='commands per pipeline')
+@manager.option('--db', dest='source_db', default=0, type=int, help='database of the AOF to load')
+@manager.option('-t', '--target', dest='target', required=True, help='redis url to load into, redis://host:port/db')
+@manager.option('--allow-flush', dest='allow_flush', action='store_true', help='replay FLUSHDB and FLUSHALL of the AOF')
+def import_aof(path, batch, source_db, target, allow_flush):
+    """replay an AOF file into redis in pipelined batches"""
+    import redis
+    from app.data import transfer
+    client = redis.Redis.from_url(target)
+    if not allow_flush:
+        # 在发送任何命令之前检查, 不会只导入一部分
+        with open(path, 'rb') as f:
+            flushes = transfer.count_flushes(transfer.parse_aof(f), source_db)
+        if flushes:
+            print('{0} has {1} FLUSHDB/FLUSHALL in db {2} which would empty {3}, '
+                  'rerun with --allow-flush to replay them'.format(path, flushes, source_db, target))
+            return
+    size = os.path.getsize(path)
+    total = errors = 0
+    with open(path, 'rb') as f:
+        for sent, failed in transfer.replay(transfer.parse_aof(f), client, batch, source_db, allow_flush):
+            total += sent
+            errors += failed
+            print('{0} commands replayed, {1} errors, {2:.1f}%'.format(total, errors, f.tell() * 100.0 / size))
+    print('{0} replayed, {1} commands, {2} errors'.format(path, total, errors))
+
+
+@manager.option('-o', '--output', dest='path', default='blog.jsonl', help='json lines file to write')
+@manager.option('-b', '--batch', dest='batch', default=500, type=int, help='keys read per pipeline')
+@manager.option('--with-passwords', dest='passwords', action='store_true', help='include password hashes of users')
+def export_jsonl(path, batch, passwords):
+    """export users, posts and the follow graph as json lines"""
+    from app.data import transfer
+    with open(path, 'w') as f:
+        for record_type, count in transfer.export_keyspace(f, batch, passwords):
+            print('{0}: {1} exported'.format(record_type, count))
+
+
+@manager.option('-c', '--concurrency', dest='concurrency', default=4, type=int, help='concurrent clients')
+@manager.option('-n', '--requests', dest='requests', default=200, type=int, help='requests per scenario')
+@manager.option('-s', '--scenario', dest='scenarios', action='append', default=[], help='scenario to run, default all')
+@manager.option('-u', '--users', dest='users', default=20, type=int, help='bench users to seed')
+@manager.option('-a', '--anonymous', dest='anonymous', action='store_true', help='read pages without logging in')
+@manager.option('--save', dest='save', default=None, help='save results to a json file')
+@manager.option('--baseline', dest='baseline', default=None, help='compare with results saved by --save')
+@manager.option('-t', '--target', dest='target', default=None,
+                help='redis url to seed and benchmark, redis://host:port/db, default a throwaway redis-server')
+def bench(concurrency, requests, scenarios, users, anonymous, save, baseline, target):
+    """benchmark the endpoints against a throwaway redis-server or --target, seeds bench users"""
+    from benchmarks import endpoints
+    try:
+        with endpoints.target(app, target):
+            results = endpoints.run(app, scenarios, concurrency, requests, users=users, anonymous=anonymous)
+    except endpoints.TargetError as e:
+        print(e)
+        return
+    print(endpoints.report(results, endpoints.load(baseline) if baseline else None))
+    if save:
+        endpoints.save(results, save)
+
+
 if __name__ == '__main__':
     manager.run()
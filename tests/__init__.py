@@ -1,2 +1,77 @@
 # !/usr/bin/python
-# coding=utf-8
\ No newline at end of file
+# coding=utf-8
+
+import os
+import shutil
+import socket
+import subprocess
+import time
+import unittest
+
+# config读取的环境变量, 在导入app之前设置
+for name, value in [('SECRET_KEY', 'test'), ('REDIS_DEV_DB', '0'), ('REDIS_TEST_DB', '0'),
+                    ('MAIL_SENDER', 'test@example.com'), ('MAIL_ADMIN', 'admin@example.com'),
+                    ('MAIL_SUBJECT_PREFIX', '[Blog] ')]:
+    os.environ.setdefault(name, value)
+
+from app import redis_pool
+
+'''
+测试使用的redis; 启动临时的redis-server, 没有redis-server时使用fakeredis, 都没有时跳过;
+'''
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_redis_server():
+    """
+    start a redis-server without persistence on a free port, return (process, port)
+    """
+    port = free_port()
+    server = subprocess.Popen(['redis-server', '--port', str(port), '--save', '', '--appendonly', 'no'],
+                              stdout=subprocess.DEVNULL)
+    for _ in range(50):
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.1).close()
+            return server, port
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError('redis-server did not start')
+
+
+class RedisServer:
+    def __init__(self):
+        self.server = None
+        self._create_pool = None
+
+    def start(self, app):
+        if shutil.which('redis-server'):
+            self.server, port = start_redis_server()
+            app.config.update(REDIS_UNIX_SOCKET=None, REDIS_IP='127.0.0.1', REDIS_PORT=port, REDIS_DB=0,
+                              REDIS_PWD=None)
+            redis_pool.init_app(app)
+            return
+        try:
+            import fakeredis
+        except ImportError:
+            raise unittest.SkipTest('neither redis-server nor fakeredis is available')
+        server = fakeredis.FakeServer()
+        self._create_pool = redis_pool.create_pool
+        redis_pool.create_pool = lambda config, address=None: redis_pool.MetricsConnectionPool(
+            connection_class=fakeredis.FakeConnection, server=server, max_connections=config['REDIS_MAX_CONNECTIONS'])
+        redis_pool.init_app(app)
+
+    def stop(self):
+        if self.server is not None:
+            self.server.terminate()
+            self.server.wait()
+        elif self._create_pool is not None:
+            redis_pool.create_pool = self._create_pool
+        redis_pool.reset()
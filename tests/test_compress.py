@@ -0,0 +1,94 @@
+# !/usr/bin/python
+# coding=utf-8
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+from app import assets
+from app.compress import GzipMiddleware
+
+'''
+gzip中间件的压缩条件和流式压缩, 以及静态文件的构建;
+'''
+
+PAGE = b'<p>' + b'a long post body ' * 200 + b'</p>'
+
+
+def _wsgi_app(chunks, headers):
+    def app(environ, start_response):
+        start_response('200 OK', list(headers))
+        return iter(chunks)
+    return app
+
+
+def _request(app, accept_encoding='gzip, deflate'):
+    """
+    return (headers dict, list of body chunks)
+    """
+    result = {}
+
+    def start_response(status, headers, exc_info=None):
+        result.update(headers)
+    environ = {'REQUEST_METHOD': 'GET', 'HTTP_ACCEPT_ENCODING': accept_encoding}
+    body = GzipMiddleware(app, min_size=1024)(environ, start_response)
+    chunks = list(body)
+    return result, chunks
+
+
+class GzipMiddlewareTestCase(unittest.TestCase):
+    def test_compressed(self):
+        headers, chunks = _request(_wsgi_app([PAGE], [('Content-Type', 'text/html; charset=utf-8'),
+                                                      ('Content-Length', str(len(PAGE))), ('ETag', '"abc"')]))
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', headers)
+        self.assertEqual(headers['ETag'], 'W/"abc"')
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(gzip.decompress(b''.join(chunks)), PAGE)
+
+    def test_small_or_not_accepted(self):
+        for chunks, accept_encoding in [([b'<p>short</p>'], 'gzip'), ([PAGE], 'identity'), ([PAGE], 'gzip;q=0')]:
+            headers, body = _request(_wsgi_app(chunks, [('Content-Type', 'text/html')]), accept_encoding)
+            self.assertNotIn('Content-Encoding', headers)
+            self.assertEqual(b''.join(body), b''.join(chunks))
+
+    def test_not_compressible(self):
+        headers, body = _request(_wsgi_app([PAGE], [('Content-Type', 'image/png')]))
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertNotIn('Vary', headers)
+
+    def test_streamed(self):
+        parts = [PAGE[i:i + 500] for i in range(0, len(PAGE), 500)]
+        headers, chunks = _request(_wsgi_app(parts, [('Content-Type', 'text/html'), ('Vary', 'Cookie')]))
+        self.assertEqual(headers['Vary'], 'Cookie, Accept-Encoding')
+        # 每一块压缩后立即可以解压, 不等待响应结束
+        decompressor = zlib.decompressobj(31)
+        self.assertTrue(PAGE.startswith(decompressor.decompress(chunks[0])))
+        self.assertGreater(len(chunks), 2)
+        self.assertEqual(gzip.decompress(b''.join(chunks)), PAGE)
+
+
+class BuildStaticTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        with open(os.path.join(self.folder, 'styles.css'), 'wb') as f:
+            f.write(b'.post { margin: 0; }\n' * 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_build(self):
+        manifest = assets.build(self.folder)
+        target = manifest['styles.css']
+        self.assertRegex(target, r'^styles\.[0-9a-f]{12}\.css$')
+        with open(os.path.join(self.folder, 'dist', target + '.gz'), 'rb') as f:
+            self.assertEqual(gzip.decompress(f.read()), b'.post { margin: 0; }\n' * 100)
+        # 再次构建时跳过dist, 结果不变
+        self.assertEqual(assets.build(self.folder), manifest)
+        self.assertEqual(assets.load_manifest(self.folder), manifest)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+# !/usr/bin/python
+# coding=utf-8
+
+import socketserver
+import threading
+import time
+import unittest
+from app import create_app, rd
+from app.data import db_mail
+from app.email import send_mail, send_queued_mail
+from . import RedisServer
+
+'''
+邮件队列的发送和重试, 使用本地的调试SMTP服务器;
+'''
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.reply('220 localhost debugging server')
+        while True:
+            line = self.rfile.readline().decode('utf-8').strip()
+            command = line[:4].upper()
+            if not line or command == 'QUIT':
+                self.reply('221 bye')
+                return
+            if command == 'RCPT' and self.server.reject:
+                self.reply('550 mailbox unavailable')
+            elif command == 'DATA':
+                self.reply('354 end data with <CR><LF>.<CR><LF>')
+                lines = []
+                while True:
+                    data = self.rfile.readline()
+                    if data in (b'.\r\n', b''):
+                        break
+                    lines.append(data)
+                self.server.messages.append(b''.join(lines))
+                self.reply('250 ok')
+            else:
+                self.reply('250 ok')
+
+
+class _SMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MailQueueTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.smtp = _SMTPServer(('127.0.0.1', 0), _SMTPHandler)
+        cls.smtp.messages = []
+        cls.smtp.reject = False
+        thread = threading.Thread(target=cls.smtp.serve_forever)
+        thread.daemon = True
+        thread.start()
+        cls.app = create_app('testing')
+        # 重试立即到期; broker地址不可用, 通知worker失败
+        cls.app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=cls.smtp.server_address[1], MAIL_USE_TLS=False,
+                              MAIL_USERNAME=None, MAIL_PASSWORD=None, MAIL_SUPPRESS_SEND=False, MAIL_DEBUG=False,
+                              MAIL_RETRY_BACKOFF=0, MAIL_MAX_RETRIES=1, SERVER_NAME='localhost')
+        cls.app.extensions['mail'].suppress = False
+        cls.app.extensions['mail'].server = '127.0.0.1'
+        cls.app.extensions['mail'].port = cls.smtp.server_address[1]
+        cls.app.extensions['mail'].use_tls = False
+        cls.redis = RedisServer()
+        cls.redis.start(cls.app)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.redis.stop()
+        cls.smtp.shutdown()
+        cls.smtp.server_close()
+
+    def setUp(self):
+        self.context = self.app.test_request_context()
+        self.context.push()
+        rd.delete(db_mail.MAIL_QUEUE, db_mail.MAIL_INFLIGHT, db_mail.MAIL_RETRY, db_mail.MAIL_FAILED)
+        self.smtp.messages = []
+        self.smtp.reject = False
+
+    def tearDown(self):
+        self.context.pop()
+
+    def send(self):
+        start = time.time()
+        send_mail('reader@example.com', 'Confirm Your Account', 'auth/email/confirm',
+                  user=type('User', (), {'username': 'reader'}), token='token')
+        # 请求中只写入队列, 不等待SMTP服务器和broker
+        self.assertLess(time.time() - start, 2)
+
+    def test_send(self):
+        self.send()
+        self.assertEqual(rd.llen(db_mail.MAIL_QUEUE), 1)
+        self.assertEqual(self.smtp.messages, [])
+        send_queued_mail()
+        self.assertEqual(len(self.smtp.messages), 1)
+        self.assertIn(b'reader@example.com', self.smtp.messages[0])
+        self.assertEqual(rd.llen(db_mail.MAIL_QUEUE) + rd.zcard(db_mail.MAIL_INFLIGHT), 0)
+
+    def test_retry(self):
+        self.send()
+        self.smtp.reject = True
+        send_queued_mail()
+        self.assertEqual(rd.zcard(db_mail.MAIL_RETRY), 1)
+        self.smtp.reject = False
+        send_queued_mail()
+        self.assertEqual(len(self.smtp.messages), 1)
+        self.assertEqual(rd.zcard(db_mail.MAIL_RETRY) + rd.zcard(db_mail.MAIL_INFLIGHT), 0)
+
+    def test_failed(self):
+        self.send()
+        self.smtp.reject = True
+        send_queued_mail()
+        send_queued_mail()
+        self.assertEqual(rd.llen(db_mail.MAIL_FAILED), 1)
+        self.assertEqual(rd.zcard(db_mail.MAIL_RETRY) + rd.llen(db_mail.MAIL_QUEUE), 0)
+        self.assertEqual(self.smtp.messages, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+# !/usr/bin/python
+# coding=utf-8
+
+import json
+import os
+import unittest
+from app import create_app, metrics, redis_pool
+from . import RedisServer
+
+'''
+/metrics的访问限制和多个worker的统计汇总;
+'''
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.redis = RedisServer()
+        self.redis.start(self.app)
+        self.config = dict(metrics._config)
+        metrics._config.update(token=None, allowed_ips=[], publish_interval=0)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        metrics._config.clear()
+        metrics._config.update(self.config)
+        self.redis.stop()
+
+    def test_forbidden(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        metrics._config['token'] = 'secret'
+        self.assertEqual(self.client.get('/metrics', headers={'Authorization': 'Bearer other'}).status_code, 403)
+
+    def test_token(self):
+        metrics._config['token'] = 'secret'
+        resp = self.client.get('/metrics', headers={'Authorization': 'Bearer secret'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('pid="{}"'.format(os.getpid()), resp.get_data(as_text=True))
+
+    def test_allowed_ips(self):
+        metrics._config['allowed_ips'] = ['127.0.0.1']
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+    def test_workers(self):
+        metrics._config.update(allowed_ips=['127.0.0.1'], publish_interval=15)
+        other = {'redis_commands_total': [[['main.index', 'GET'], 7]], 'redis_pool': {'in_use': 2}}
+        redis_pool.get_client().set(metrics._worker_key(1), json.dumps(other))
+        text = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('redis_commands_total{pid="1",endpoint="main.index",command="GET"} 7', text)
+        self.assertIn('redis_pool_in_use{pid="1"} 2', text)
+        self.assertEqual(text.count('# TYPE redis_commands_total counter'), 1)
+        # 当前进程的统计也写入了redis
+        self.assertTrue(redis_pool.get_client().exists(metrics._worker_key(os.getpid())))
@@ -0,0 +1,65 @@
+# !/usr/bin/python
+# coding=utf-8
+
+import unittest
+from app import create_app, rd
+from app.data import db_posts
+from app.models import purge_deleted_posts
+from . import RedisServer
+
+'''
+旧版本的文章列表(posts:list, posts:author:id)的迁移, 以及迁移前后回收已删除的文章;
+'''
+
+
+class LegacyPostsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.redis = RedisServer()
+        self.redis.start(self.app)
+        self.context = self.app.app_context()
+        self.context.push()
+        # 旧版本的数据: 文章1..4属于作者1, 删除文章2时只从posts:list中LREM
+        for post_id in range(1, 5):
+            rd.hmset('post:{}'.format(post_id), {'post_id': post_id, 'author_id': 1, 'title': 'post {}'.format(post_id),
+                                                 'time': '2016-01-0{} 00:00:00'.format(post_id)})
+            rd.lpush('posts:author:1', post_id)
+            if post_id != 2:
+                rd.lpush('posts:list', post_id)
+        rd.lpush('posts:del_list', 2)
+        # 文章5被旧版本删除并且已经回收: 散列不存在, 只留在作者列表中
+        rd.lpush('posts:author:1', 5)
+        rd.set('posts:count', 5)
+
+    def tearDown(self):
+        self.context.pop()
+        self.redis.stop()
+
+    def migrate(self):
+        return dict((key, moved) for key, moved in db_posts.migrate_post_lists(2))
+
+    def test_purge_before_migration(self):
+        # posts:by_time还不存在, 不能把其中没有的文章当作已删除
+        self.assertIsNone(db_posts.purge_deleted(10))
+        self.assertEqual(sum(purge_deleted_posts(10)), 0)
+        self.assertEqual(db_posts.deleted_count(), 1)
+        self.assertTrue(rd.exists('post:1'))
+        self.assertEqual(self.migrate(), {'posts:list': 3, 'posts:author:1': 5})
+        self.assertEqual(sum(purge_deleted_posts(10)), 1)
+        self.assertFalse(rd.exists('post:2'))
+        self.assertEqual(db_posts.posts_by_author(1, 1, 10)[0], ['4', '3', '1'])
+
+    def test_migrate_skips_deleted(self):
+        self.migrate()
+        self.assertEqual(rd.hget('post:2', 'deleted'), b'1')
+        self.assertFalse(rd.exists('post:5'))
+        self.assertEqual(db_posts.posts_by_page(1, 10)[0], ['4', '3', '1'])
+        self.assertEqual(db_posts.posts_by_author(1, 1, 10)[0], ['4', '3', '1'])
+        self.assertIsNone(rd.zscore('posts:by_author:1', 5))
+        # 中断后重新执行: 删除列表已经被回收, 之前的迁移加入的文章2也被删除
+        rd.zadd('posts:by_author:1', 2, 0)
+        rd.lpush('posts:author:1', 2, 5)
+        self.assertEqual(sum(purge_deleted_posts(10)), 1)
+        self.migrate()
+        self.assertEqual(db_posts.posts_by_author(1, 1, 10)[0], ['4', '3', '1'])
+        self.assertEqual(rd.zcard('posts:by_author:1'), 3)
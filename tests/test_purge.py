@@ -0,0 +1,78 @@
+# !/usr/bin/python
+# coding=utf-8
+
+import threading
+import unittest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from flask import Flask
+from app import purge
+
+'''
+清除请求的合并和重试, 使用本地的HTTP服务器代替反向代理;
+'''
+
+
+class _PurgeHandler(BaseHTTPRequestHandler):
+    def do_PURGE(self):
+        self.server.received.append((self.command, self.headers['Surrogate-Key']))
+        self.send_response(self.server.status)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class PurgeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), _PurgeHandler)
+        self.server.received = []
+        self.server.status = 200
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        app = Flask(__name__)
+        # 后台线程不会在测试期间发送, 由测试调用flush
+        app.config.update(PURGE_URL='http://127.0.0.1:{}/'.format(self.server.server_port), PURGE_METHOD='PURGE',
+                          SURROGATE_KEY_HEADER='Surrogate-Key', PURGE_BATCH_SIZE=2, PURGE_TIMEOUT=5,
+                          PURGE_INTERVAL=60)
+        purge.init_app(app)
+
+    def tearDown(self):
+        purge.purge_buffer.configure(0, 0)
+        purge._config.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_surrogate_keys(self):
+        self.assertEqual(purge.surrogate_keys(['index', 'user:3', 'post:12']), ['index', 'author-3', 'post-12'])
+
+    def test_batched(self):
+        purge.purge(['index', 'user:3'])
+        purge.purge(['post:12', 'user:3', 'index'])
+        self.assertEqual(self.server.received, [])
+        self.assertEqual(purge.purge_buffer.flush(), 3)
+        self.assertEqual(self.server.received, [('PURGE', 'index author-3'), ('PURGE', 'post-12')])
+
+    def test_retry(self):
+        self.server.status = 503
+        purge.purge(['post:12'])
+        self.assertEqual(purge.purge_buffer.flush(), 0)
+        self.server.status = 200
+        purge.purge(['post:13'])
+        self.assertEqual(purge.purge_buffer.flush(), 2)
+        self.assertEqual(set(self.server.received[-1][1].split()), {'post-12', 'post-13'})
+
+    def test_immediate_retry(self):
+        purge.purge_buffer.configure(0, 0)
+        self.server.status = 503
+        # 立即发送失败时不影响调用者, 保留到下一次清除
+        purge.purge(['post:12'])
+        self.assertEqual(len(purge.purge_buffer), 1)
+        self.server.status = 200
+        purge.purge(['post:13'])
+        self.assertEqual(len(purge.purge_buffer), 0)
+        self.assertEqual(set(self.server.received[-1][1].split()), {'post-12', 'post-13'})
+
+
+if __name__ == '__main__':
+    unittest.main()
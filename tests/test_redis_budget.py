@@ -0,0 +1,110 @@
+# !/usr/bin/python
+# coding=utf-8
+
+import unittest
+from app import create_app, metrics
+from app.data import db_users
+from app.models import register_user, get_user, publish_post, Relation, POST_NUM_PAGE
+from . import RedisServer
+
+'''
+每个页面的redis命令数和往返次数预算, 重新引入逐条查询(N+1)时测试失败;
+启动临时的redis-server, 没有redis-server时使用fakeredis, 都没有时跳过;
+往返次数和命令数来自metrics的统计; 每个请求之前清空用户缓存, 预算是缓存未命中时的代价;
+'''
+
+
+class RedisBudgetTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app('testing')
+        cls.app.config.update(WTF_CSRF_ENABLED=False, PAGE_CACHE_ENABLED=False)
+        cls.redis = RedisServer()
+        cls.redis.start(cls.app)
+        # 请求会复用已经存在的app context(以及其中的g), 只在写入数据时push
+        # 多个作者和多个粉丝, 逐条查询时命令数随之增加
+        with cls.app.app_context():
+            names = ['author', 'reader', 'other'] + ['fan{}'.format(i) for i in range(5)]
+            for name in names:
+                register_user(name, 'pw', '{}@example.com'.format(name))
+                db_users.confirm(get_user('{}@example.com'.format(name)).id)
+            user_ids = [get_user('{}@example.com'.format(name)).id for name in names]
+            for follower_id in user_ids[1:2] + user_ids[3:]:
+                Relation.follow(follower_id, user_ids[0])
+            Relation.follow(user_ids[1], user_ids[2])
+            # 与运行中的服务器相同, 脚本已经加载
+            Relation.unfollow(user_ids[1], user_ids[2])
+            Relation.follow(user_ids[1], user_ids[2])
+            for n in range(POST_NUM_PAGE * 2):
+                cls.last_post = publish_post('post {}'.format(n), user_ids[n % 3], 'body **{}**'.format(n), '')
+
+    @classmethod
+    def tearDownClass(cls):
+        db_users.last_seen_buffer.flush()
+        cls.redis.stop()
+
+    def setUp(self):
+        self.client = self.app.test_client()
+
+    def login(self, email):
+        resp = self.client.post('/auth/login', data={'email': email, 'password': 'pw'})
+        self.assertEqual(resp.status_code, 302)
+
+    def measure(self, path, headers=None):
+        """
+        return (response, round trips, commands) of requesting path
+        """
+        endpoint = self.app.url_map.bind('localhost').match(path.split('?')[0])[0]
+        db_users.user_cache.clear()
+        trips = metrics.redis_roundtrip.totals((endpoint,))[0]
+        commands = metrics.redis_per_request.totals((endpoint,))[1]
+        resp = self.client.get(path, headers=headers)
+        return (resp, metrics.redis_roundtrip.totals((endpoint,))[0] - trips,
+                metrics.redis_per_request.totals((endpoint,))[1] - commands)
+
+    def assertBudget(self, path, max_trips, max_commands, status=200, headers=None):
+        resp, trips, commands = self.measure(path, headers)
+        self.assertEqual(resp.status_code, status)
+        self.assertLessEqual(trips, max_trips, '{0}: {1} round trips'.format(path, trips))
+        self.assertLessEqual(commands, max_commands, '{0}: {1} commands'.format(path, commands))
+
+    def test_index(self):
+        # 文章索引, 文章管道, 作者管道(3个作者), 文章总数
+        self.assertBudget('/', 4, POST_NUM_PAGE + 5)
+        self.assertBudget('/?page=2', 4, POST_NUM_PAGE + 5)
+
+    def test_index_followed(self):
+        self.login('reader@example.com')
+        self.client.get('/followed')
+        # 当前用户, 时间线和大V集合, 文章管道, 作者管道
+        self.assertBudget('/', 4, POST_NUM_PAGE + 5)
+
+    def test_user(self):
+        # 用户名, 用户, 文章索引, 文章管道, 文章数, 粉丝数, 关注数
+        self.assertBudget('/user/author', 7, 13)
+
+    def test_post(self):
+        self.assertBudget('/post/{}'.format(self.last_post), 2, 2)
+
+    def test_not_modified(self):
+        self.app.config['CONDITIONAL_GET_ENABLED'] = True
+        try:
+            # 只读取作者或用户ID和版本号, 不读取文章
+            for path, max_trips in [('/post/{}'.format(self.last_post), 2), ('/user/author', 3), ('/', 1)]:
+                etag = self.client.get(path).headers['ETag']
+                self.assertBudget(path, max_trips, max_trips, status=304, headers={'If-None-Match': etag})
+        finally:
+            self.app.config['CONDITIONAL_GET_ENABLED'] = False
+
+    def test_followers(self):
+        # 用户名, 用户, 粉丝索引, 粉丝管道(6个粉丝), 粉丝数
+        self.assertBudget('/followers/author', 5, 10)
+
+    def test_follow_unfollow(self):
+        self.login('other@example.com')
+        self.assertBudget('/follow/author', 6, 8, status=302)
+        self.assertBudget('/unfollow/author', 7, 10, status=302)
+
+
+if __name__ == '__main__':
+    unittest.main()
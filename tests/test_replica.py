@@ -0,0 +1,47 @@
+# !/usr/bin/python
+# coding=utf-8
+
+import socket
+import unittest
+import redis
+from app import create_app, redis_pool
+from . import RedisServer, free_port
+
+'''
+从库不可用时改为读主库; 从库是只监听不回复的端口(读取超时)或者没有监听的端口(连接失败);
+'''
+
+
+class ReplicaFallbackTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.redis = RedisServer()
+        self.redis.start(self.app)
+        redis_pool.get_client().set('key', 'primary')
+        # 连接在backlog中完成, 请求没有回复
+        self.silent = socket.socket()
+        self.silent.bind(('127.0.0.1', 0))
+        self.silent.listen(8)
+
+    def tearDown(self):
+        self.silent.close()
+        self.redis.stop()
+
+    def replica(self, port):
+        return redis_pool.ReplicaRedis(connection_pool=redis.ConnectionPool(host='127.0.0.1', port=port,
+                                                                            socket_timeout=0.2,
+                                                                            socket_connect_timeout=0.2))
+
+    def test_timeout(self):
+        replica = self.replica(self.silent.getsockname()[1])
+        self.assertEqual(replica.get('key'), b'primary')
+        pipe = replica.pipeline(transaction=False)
+        pipe.get('key')
+        self.assertEqual(pipe.execute(), [b'primary'])
+
+    def test_unreachable(self):
+        replica = self.replica(free_port())
+        self.assertEqual(replica.get('key'), b'primary')
+        pipe = replica.pipeline(transaction=False)
+        pipe.get('key')
+        self.assertEqual(pipe.execute(), [b'primary'])
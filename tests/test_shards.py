@@ -0,0 +1,61 @@
+# !/usr/bin/python
+# coding=utf-8
+
+import shutil
+import unittest
+from app import create_app, rd
+from app.data import shards, db_posts
+from app.models import register_user, get_user, publish_post
+from . import RedisServer, start_redis_server
+
+'''
+reshard在真实的节点之间复制key; 主库和两个分片节点都是临时启动的redis-server;
+DUMP/RESTORE只有redis-server支持, 没有redis-server时跳过;
+'''
+
+
+class ReshardTestCase(unittest.TestCase):
+    def setUp(self):
+        if not shutil.which('redis-server'):
+            raise unittest.SkipTest('reshard uses DUMP/RESTORE, which needs redis-server')
+        self.app = create_app('testing')
+        self.redis = RedisServer()
+        self.redis.start(self.app)
+        self.nodes = [start_redis_server() for _ in range(2)]
+        self.addresses = [('127.0.0.1', port) for _, port in self.nodes]
+        self.context = self.app.app_context()
+        self.context.push()
+        register_user('author', 'pw', 'author@example.com')
+        self.author_id = get_user('author@example.com').id
+        self.post_ids = [publish_post('post {}'.format(n), self.author_id, 'body {}'.format(n), '') for n in range(5)]
+        rd.pexpire('post:{}'.format(self.post_ids[0]), 600000)
+
+    def tearDown(self):
+        self.app.config['REDIS_SHARDS'] = None
+        shards.init_app(self.app)
+        self.context.pop()
+        for server, _ in self.nodes:
+            server.terminate()
+            server.wait()
+        self.redis.stop()
+
+    def reshard(self, cleanup=False):
+        primary = [(self.app.config['REDIS_IP'], self.app.config['REDIS_PORT'])]
+        return sum(count for _, _, count in shards.reshard(self.addresses, primary, 2, cleanup))
+
+    def test_reshard(self):
+        sharded = [key.decode() for key in rd.keys() if shards.is_sharded(key.decode())]
+        self.assertEqual(self.reshard(), len(sharded))
+        # 再次执行时覆盖已经复制的key
+        self.assertEqual(self.reshard(), len(sharded))
+        self.app.config['REDIS_SHARDS'] = ','.join('{0}:{1}'.format(*address) for address in self.addresses)
+        shards.init_app(self.app)
+        for key in sharded:
+            self.assertEqual(shards.node(key).type(key), rd.type(key))
+        ttl = shards.node('post:{}'.format(self.post_ids[0])).pttl('post:{}'.format(self.post_ids[0]))
+        self.assertTrue(0 < ttl <= 600000)
+        self.assertEqual(db_posts.get_post(self.post_ids[1])['title'], 'post 1')
+        self.assertEqual(len(db_posts.posts_by_author(self.author_id, 1, 10)[0]), 5)
+        self.assertEqual(self.reshard(cleanup=True), len(sharded))
+        self.assertFalse([key for key in rd.keys() if shards.is_sharded(key.decode())])
+        self.assertEqual(db_posts.get_post(self.post_ids[1])['title'], 'post 1')
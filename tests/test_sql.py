@@ -0,0 +1,101 @@
+# !/usr/bin/python
+# coding=utf-8
+
+import os
+import shutil
+import tempfile
+import unittest
+from app import create_app
+from app.data import backend, sql, sql_users, sql_posts
+from app.models import rerender_posts
+
+'''
+关系数据库后端, 使用临时目录中的sqlite数据库, 不需要redis;
+'''
+
+
+class SqlBackendTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = create_app('testing')
+        self.app.config.update(STORAGE_BACKEND='sql',
+                               SQL_DATABASE_URI='sqlite:///' + os.path.join(self.directory, 'blog.db'),
+                               PAGE_CACHE_ENABLED=False, CONDITIONAL_GET_ENABLED=False, LAST_SEEN_FLUSH_INTERVAL=0,
+                               LAST_SEEN_THROTTLE=0)
+        backend.init_app(self.app)
+        self.context = self.app.app_context()
+        self.context.push()
+        self.user_ids = [sql_users.reg_user(name, 'pw', name + '@example.com', 1) for name in ('a', 'b', 'c')]
+
+    def tearDown(self):
+        self.context.pop()
+        self.app.config['STORAGE_BACKEND'] = 'redis'
+        backend.init_app(self.app)
+        shutil.rmtree(self.directory)
+
+    def test_reg_user(self):
+        self.assertEqual(self.user_ids, [1, 2, 3])
+        self.assertEqual(sql_users.reg_user('a', 'pw', 'other@example.com', 1), 0)
+        self.assertEqual(sql_users.reg_user('other', 'pw', 'a@example.com', 1), 0)
+        self.assertEqual(sql_users.get_user_by_name('a')['email'], 'a@example.com')
+
+    def test_last_seen(self):
+        # init_cache读取LAST_SEEN_FLUSH_INTERVAL, 为0时立即写入
+        self.assertTrue(backend.users.update_last_seen(1, '2016-01-01 00:00:00'))
+        self.assertEqual(sql_users.get_user_by_id(1)['last_seen'], '2016-01-01 00:00:00')
+
+    def test_follow(self):
+        a, b, c = self.user_ids
+        sql_users.follow(a, b)
+        sql_users.follow(c, b)
+        sql_users.follow(c, b)
+        self.assertEqual((sql_users.followers_count(b), sql_users.following_count(c)), (2, 1))
+        self.assertTrue(sql_users.is_followed(a, b) and sql_users.is_followed_by(b, a))
+        sql_users.unfollow(a, b)
+        sql_users.unfollow(a, b)
+        self.assertEqual((sql_users.followers_count(b), sql_users.following_count(a)), (1, 0))
+        self.assertFalse(sql_users.is_followed(a, b))
+        self.assertEqual([user_id for user_id, _ in sql_users.followers_by_page(b, 1, 10)[0]], [c])
+
+    def test_paging(self):
+        post_ids = [sql_posts.publish_post('post {}'.format(n), self.user_ids[n % 2], 'html', '', 'body')
+                    for n in range(7)]
+        latest = [str(post_id) for post_id in reversed(post_ids)]
+        pages, cursor = [], None
+        for page_id in range(1, 5):
+            numbered = sql_posts.posts_by_page(page_id, 3)[0]
+            page, cursor = sql_posts.posts_by_page(page_id, 3, cursor)
+            self.assertEqual(page, numbered)
+            pages.extend(page)
+            if cursor is None:
+                break
+        self.assertEqual(pages, latest)
+        author_posts, cursor = sql_posts.posts_by_author(self.user_ids[0], 1, 2)
+        author_posts += sql_posts.posts_by_author(self.user_ids[0], 0, 2, cursor)[0]
+        self.assertEqual(author_posts, latest[::2][:4])
+        self.assertEqual(sql_posts.total_posts_by_author(self.user_ids[1]), 3)
+
+    def test_delete_purge_rerender(self):
+        post_ids = [sql_posts.publish_post('post {}'.format(n), self.user_ids[0], 'old', '', '**{}**'.format(n))
+                    for n in range(3)]
+        self.assertEqual(sql_posts.delete_post(post_ids[0]), self.user_ids[0])
+        self.assertIsNone(sql_posts.delete_post(post_ids[0]))
+        self.assertIsNone(sql_posts.get_post(post_ids[0]))
+        self.assertEqual((sql_posts.total_posts(), sql_posts.deleted_count()), (2, 1))
+        # 读取之后被修改的文章不覆盖
+        sources = next(sql_posts.iter_post_sources(10))
+        sql_posts.update_post_content(post_ids[1], 'edited', 'edited')
+        self.assertEqual(sql_posts.update_post_contents([(post_id, 'new', body, version)
+                                                         for post_id, body, _, version in sources]), [post_ids[2]])
+        self.assertEqual(sql_posts.get_post(post_ids[1])['content'], 'edited')
+        self.assertEqual(sum(rerender_posts(2)), 2)
+        self.assertEqual(sql_posts.get_post(post_ids[2])['content'], '<p><strong>2</strong></p>')
+        self.assertEqual(sql_posts.purge_deleted(10), 1)
+        self.assertEqual((sql_posts.deleted_count(), sql_posts.get_post_author(post_ids[0])), (0, None))
+
+    def test_placeholders(self):
+        dialect = sql.Dialect(None, None, None, '%s')
+        self.assertEqual(dialect.sql("SELECT id FROM t WHERE a = ? AND b LIKE 'x?%' AND \"c?\" = ?"),
+                         "SELECT id FROM t WHERE a = %s AND b LIKE 'x?%%' AND \"c?\" = %s")
+        with sql.cursor() as cur:
+            self.assertEqual(cur.execute("SELECT '?', ?", (1,)).fetchone(), ('?', 1))